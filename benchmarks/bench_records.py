@@ -0,0 +1,84 @@
+'''
+    Memory of 100k clients (list_allusers like records) as dicts vs ClientRecord
+
+    $ python benchmarks/bench_records.py
+'''
+import json
+import tracemalloc
+
+from unifi_api.utils.records import ClientRecord
+
+CLIENTS = 100000
+
+
+def make_client(i):
+    mac = '00:11:22:%02x:%02x:%02x' % (i // 65536 % 256, i // 256 % 256, i % 256)
+    return {
+        '_id': '5f%022x' % i,
+        'mac': mac,
+        'site_id': '5e0000000000000000000001',
+        'oui': 'Apple',
+        'hostname': 'host-%d' % i,
+        'name': 'client %d' % i,
+        'ip': '10.%d.%d.%d' % (i // 65536 % 256, i // 256 % 256, i % 256),
+        'ap_mac': '80:2a:a8:00:00:%02x' % (i % 32),
+        'essid': 'guest' if i % 3 else 'corp',
+        'network': 'LAN',
+        'is_guest': bool(i % 3),
+        'is_wired': False,
+        'first_seen': 1500000000 + i,
+        'last_seen': 1600000000 + i,
+        'uptime': i % 86400,
+        'rx_bytes': i * 1000,
+        'tx_bytes': i * 300,
+        # rarely used keys
+        'user_id': '5f%022x' % (i + 1),
+        'usergroup_id': '',
+        'noted': False,
+        'fingerprint_source': 0,
+        'dev_cat': 1,
+        'dev_family': 4,
+        'dev_vendor': 1,
+        'dev_id': 282,
+        'os_class': 15,
+        'os_name': 19,
+        'radio': 'na',
+        'radio_proto': 'ac',
+        'channel': 36,
+        'signal': -60 - i % 20,
+        'noise': -95,
+        'rssi': 35,
+        'tx_rate': 866700,
+        'rx_rate': 650000,
+        'satisfaction': 98,
+        'idletime': i % 60,
+        'assoc_time': 1600000000 + i,
+        'latest_assoc_time': 1600000000 + i,
+        'qos_policy_applied': True,
+        '_uptime_by_uap': i % 86400,
+        '_last_seen_by_uap': 1600000000 + i,
+    }
+
+
+def measure(build):
+    tracemalloc.start()
+    data = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return data, size
+
+
+def main():
+    body = json.dumps([make_client(i) for i in range(CLIENTS)])
+    dicts, dict_size = measure(lambda: json.loads(body))
+    records, record_size = measure(lambda: ClientRecord.from_records(json.loads(body)))
+    assert records[10].to_dict() == dicts[10]
+
+    print('%d clients, %d keys each, %.1f MB of json' % (CLIENTS, len(dicts[0]), len(body) / 1e6))
+    print('dicts          %8.1f MB' % (dict_size / 1e6))
+    print('ClientRecord   %8.1f MB' % (record_size / 1e6))
+    print('reduction      %8.0f %%' % (100 - 100 * record_size / dict_size))
+
+
+if __name__ == '__main__':
+    main()
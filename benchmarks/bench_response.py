@@ -0,0 +1,41 @@
+'''
+    Per call overhead of the response envelope check on a 50k records payload
+
+    $ python benchmarks/bench_response.py
+'''
+import json
+import timeit
+
+from unifi_api.utils import models
+
+RECORDS = 50000
+
+
+def make_payload(n=RECORDS):
+    return {
+        'meta': {'rc': 'ok'},
+        'data': [{'mac': '00:11:22:33:%02x:%02x' % (i // 256 % 256, i % 256), 'bytes': i, 'time': 1500000000000 + i} for i in range(n)],
+    }
+
+
+def bench(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+
+def main():
+    payload = make_payload()
+    body = json.dumps(payload)
+
+    decode = bench(lambda: json.loads(body), 5)
+    strict = bench(lambda: models.JsonResponse(payload), 5)
+    fast = bench(lambda: models.check_response(payload), 10000)
+
+    print('payload: %d records, %.1f MB' % (RECORDS, len(body) / 1e6))
+    print('json decode              %12.1f us' % (decode * 1e6))
+    print('JsonResponse (strict)    %12.1f us' % (strict * 1e6))
+    print('check_response (fast)    %12.1f us' % (fast * 1e6))
+    print('envelope speedup         %10.0fx' % (strict / fast))
+
+
+if __name__ == '__main__':
+    main()
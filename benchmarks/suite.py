@@ -0,0 +1,269 @@
+'''
+    Benchmark suite of the client hot paths, checked against a baseline of the same machine
+
+    $ python benchmarks/suite.py                          # run, compare with benchmarks/baseline.json
+    $ python benchmarks/suite.py --update-baseline        # store this run as the baseline
+    $ python benchmarks/suite.py -k find_device -o results.json
+
+    network cases run against the bundled fake controller (unifi_api.fake_controller),
+    the run exits with status 1 if any case is slower than `baseline * (1 + tolerance)`
+    the baseline is local (not committed, timings are machine specific): a run without a baseline
+    of this host and python version for every case fails, store one with --update-baseline
+'''
+from os.path import dirname, join as pjoin
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+
+import requests
+
+from unifi_api import UnifiClient
+from unifi_api.base_api import AbstractUnifiSession
+from unifi_api.fake_controller import FakeController
+from unifi_api.utils import models
+from unifi_api.utils.decorators import guard, set_validation_level, get_validation_level
+
+BASELINE = pjoin(dirname(__file__), 'baseline.json')
+
+SITES = 20
+DEVICES = 20
+# per request latency of the fake controller, in seconds
+LATENCY = 0.005
+
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def best(fn, number, repeat=5):
+    '''
+        returns the best seconds per call of `repeat` rounds of `number` calls
+    '''
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+class Session(AbstractUnifiSession):
+    def login(self, username=None, password=None):
+        return True
+
+
+def make_response(n):
+    body = json.dumps({
+        'meta': {'rc': 'ok'},
+        'data': [{'mac': '00:11:22:33:%02x:%02x' % (i // 256 % 256, i % 256), 'bytes': i, 'time': 1500000000000 + i} for i in range(n)],
+    }).encode()
+    r = requests.Response()
+    r.status_code = 200
+    r.headers['Content-Type'] = 'application/json;charset=UTF-8'
+    r._content = body
+    return r
+
+
+class Guarded:
+    @guard(client_mac=models.MacAddress, site=models.SiteName)
+    def call(self, client_mac, site='default'):
+        return site
+
+
+class Context:
+    '''
+        Shared fake controller and client of the network cases, started on first use
+    '''
+    controller = None
+
+    @classmethod
+    def get(cls):
+        if cls.controller is None:
+            cls.controller = FakeController(sites=SITES, devices=DEVICES, clients=10, latency=LATENCY).start()
+            cls.client = UnifiClient(cls.controller.url, username='admin', password='admin', pool_maxsize=SITES)
+            cls.client.login()
+            cls.sites = [s['name'] for s in cls.client.list_sites()]
+        return cls
+
+    @classmethod
+    def stop(cls):
+        if cls.controller is not None:
+            cls.controller.stop()
+            cls.controller = None
+
+
+@benchmark
+def process_response_small():
+    session = Session('http://localhost')
+    r = make_response(10)
+    return best(lambda: session.process_response(r), 2000)
+
+
+@benchmark
+def process_response_huge():
+    session = Session('http://localhost')
+    r = make_response(50000)
+    return best(lambda: session.process_response(r), 3)
+
+
+def _guard_call(level):
+    obj = Guarded()
+    previous = get_validation_level()
+    set_validation_level(level)
+    try:
+        return best(lambda: obj.call('00:11:22:33:44:55', site='default'), 20000)
+    finally:
+        set_validation_level(previous)
+
+
+@benchmark
+def guard_full():
+    return _guard_call('full')
+
+
+@benchmark
+def guard_types():
+    return _guard_call('types')
+
+
+@benchmark
+def mac_address_cached():
+    macs = ['00:11:22:33:%02x:%02x' % (i // 256, i % 256) for i in range(1000)]
+    return best(lambda: [models.MacAddress(m) for m in macs], 20) / len(macs)
+
+
+@benchmark
+def mac_address_uncached():
+    macs = ['00-11-22-%02X-%02X-%02X' % (i // 65536, i // 256 % 256, i % 256) for i in range(10000)]
+    def run():
+        models.normalize_macaddr.cache_clear()
+        for m in macs:
+            models.MacAddress(m)
+    return best(run, 1) / len(macs)
+
+
+@benchmark
+def find_device_index_build():
+    ctx = Context.get()
+    return best(ctx.client.build_device_index, 1)
+
+
+@benchmark
+def find_device_lookup():
+    ctx = Context.get()
+    client = ctx.client
+    client.build_device_index()
+    mac = 'f0:9f:00:%02x:00:%02x' % (SITES - 1, DEVICES - 1)
+    assert client.find_device(mac) == ctx.sites[-1]
+    return best(lambda: client.find_device(mac), 5000)
+
+
+@benchmark
+def relogin():
+    ctx = Context.get()
+    def run():
+        ctx.controller.expire_cookies()
+        ctx.client.list_sites()
+    return best(run, 1, repeat=10)
+
+
+@benchmark
+def sweep_sequential():
+    ctx = Context.get()
+    return best(lambda: [ctx.client.list_devices(site=s) for s in ctx.sites], 1)
+
+
+@benchmark
+def sweep_concurrent():
+    ctx = Context.get()
+    return best(lambda: list(ctx.client.for_each_site('list_devices', sites=ctx.sites, max_workers=SITES)), 1)
+
+
+def run(names):
+    results = {}
+    try:
+        for name in names:
+            results[name] = min(BENCHMARKS[name](), results.get(name, float('inf')))
+            print('%-26s %14.3f us' % (name, results[name] * 1e6), file=sys.stderr)
+    finally:
+        Context.stop()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+        returns the list of (name, seconds, baseline seconds) slower than the tolerance
+    '''
+    regressions = []
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        if base is not None and seconds > base * (1 + tolerance):
+            regressions.append((name, seconds, base))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='filter', default=None, help='only run cases containing this string')
+    parser.add_argument('-o', '--output', default=None, help='write the results as json to this file')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file, defaults to benchmarks/baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed slowdown over the baseline, defaults to 0.5 (+50%%)')
+    parser.add_argument('--confirm', type=int, default=2, help='re-runs of regressed cases before failing, defaults to 2')
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as the baseline')
+    args = parser.parse_args(argv)
+
+    names = [n for n in BENCHMARKS if args.filter is None or args.filter in n]
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'host': platform.node(),
+        'time': int(time.time()),
+        'unit': 'seconds per call',
+    }
+    try:
+        with open(args.baseline, 'r') as fh:
+            stored = json.load(fh)
+    except FileNotFoundError:
+        stored = None
+    # absolute timings only compare on the machine that took them
+    if stored is not None and any(stored.get(key) != report[key] for key in ('python', 'machine', 'host')):
+        print('baseline %s was taken on %s (python %s)' % (args.baseline, stored.get('host'), stored.get('python')), file=sys.stderr)
+        stored = None
+    baseline = {} if stored is None else stored['results']
+
+    if not args.update_baseline:
+        missing = [name for name in names if name not in baseline]
+        if missing:
+            print('no baseline of this machine for %s, run with --update-baseline first' % ', '.join(missing), file=sys.stderr)
+            return 2
+
+    results = report['results'] = run(names)
+    if args.update_baseline:
+        # cases left out by -k keep their baseline
+        with open(args.baseline, 'w') as fh:
+            json.dump(dict(report, results=dict(baseline, **results)), fh, indent=2)
+        if args.output:
+            with open(args.output, 'w') as fh:
+                json.dump(report, fh, indent=2)
+        print('baseline updated: %s' % args.baseline, file=sys.stderr)
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        # confirm them, single runs of the short cases are noisy
+        print('re-running %s' % ', '.join(r[0] for r in regressions), file=sys.stderr)
+        retried = run([r[0] for r in regressions] * args.confirm)
+        for name, seconds in retried.items():
+            results[name] = min(results[name], seconds)
+        regressions = compare(results, baseline, args.tolerance)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+    for name, seconds, base in regressions:
+        print('REGRESSION %s: %.3f us vs %.3f us baseline (%+.0f%%)' % (name, seconds * 1e6, base * 1e6, 100 * (seconds / base - 1)), file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,9 @@
 from .api import UnifiClient
-from . import api, base_api, utils
+from .pool import UnifiClientPool
+from . import api, base_api, pool, utils
 
 import urllib3
 urllib3.disable_warnings()
 
 
-__all__ = ['UnifiClient', 'api', 'base_api', 'utils']
+__all__ = ['UnifiClient', 'UnifiClientPool', 'api', 'base_api', 'pool', 'utils']
@@ -1,16 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import copy_context
 from datetime import datetime
+from threading import Lock
+import time
 import trafaret as t
 
 from .base_api import AbstractUnifiSession
 from .utils import models
 from .utils.decorators import requires_login, guard
-from .utils.exceptions import UnifiLoginError
+from .utils.exceptions import UnifiCallFailed, UnifiLoginError, UnifiSiteErrors
+from .utils.times import time_range, split_range
+from .utils.sync import SyncState, fingerprint
+from .utils.records import RECORD_CLASSES
+from .utils.watch import Watcher
+from .utils.timeseries import TimeSeries
 
 
 class UnifiClient(AbstractUnifiSession):
     '''
         Unifi API client
     '''
+    # seconds until the device -> site index is rebuilt, None to never expire
+    device_index_ttl = 5*60
+    # minimum seconds between index rebuilds triggered by lookup misses
+    device_index_miss_interval = 30
+
+    # stats reports longer than this (milliseconds, per granularity) are fetched in aligned chunks
+    report_chunk_size = {
+        '5minutes': 24*60*60*1000,
+        'hourly': 7*24*60*60*1000,
+        'daily': 365*24*60*60*1000,
+    }
+    # max concurrent requests for the chunks of a report
+    report_max_workers = 4
+
+    # seconds before the watermark re-read by incremental syncs, catches late and updated records
+    sync_overlap = 60*60
+
+    def __init__(self, *args, **kwargs):
+        self._device_index = None
+        self._device_index_time = 0
+        self._device_index_lock = Lock()
+        # site -> exception of the sites that failed in the last index build
+        self.device_index_errors = {}
+        # watermarks of `sync_sessions`/`sync_authorizations`, replace with SyncState(path) to persist them
+        self.sync_state = SyncState()
+        super(UnifiClient, self).__init__(*args, **kwargs)
+
     def login(self, username=None, password=None):
         self.debug('------LOGIN------')
 
@@ -31,38 +67,51 @@ class UnifiClient(AbstractUnifiSession):
             # if instance doesn't have username or password, cannot login
             raise UnifiLoginError('Missing login information')
 
-        # login with clean slate session
-        self.clean_session()
+        # login with clean cookies, pooled connections are kept
+        self.clear_cookies()
 
         # make login call
-        r = self.session.post(
-            self.endpoint('/api/login'),
-            headers={'Referer': self.endpoint('/login')},
-            json={
-                'username': self.username,
-                'password': self.password,
-            },
-            timeout=4
-        )
+        url = self.endpoint('/api/login')
+        started = time.perf_counter()
+        with self.span('login', url=url):
+            r = self.session.post(
+                url,
+                headers={'Referer': self.endpoint('/login')},
+                json={
+                    'username': self.username,
+                    'password': self.password,
+                },
+                timeout=4
+            )
+        self.metrics.observe_request('POST', url, r.status_code, time.perf_counter() - started, len(r.content))
+        self.metrics.observe_login(self.logged_in)
+        self.login_generation += 1
+        self.login_time = time.monotonic() if self.logged_in else None
+        self.store_cookie()
 
         # debug messages
-        self.debug('LOGIN REQUEST')
-        self.debug('url:', r.request.url)
-        self.debug('body:', r.request.body.decode())
-        self.debug('headers:', r.request.headers)
-        self.debug('LOGIN RESPONSE')
-        self.debug('status:', r.status_code)
-        self.debug('text:', r.text)
-        self.debug('headers:', r.headers)
-        self.debug('cookies:', r.cookies)
-        self.debug('------END LOGIN------')
+        if self.debug_enabled:
+            self.debug('LOGIN REQUEST')
+            self.debug('url: %s', r.request.url)
+            self.debug('body: %s', r.request.body.decode())
+            self.debug('headers: %s', r.request.headers)
+            self.debug('LOGIN RESPONSE')
+            self.debug('status: %s', r.status_code)
+            self.debug('text: %s', r.text)
+            self.debug('headers: %s', r.headers)
+            self.debug('cookies: %s', r.cookies)
+            self.debug('------END LOGIN------')
 
         return self.logged_in
 
     def logout(self):
         if not self.logged_in:
             return False
+        # a background refresh would log in again (and store the new cookie)
+        self.stop_refresh()
         self.post(self.endpoint('/logout'))
+        # the controller drops the session, other users of the store would get LoginRequired
+        self.forget_cookie()
         self.clean_session()
         return True
 
@@ -105,7 +154,10 @@ class UnifiClient(AbstractUnifiSession):
             data['ap_mac'] = ap_mac
         if MB_limit is not None:
             data['MB_limit'] = MB_limit
-        self.debug('Posting authorize guest: %s' % data)
+        self.debug('Posting authorize guest: %s', data)
+        return self._stamgr(site, data)
+
+    def _stamgr(self, site, data):
         r = self.post(self.endpoint('/api/s/%s/cmd/stamgr' % site), json=data, timeout=6)
         return self.process_response(r, boolean=True)
 
@@ -127,9 +179,7 @@ class UnifiClient(AbstractUnifiSession):
             'cmd': cmd,
             'mac': client_mac,
         }
-
-        r = self.post(self.endpoint('/api/s/%s/cmd/stamgr' % site), json=data, timeout=6)
-        return self.process_response(r, boolean=True)
+        return self._stamgr(site, data)
 
     @guard(client_mac=models.MacAddress, site=models.SiteName)
     def unauthorize_guest(self, client_mac, site='default'):
@@ -195,9 +245,66 @@ class UnifiClient(AbstractUnifiSession):
             'cmd': 'forget-sta',
             'mac': client_macs,
         }
+        return self._stamgr(site, data)
 
-        r = self.post(self.endpoint('/api/s/%s/cmd/stamgr' % site), json=data, timeout=6)
-        return self.process_response(r, boolean=True)
+    @requires_login
+    def stamgr_batch(self, commands, max_workers=8):
+        '''
+            Run many stamgr commands, grouped by site
+            -------------------------
+            returns a dict of client mac -> True/False (success) or the exception raised by its command
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                commands    |   True    | iterable of (cmd, client_mac, site, params) tuples
+                max_workers |   False   | max number of sites handled concurrently, defaults to 8
+
+            # cmd is one of: authorize-guest, unauthorize-guest, kick-sta, block-sta, unblock-sta, forget-sta
+            # params is None or a dict with the controller fields: minutes (required to authorize), up, down, MB_limit, ap_mac
+            # site None is resolved with `find_device` from params ap_mac (or `default` without ap_mac)
+            # every command is validated before anything is sent, commands of a site run in order
+            # except forget-sta, which is sent once per site with all its macs
+            # if a mac has many commands only the result of the last one is kept
+        '''
+        assert max_workers > 0, 'max_workers must be positive'
+        groups = {}
+        for cmd, client_mac, site, params in models.stamgr_batch_params(list(commands)):
+            params = params or {}
+            assert cmd != 'authorize-guest' or 'minutes' in params, 'authorize-guest requires minutes'
+            if site is None:
+                site = self.find_device(params['ap_mac']) if 'ap_mac' in params else 'default'
+                assert site is not None, 'No site provided and AP does not belong to any known site'
+            groups.setdefault(site, []).append((cmd, client_mac, params))
+
+        results = {}
+        errors = {}
+        sweep = self.for_each_site(lambda site: self._stamgr_group(site, groups[site]), sites=list(groups),
+                                   max_workers=max_workers, errors=errors)
+        for site, group_results in sweep:
+            results.update(group_results)
+        for site, ex in errors.items():
+            results.update((client_mac, ex) for cmd, client_mac, params in groups[site])
+        return results
+
+    def _stamgr_group(self, site, commands):
+        results = {}
+        forget = []
+        for cmd, client_mac, params in commands:
+            if cmd == 'forget-sta':
+                forget.append(client_mac)
+                continue
+            data = dict(params, cmd=cmd, mac=client_mac.lower())
+            try:
+                results[client_mac] = self._stamgr(site, data)
+            except Exception as ex:
+                results[client_mac] = ex
+        if forget:
+            try:
+                r = self._stamgr(site, {'cmd': 'forget-sta', 'mac': forget})
+            except Exception as ex:
+                r = ex
+            results.update(dict.fromkeys(forget, r))
+        return results
 
     @requires_login
     def list_sites(self):
@@ -226,6 +333,152 @@ class UnifiClient(AbstractUnifiSession):
         r = self.get(self.endpoint('/api/s/%s/stat/device/%s' % (site, device_mac or '')))
         return self.process_response(r)
 
+    @requires_login
+    def for_each_site(self, method, sites=None, max_workers=8, errors=None, **kwargs):
+        '''
+            Run a site scoped call on many sites in parallel
+            -------------------------
+            yields (site, result) pairs as the calls complete
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                method      |   True    | name of a client method (or a callable) receiving `site` as keyword
+                sites       |   False   | site names to run on, defaults to all sites from `list_sites`
+                max_workers |   False   | max number of concurrent calls, defaults to 8
+                errors      |   False   | dict to collect site -> exception of failed calls
+                **kwargs    |   False   | extra params for every call
+
+            # a failed site doesn't stop the others, if `errors` isn't given
+            # UnifiSiteErrors is raised after every result has been yielded
+        '''
+        assert max_workers > 0, 'max_workers must be positive'
+        fn = getattr(self, method) if isinstance(method, str) else method
+        if sites is None:
+            sites = [s['name'] for s in self.list_sites() or []]
+        failed = {} if errors is None else errors
+
+        def call(site):
+            with self.span('site', site=site):
+                return fn(site=site, **kwargs)
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        # each call runs in a copy of the caller context, so its spans nest in the current one
+        futures = {executor.submit(copy_context().run, call, site): site for site in sites}
+        try:
+            for f in as_completed(futures):
+                try:
+                    result = f.result()
+                except Exception as ex:
+                    failed[futures[f]] = ex
+                    continue
+                yield futures[f], result
+        finally:
+            # stop pending calls if the consumer gave up early
+            for f in futures:
+                f.cancel()
+            executor.shutdown(wait=False)
+        if errors is None and failed:
+            raise UnifiSiteErrors(failed)
+
+    def columnar(self, method, *args, **kwargs):
+        '''
+            Run a stats call and get a columnar result
+            -------------------------
+            returns a `utils.timeseries.TimeSeries` (or False if the call failed)
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                method      |   True    | name of a client method (or a callable) returning report records,
+                            |           | e.g. site_stat_5min, ap_stat_hourly, stat_reportAp, speedtest_result
+                *args       |   False   | params of the call
+                **kwargs    |   False   | params of the call
+
+            # the response is streamed into the columns, the list of records is never built
+        '''
+        fn = getattr(self, method) if isinstance(method, str) else method
+        with self.streaming():
+            records = fn(*args, **kwargs)
+            if records is False:
+                return False
+            return TimeSeries.from_records(records)
+
+    def records(self, method, *args, record=None, **kwargs):
+        '''
+            Run a call and get compact records instead of dicts
+            -------------------------
+            returns a list of `utils.records.Record` (or False if the call failed)
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                method      |   True    | name of a client method (or a callable) returning clients, devices or sessions,
+                            |           | e.g. list_allusers, stat_clients, list_devices, list_sessions
+                record      |   False   | Record subclass, defaults to the one of `method` in `utils.records.RECORD_CLASSES`
+                *args       |   False   | params of the call
+                **kwargs    |   False   | params of the call
+
+            # the response is streamed into the records, the list of dicts is never built
+        '''
+        if record is None:
+            assert isinstance(method, str) and method in RECORD_CLASSES, 'record class required for %r' % (method, )
+            record = RECORD_CLASSES[method]
+        fn = getattr(self, method) if isinstance(method, str) else method
+        with self.streaming():
+            data = fn(*args, **kwargs)
+            if data is False:
+                return False
+            return record.from_records(data)
+
+    def watch(self, site='default', clients=True, devices=True):
+        '''
+            Watch the clients and devices of a site
+            -------------------------
+            returns a `utils.watch.Watcher`, its `poll()` returns the join, leave, roam, ip_change and
+            state_change events since the previous poll, `events(interval)` yields them forever
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                site        |   False   | site name, defaults to `default`
+                clients     |   False   | watch online clients, defaults to True
+                devices     |   False   | watch devices, defaults to True
+        '''
+        return Watcher(self, site=site, clients=clients, devices=devices)
+
+    def build_device_index(self):
+        '''
+            Build the device -> site index used by `find_device`
+            -------------------------
+            returns a dict mapping device mac addresses to site names
+
+            # This is a costly function, it lists the devices of every site (in parallel)
+            # sites that fail (exception or False) keep their entries of the previous index,
+            # see `device_index_errors`
+        '''
+        index = {}
+        errors = {}
+        with self.span('device_index'):
+            for site, devices in self.for_each_site('list_devices', errors=errors):
+                if devices is False:
+                    errors[site] = UnifiCallFailed('list_devices failed on site %s' % site)
+                    continue
+                for d in devices:
+                    index[models.format_macaddr(d['mac'])] = site
+        if errors:
+            self.debug('device index: listing devices failed on %d site(s): %s', len(errors), ', '.join(sorted(errors)))
+            for mac, site in (self._device_index or {}).items():
+                if site in errors:
+                    index.setdefault(mac, site)
+        self.device_index_errors = errors
+        self._device_index = index
+        self._device_index_time = time.monotonic()
+        return index
+
+    def invalidate_device_index(self):
+        '''
+            Drop the device -> site index, next `find_device` call will rebuild it
+        '''
+        self._device_index = None
+        self._device_index_time = 0
+
     @guard(device_mac=models.MacAddress)
     def find_device(self, device_mac):
         '''
@@ -238,11 +491,18 @@ class UnifiClient(AbstractUnifiSession):
                 -----------------------------------------
                 device_mac  |   True   | device mac address
 
-            # This is a costly function, use with caution
+            # Lookups use an index of all devices, rebuilt every `device_index_ttl` seconds
+            # or on a miss (at most once every `device_index_miss_interval` seconds)
         '''
-        for s in self.list_sites():
-            if device_mac in [models.MacAddress(d['mac']) for d in self.list_devices(site=s['name'])]:
-                return models.SiteName(s['name'])
+        with self.span('find_device', mac=device_mac), self._device_index_lock:
+            age = time.monotonic() - self._device_index_time
+            index = self._device_index
+            if index is None or (self.device_index_ttl is not None and age > self.device_index_ttl):
+                index = self.build_device_index()
+            elif device_mac not in index and age >= self.device_index_miss_interval:
+                index = self.build_device_index()
+        site = index.get(device_mac)
+        return None if site is None else models.SiteName(site)
 
     # skipping user management functions for now
 
@@ -264,9 +524,7 @@ class UnifiClient(AbstractUnifiSession):
                 end         |   False   | Unix timestamp in seconds or datetime, defaults to now
                 site        |   False   | site name to get sessions, defaults to `default`
         '''
-        end = end*1000 if isinstance(end, int) else int(datetime.now().timestamp()*1000) if end is None else int(end.timestamp()*1000)
-        start = start*1000 if isinstance(start, int) else end - 7*24*60*60*1000 if start is None else int(start.timestamp()*1000)
-        assert 0 < start < end, 'start must be before end (and both positive)'
+        start, end = time_range(start, end, 7*24*60*60*1000)
 
         data = {
             'type': client_type,
@@ -316,9 +574,7 @@ class UnifiClient(AbstractUnifiSession):
                 end         |   False   | Unix timestamp in seconds or datetime, defaults to now
                 site        |   False   | site name to get authorizations, defaults to `default`
         '''
-        end = end*1000 if isinstance(end, int) else int(datetime.now().timestamp()*1000) if end is None else int(end.timestamp()*1000)
-        start = start*1000 if isinstance(start, int) else end - 7*24*60*60*1000 if start is None else int(start.timestamp()*1000)
-        assert 0 < start < end, 'start must be before end (and both positive)'
+        start, end = time_range(start, end, 7*24*60*60*1000)
 
         data = {
             'start': start,
@@ -328,6 +584,85 @@ class UnifiClient(AbstractUnifiSession):
         r = self.get(self.endpoint('/api/s/%s/stat/authorization' % site), json=data)
         return self.process_response(r)
 
+    def _sync(self, kind, time_key, site, overlap, fetch, end_key=None):
+        watermark, seen = self.sync_state.get(kind, site)
+        open_records = self.sync_state.get_open(kind, site)
+        overlap = self.sync_overlap if overlap is None else overlap
+        start = None if watermark is None else watermark - overlap
+        if start is not None and open_records:
+            # records open at the last sync (no `end_key`) can end or change later, read from the oldest
+            start = min(start, min(open_records.values()))
+        records = fetch(start)
+        if records is False:
+            return
+
+        kept = {}
+        still_open = {}
+        for record in records:
+            rid = record.get('_id')
+            digest = fingerprint(record)
+            if rid is None or seen.get(rid) != digest:
+                yield record
+            record_time = record.get(time_key)
+            if record_time is None:
+                continue
+            if watermark is None or record_time > watermark:
+                watermark = record_time
+            if rid is not None:
+                kept[rid] = (record_time, digest)
+                if end_key is not None and record.get(end_key) is None:
+                    still_open[rid] = record_time
+
+        # only records from the start of the next fetch (overlap window or oldest open record) are read again
+        if watermark is not None:
+            start = min([watermark - overlap] + list(still_open.values()))
+            seen = {rid: digest for rid, (record_time, digest) in kept.items() if record_time >= start}
+            self.sync_state.set(kind, site, watermark, seen, still_open)
+
+    @requires_login
+    @guard(client_type=t.Enum('all', 'guest', 'user'), site=models.SiteName, overlap=t.Or(t.Int(gte=1), t.Atom(None)))
+    def sync_sessions(self, client_type='all', site='default', overlap=None):
+        '''
+            Get the login sessions added or changed since the last sync
+            -------------------------
+            returns a generator of new or changed sessions, the first sync returns the last 7 days
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                client_type |   False   | type of client, can be: ['all', 'guest', 'user']
+                site        |   False   | site name to get sessions, defaults to `default`
+                overlap     |   False   | seconds re-read before the watermark, defaults to `sync_overlap`
+
+            # the watermark (latest `assoc_time`) is stored in `sync_state` once the generator is
+            # exhausted, a sync stopped midway is repeated in full next time
+            # sessions without `disassoc_time` are re-read until they end, however long they last
+        '''
+        return self._sync(
+            'sessions', 'assoc_time', site, overlap,
+            lambda start: self.list_sessions(client_type=client_type, start=start, site=site),
+            end_key='disassoc_time',
+        )
+
+    @requires_login
+    @guard(site=models.SiteName, overlap=t.Or(t.Int(gte=1), t.Atom(None)))
+    def sync_authorizations(self, site='default', overlap=None):
+        '''
+            Get the authorizations added or changed since the last sync
+            -------------------------
+            returns a generator of new or changed authorizations, the first sync returns the last 7 days
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                site        |   False   | site name to get authorizations, defaults to `default`
+                overlap     |   False   | seconds re-read before the watermark, defaults to `sync_overlap`
+
+            # the watermark is the latest authorization `start`, see `sync_sessions`
+        '''
+        return self._sync(
+            'authorizations', 'start', site, overlap,
+            lambda start: self.list_authorizations(start=start, site=site),
+        )
+
     @requires_login
     @guard(last_hours=t.Int, site=models.SiteName)
     def list_allusers(self, last_hours=365*24, site='default'):
@@ -385,11 +720,7 @@ class UnifiClient(AbstractUnifiSession):
                 client_mac  |   False   | client mac to search, if not provided all clients will be returned
                 site        |   False   | site name to get authorizations, defaults to `default`
         '''
-        data = {
-            'within': last_hours,
-        }
-
-        r = self.get(self.endpoint('/api/s/%s/stat/sta/%s' % (site, client_mac or '')), json=data)
+        r = self.get(self.endpoint('/api/s/%s/stat/sta/%s' % (site, client_mac or '')))
         return self.process_response(r)
 
     @requires_login
@@ -409,6 +740,90 @@ class UnifiClient(AbstractUnifiSession):
         return self.process_response(r)
 
 
+    def _report(self, kind, gran, site, mac, data):
+        '''
+            Request a stat/report, through `report_cache` when enabled
+            -------------------------
+            returns the report records
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                kind        |   True    | report kind: site, ap, user, gw
+                gran        |   True    | granularity: 5minutes, hourly, daily
+                site        |   True    | site name
+                mac         |   True    | mac of the reported object, None for site/gw reports or all aps
+                data        |   True    | request body with attrs, start and end
+
+            # reports of all the aps of a site (ap without mac) aren't cached
+        '''
+        url = self.endpoint('/api/s/%s/stat/report/%s.%s' % (site, gran, kind))
+
+        def fetch_chunk(start, end):
+            r = self.get(url, json=dict(data, start=start, end=end))
+            return self.process_response(r)
+
+        def fetch(start, end):
+            return self._fetch_chunked(gran, start, end, fetch_chunk)
+
+        if self.report_cache is None or (kind == 'ap' and mac is None):
+            return fetch(data['start'], data['end'])
+        return self.report_cache.query(site, kind, mac, gran, data['attrs'], data['start'], data['end'], fetch,
+                                       controller=self.base_url)
+
+    def _fetch_chunked(self, gran, start, end, fetch):
+        '''
+            Fetch a report range in granularity aligned chunks
+            -------------------------
+            returns the records of every chunk sorted by time, without duplicates, or False if a chunk failed
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                gran        |   True    | granularity: 5minutes, hourly, daily
+                start, end  |   True    | time range in milliseconds
+                fetch       |   True    | callable(start, end) requesting a chunk, returns records or False
+
+            # chunk sizes come from `report_chunk_size`, at most `report_max_workers` chunks are fetched at once
+            # in streaming mode chunks are fetched one after the other as the records are consumed,
+            # a chunk failing after the first raises ValueError
+        '''
+        chunk_size = self.report_chunk_size.get(gran)
+        chunks = [(start, end)] if chunk_size is None else split_range(start, end, chunk_size)
+        if len(chunks) == 1:
+            return fetch(start, end)
+        if self.streaming_enabled:
+            return self._stream_chunks(chunks, fetch)
+
+        with ThreadPoolExecutor(max_workers=min(self.report_max_workers, len(chunks))) as executor:
+            results = list(executor.map(lambda chunk: copy_context().run(fetch, *chunk), chunks))
+        if any(records is False for records in results):
+            return False
+        # the same bucket of an object may come in two chunks
+        merged = {}
+        for records in results:
+            for record in records:
+                merged[(record['time'], record.get('oid'))] = record
+        return sorted(merged.values(), key=lambda record: record['time'])
+
+    def _stream_chunks(self, chunks, fetch):
+        # returns False if the first chunk fails, like a streamed response
+        first = fetch(*chunks[0])
+        if first is False:
+            return False
+
+        def records():
+            current = first
+            for i, (chunk_start, chunk_end) in enumerate(chunks):
+                if i:
+                    current = fetch(chunk_start, chunk_end)
+                    if current is False:
+                        raise ValueError('Controller returned an error for the chunk %s-%s' % (chunk_start, chunk_end))
+                last = i == len(chunks) - 1
+                for record in current:
+                    # the bucket starting the next chunk comes again with it
+                    if last or record['time'] <= chunk_end:
+                        yield record
+        return records()
+
     # Site stats
 
     @requires_login
@@ -429,17 +844,14 @@ class UnifiClient(AbstractUnifiSession):
 
             # support and restrictions apply from 'site_stat_*' functions
         '''
-        end = end*1000 if isinstance(end, int) else int(datetime.now().timestamp()*1000) if end is None else int(end.timestamp()*1000)
-        start = start*1000 if isinstance(start, int) else end - def_range if start is None else int(start.timestamp()*1000)
-        assert 0 < start < end, 'start must be before end (and both positive)'
+        start, end = time_range(start, end, def_range)
 
         data = {
             'attrs': ['bytes', 'wan-tx_bytes', 'wan-rx_bytes', 'wlan_bytes', 'num_sta', 'lan-num_sta', 'wlan-num_sta', 'time'],
             'start': start,
             'end': end,
         }
-        r = self.get(self.endpoint('/api/s/%s/stat/report/%s.site' % (site, gran)), json=data)
-        return self.process_response(r)
+        return self._report('site', gran, site, None, data)
 
 
     # site stats: 5 min
@@ -518,9 +930,7 @@ class UnifiClient(AbstractUnifiSession):
 
             # support and restrictions apply from 'ap_stat_*' functions
         '''
-        end = end*1000 if isinstance(end, int) else int(datetime.now().timestamp()*1000) if end is None else int(end.timestamp()*1000)
-        start = start*1000 if isinstance(start, int) else end - def_range if start is None else int(start.timestamp()*1000)
-        assert 0 < start < end, 'start must be before end (and both positive)'
+        start, end = time_range(start, end, def_range)
 
         data = {
             'attrs': ['bytes', 'num_sta', 'time'],
@@ -535,8 +945,7 @@ class UnifiClient(AbstractUnifiSession):
         elif site is None:
             site = 'default'
 
-        r = self.get(self.endpoint('/api/s/%s/stat/report/%s.ap' % (site, gran)), json=data)
-        return self.process_response(r)
+        return self._report('ap', gran, site, ap_mac, data)
 
     # ap stats: 5 min
     @guard(models.ap_stats_params)
@@ -616,21 +1025,18 @@ class UnifiClient(AbstractUnifiSession):
 
             # support and restrictions apply from 'user_stat_*' functions
         '''
-        end = end*1000 if isinstance(end, int) else int(datetime.now().timestamp()*1000) if end is None else int(end.timestamp()*1000)
-        start = start*1000 if isinstance(start, int) else end - def_range if start is None else int(start.timestamp()*1000)
-        assert 0 < start < end, 'start must be before end (and both positive)'
+        start, end = time_range(start, end, def_range)
 
         data = {
             'mac': user_mac,
-            'attrs': attrs if 'time' in attrs else attrs.append('time'),
+            'attrs': attrs if 'time' in attrs else attrs + ['time'],
             'start': start,
             'end': end,
         }
 
         # site?
 
-        r = self.get(self.endpoint('/api/s/%s/stat/report/%s.user' % (site, gran)), json=data)
-        return self.process_response(r)
+        return self._report('user', gran, site, user_mac, data)
 
     @guard(models.user_stats_params)
     def user_stat_5min(self, user_mac, attrs=['rx_bytes', 'tx_bytes'], start=None, end=None, site=None):
@@ -747,18 +1153,15 @@ class UnifiClient(AbstractUnifiSession):
 
             # support and restrictions apply from 'gateway_stat_*' functions
         '''
-        end = end*1000 if isinstance(end, int) else int(datetime.now().timestamp()*1000) if end is None else int(end.timestamp()*1000)
-        start = start*1000 if isinstance(start, int) else end - def_range if start is None else int(start.timestamp()*1000)
-        assert 0 < start < end, 'start must be before end (and both positive)'
+        start, end = time_range(start, end, def_range)
 
         data = {
-            'attrs': attrs if 'time' in attrs else attrs.append('time'),
+            'attrs': attrs if 'time' in attrs else attrs + ['time'],
             'start': start,
             'end': end,
         }
 
-        r = self.get(self.endpoint('/api/s/%s/stat/report/%s.gw' % (site, gran)), json=data)
-        return self.process_response(r)
+        return self._report('gw', gran, site, None, data)
 
     @guard(models.gateway_stats_params)
     def gateway_stat_5min(self, attrs=['mem', 'cpu', 'loadavg_5'], start=None, end=None, site='default'):
@@ -871,9 +1274,7 @@ class UnifiClient(AbstractUnifiSession):
 
             # must have a USG on the site
         '''
-        end = end*1000 if isinstance(end, int) else int(datetime.now().timestamp()*1000) if end is None else int(end.timestamp()*1000)
-        start = start*1000 if isinstance(start, int) else end - 24*60*60*1000 if start is None else int(start.timestamp()*1000)
-        assert 0 < start < end, 'start must be before end (and both positive)'
+        start, end = time_range(start, end, 24*60*60*1000)
 
         data = {
             'attrs': ['xput_download', 'xput_upload', 'latency', 'time'],
@@ -920,6 +1321,7 @@ class UnifiClient(AbstractUnifiSession):
                       date_range: tuple of datetime range
                       interval: daily, hourly, 5minutes. Default is 'daily'
                       attrs: aditional filters, default is ["bytes","num_sta","time"]
+            Long ranges are fetched in parallel chunks, see `_fetch_chunked`
         '''
         assert date_range, "date_range is required"
         data = {"start": self.datetemp(date_range[0]), "end": self.datetemp(date_range[1])}
@@ -930,8 +1332,12 @@ class UnifiClient(AbstractUnifiSession):
                 "time"]
         else:
             data["attrs"] = attrs
-        r = self.post(self.endpoint('/api/s/{}/stat/report/{}.site' .format(site, interval)), json=data)
-        return self.process_response(r)
+        url = self.endpoint('/api/s/{}/stat/report/{}.site' .format(site, interval))
+
+        def fetch(start, end):
+            r = self.post(url, json=dict(data, start=start, end=end))
+            return self.process_response(r)
+        return self._fetch_chunked(interval, data['start'], data['end'], fetch)
 
     @requires_login
     def stat_reportAp(self, site, date_range, macs=None, interval='daily', attrs=None):
@@ -942,6 +1348,7 @@ class UnifiClient(AbstractUnifiSession):
                       macs: Array of AP mac's
                       interval: daily, hourly, 5minutes. Default is 'daily'
                       attrs: Aditional filters, default is ["bytes","num_sta","time"]
+            Long ranges are fetched in parallel chunks, see `_fetch_chunked`
         '''
         data = {
             "start": self.datetemp(date_range[0]),
@@ -950,8 +1357,12 @@ class UnifiClient(AbstractUnifiSession):
             data["attrs"] = ["bytes", "num_sta","time"]
         else:
             data["attrs"] = attrs
-        r = self.post(self.endpoint('/api/s/{}/stat/report/{}.ap' .format(site, interval)), json=data, timeout=4)
-        return self.process_response(r)
+        url = self.endpoint('/api/s/{}/stat/report/{}.ap' .format(site, interval))
+
+        def fetch(start, end):
+            r = self.post(url, json=dict(data, start=start, end=end), timeout=4)
+            return self.process_response(r)
+        return self._fetch_chunked(interval, data['start'], data['end'], fetch)
 
     @requires_login
     def stat_widgetHealth(self, site):
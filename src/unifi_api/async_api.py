@@ -0,0 +1,497 @@
+from asyncio import Lock, gather
+import time
+import trafaret as t
+
+from .async_base_api import AsyncUnifiSession
+from .utils import models
+from .utils.decorators import async_requires_login, guard
+from .utils.exceptions import UnifiLoginError
+from .utils.times import time_range, timestamp_ms
+
+
+class AsyncUnifiClient(AsyncUnifiSession):
+    '''
+        asyncio Unifi API client
+        mirrors `UnifiClient`, every call is a coroutine, see the `UnifiClient` methods for params
+    '''
+    # seconds until the device -> site index is rebuilt, None to never expire
+    device_index_ttl = 5*60
+    # minimum seconds between index rebuilds triggered by lookup misses
+    device_index_miss_interval = 30
+
+    def __init__(self, *args, **kwargs):
+        self._device_index = None
+        self._device_index_time = 0
+        self._device_index_lock = None
+        super(AsyncUnifiClient, self).__init__(*args, **kwargs)
+
+    async def login(self, username=None, password=None):
+        self.debug('------LOGIN------')
+
+        # if logging in with same user/passwd, check for login cookie
+        if (username is None or self.username == username) and \
+           (password is None or self.password == password) and \
+           self.logged_in:
+            self.debug('logged in -> cookie exists')
+            self.debug('------END LOGIN------')
+            return True
+
+        # user/passwd from params overwites known user/passwd
+        self.username = username or self.username
+        self.password = password or self.password
+        if self.username is None or self.password is None:
+            # if instance doesn't have username or password, cannot login
+            raise UnifiLoginError('Missing login information')
+
+        # drop the old cookie but keep the connection pool
+        self.clear_cookies()
+
+        r = await self.request(
+            'POST',
+            self.endpoint('/api/login'),
+            headers={'Referer': self.endpoint('/login')},
+            json={
+                'username': self.username,
+                'password': self.password,
+            },
+            timeout=4
+        )
+        self.metrics.observe_login(self.logged_in)
+        self.login_generation += 1
+
+        # debug messages
+        self.debug('LOGIN RESPONSE')
+        self.debug('status: %s', r.status)
+        self.debug('headers: %s', r.headers)
+        self.debug('------END LOGIN------')
+
+        return self.logged_in
+
+    async def logout(self):
+        if not self.logged_in:
+            return False
+        await self.post(self.endpoint('/logout'))
+        self.clear_cookies()
+        return True
+
+    def datetemp(self, a):
+        '''
+            Convert datetime to timestamp
+        '''
+        return timestamp_ms(a)
+
+    async def _stamgr(self, site, data):
+        r = await self.post(self.endpoint('/api/s/%s/cmd/stamgr' % site), json=data, timeout=6)
+        return await self.process_response(r, boolean=True)
+
+    @async_requires_login
+    @guard(models.authorize_guest_params)
+    async def authorize_guest(self, client_mac, minutes, site=None, ap_mac=None, up_speed=None, down_speed=None, MB_limit=None):
+        '''
+            Authorize a client device, see `UnifiClient.authorize_guest`
+        '''
+        data = {
+            'cmd': 'authorize-guest',
+            'mac': client_mac.lower(),
+            'minutes': minutes,
+        }
+        if up_speed is not None:
+            data['up'] = up_speed
+        if down_speed is not None:
+            data['down'] = down_speed
+        if ap_mac is not None:
+            site = await self.find_device(ap_mac) if site is None else site
+            assert site is not None, 'No site provided and AP does not belong to any known site'
+            data['ap_mac'] = ap_mac
+        if MB_limit is not None:
+            data['MB_limit'] = MB_limit
+        self.debug('Posting authorize guest: %s', data)
+        return await self._stamgr(site, data)
+
+    @async_requires_login
+    @guard(cmd=t.String, client_mac=models.MacAddress, site=models.SiteName)
+    async def _guest_cmd(self, cmd, client_mac, site):
+        '''
+            Run most stamgr command, see `UnifiClient._guest_cmd`
+        '''
+        return await self._stamgr(site, {'cmd': cmd, 'mac': client_mac})
+
+    async def unauthorize_guest(self, client_mac, site='default'):
+        '''
+            Unauthorize a client device, see `UnifiClient.unauthorize_guest`
+        '''
+        return await self._guest_cmd('unauthorize-guest', client_mac, site)
+
+    async def reconnect_sta(self, client_mac, site='default'):
+        '''
+            Reconnect a client device, see `UnifiClient.reconnect_sta`
+        '''
+        return await self._guest_cmd('kick-sta', client_mac, site)
+
+    async def block_sta(self, client_mac, site='default'):
+        '''
+            Block a client device, see `UnifiClient.block_sta`
+        '''
+        return await self._guest_cmd('block-sta', client_mac, site)
+
+    async def unblock_sta(self, client_mac, site='default'):
+        '''
+            Unblock a client device, see `UnifiClient.unblock_sta`
+        '''
+        return await self._guest_cmd('unblock-sta', client_mac, site)
+
+    @async_requires_login
+    @guard(client_macs=t.List(models.MacAddress), site=models.SiteName)
+    async def forget_sta(self, client_macs, site='default'):
+        '''
+            Forget client devices, see `UnifiClient.forget_sta`
+        '''
+        return await self._stamgr(site, {'cmd': 'forget-sta', 'mac': client_macs})
+
+    @async_requires_login
+    async def list_sites(self):
+        '''
+            List sites managed by controller, see `UnifiClient.list_sites`
+        '''
+        r = await self.get(self.endpoint('/api/self/sites'))
+        return await self.process_response(r)
+
+    @async_requires_login
+    @guard(site=models.SiteName, device_mac=t.Or(models.MacAddress, t.Atom(None)))
+    async def list_devices(self, site='default', device_mac=None):
+        '''
+            List devices managed by controller on a given site, see `UnifiClient.list_devices`
+        '''
+        r = await self.get(self.endpoint('/api/s/%s/stat/device/%s' % (site, device_mac or '')))
+        return await self.process_response(r)
+
+    async def build_device_index(self):
+        '''
+            Build the device -> site index used by `find_device`, sites are listed concurrently
+        '''
+        sites = [s['name'] for s in await self.list_sites() or []]
+        index = {}
+        for site, devices in zip(sites, await gather(*[self.list_devices(site=s) for s in sites])):
+            for d in devices or []:
+                index[models.format_macaddr(d['mac'])] = site
+        self._device_index = index
+        self._device_index_time = time.monotonic()
+        return index
+
+    def invalidate_device_index(self):
+        '''
+            Drop the device -> site index, next `find_device` call will rebuild it
+        '''
+        self._device_index = None
+        self._device_index_time = 0
+
+    @guard(device_mac=models.MacAddress)
+    async def find_device(self, device_mac):
+        '''
+            Find site name of device by mac, see `UnifiClient.find_device`
+        '''
+        if self._device_index_lock is None:
+            self._device_index_lock = Lock()
+        async with self._device_index_lock:
+            age = time.monotonic() - self._device_index_time
+            index = self._device_index
+            if index is None or (self.device_index_ttl is not None and age > self.device_index_ttl):
+                index = await self.build_device_index()
+            elif device_mac not in index and age >= self.device_index_miss_interval:
+                index = await self.build_device_index()
+        site = index.get(device_mac)
+        return None if site is None else models.SiteName(site)
+
+    @async_requires_login
+    @guard(models.list_sessions_params)
+    async def list_sessions(self, client_mac=None, client_type='all', start=None, end=None, site='default'):
+        '''
+            Get all login sessions, see `UnifiClient.list_sessions`
+        '''
+        start, end = time_range(start, end, 7*24*60*60*1000)
+        data = {
+            'type': client_type,
+            'start': start,
+            'end': end,
+        }
+        if client_mac is not None:
+            data['mac'] = client_mac
+
+        r = await self.get(self.endpoint('/api/s/%s/stat/session' % site), json=data)
+        return await self.process_response(r)
+
+    @async_requires_login
+    @guard(client_mac=models.MacAddress, limit=t.Int, site=models.SiteName)
+    async def list_sessions_latest(self, client_mac, limit=5, site='default'):
+        '''
+            Get latest login sessions for a given client, see `UnifiClient.list_sessions_latest`
+        '''
+        data = {
+            'mac': client_mac,
+            '_limit': limit,
+            '_sort': '-assoc_time',
+        }
+        r = await self.get(self.endpoint('/api/s/%s/stat/session' % site), json=data)
+        return await self.process_response(r)
+
+    @async_requires_login
+    @guard(models._base_time_site_params)
+    async def list_authorizations(self, start=None, end=None, site='default'):
+        '''
+            Get latest authorizations for a given site, see `UnifiClient.list_authorizations`
+        '''
+        start, end = time_range(start, end, 7*24*60*60*1000)
+        r = await self.get(self.endpoint('/api/s/%s/stat/authorization' % site), json={'start': start, 'end': end})
+        return await self.process_response(r)
+
+    @async_requires_login
+    @guard(last_hours=t.Int, site=models.SiteName)
+    async def list_allusers(self, last_hours=365*24, site='default'):
+        '''
+            Get all users ever connected to a given site, see `UnifiClient.list_allusers`
+        '''
+        data = {
+            'type': 'all',
+            'conn': 'all',
+            'within': last_hours,
+        }
+        r = await self.get(self.endpoint('/api/s/%s/stat/allusers' % site), json=data)
+        return await self.process_response(r)
+
+    @async_requires_login
+    @guard(last_hours=t.Int, site=models.SiteName)
+    async def list_guests(self, last_hours=365*24, site='default'):
+        '''
+            Get all guests ever connected to a given site, see `UnifiClient.list_guests`
+        '''
+        r = await self.get(self.endpoint('/api/s/%s/stat/guest' % site), json={'within': last_hours})
+        return await self.process_response(r)
+
+    @async_requires_login
+    @guard(client_mac=t.Or(models.MacAddress, t.Atom(None)), site=models.SiteName)
+    async def list_online_clients(self, client_mac=None, site='default'):
+        '''
+            Get online client devices on a given site, see `UnifiClient.list_online_clients`
+        '''
+        r = await self.get(self.endpoint('/api/s/%s/stat/sta/%s' % (site, client_mac or '')))
+        return await self.process_response(r)
+
+    @async_requires_login
+    @guard(client_mac=models.MacAddress, site=models.SiteName)
+    async def client_info(self, client_mac, site='default'):
+        '''
+            Get client device information, see `UnifiClient.client_info`
+        '''
+        r = await self.get(self.endpoint('/api/s/%s/stat/user/%s' % (site, client_mac)))
+        return await self.process_response(r)
+
+    # Site stats
+
+    @async_requires_login
+    @guard(models.site_stats_params.merge(models._inner_stats_extras))
+    async def _site_stats(self, gran, def_range, start=None, end=None, site='default'):
+        start, end = time_range(start, end, def_range)
+        data = {
+            'attrs': ['bytes', 'wan-tx_bytes', 'wan-rx_bytes', 'wlan_bytes', 'num_sta', 'lan-num_sta', 'wlan-num_sta', 'time'],
+            'start': start,
+            'end': end,
+        }
+        r = await self.get(self.endpoint('/api/s/%s/stat/report/%s.site' % (site, gran)), json=data)
+        return await self.process_response(r)
+
+    async def site_stat_5min(self, start=None, end=None, site='default'):
+        '''
+            Get site stats (5 min), see `UnifiClient.site_stat_5min`
+        '''
+        return await self._site_stats('5minutes', 12*60*60*1000, start, end, site)
+
+    async def site_stat_hourly(self, start=None, end=None, site='default'):
+        '''
+            Get site stats (hourly), see `UnifiClient.site_stat_hourly`
+        '''
+        return await self._site_stats('hourly', 7*24*60*60*1000, start, end, site)
+
+    async def site_stat_daily(self, start=None, end=None, site='default'):
+        '''
+            Get site stats (daily), see `UnifiClient.site_stat_daily`
+        '''
+        return await self._site_stats('daily', 30*24*60*60*1000, start, end, site)
+
+    # AP stats
+
+    @async_requires_login
+    @guard(models.ap_stats_params.merge(models._inner_stats_extras))
+    async def _ap_stats(self, gran, def_range, ap_mac=None, start=None, end=None, site=None):
+        start, end = time_range(start, end, def_range)
+        data = {
+            'attrs': ['bytes', 'num_sta', 'time'],
+            'start': start,
+            'end': end,
+        }
+
+        if ap_mac is not None:
+            site = await self.find_device(ap_mac) if site is None else site
+            assert site is not None, 'No site provided and AP does not belong to any known site'
+            data['mac'] = ap_mac
+        elif site is None:
+            site = 'default'
+
+        r = await self.get(self.endpoint('/api/s/%s/stat/report/%s.ap' % (site, gran)), json=data)
+        return await self.process_response(r)
+
+    async def ap_stat_5min(self, ap_mac=None, start=None, end=None, site=None):
+        '''
+            Get ap stats (5 min), see `UnifiClient.ap_stat_5min`
+        '''
+        return await self._ap_stats('5minutes', 12*60*60*1000, ap_mac, start, end, site)
+
+    async def ap_stat_hourly(self, ap_mac=None, start=None, end=None, site=None):
+        '''
+            Get ap stats (hourly), see `UnifiClient.ap_stat_hourly`
+        '''
+        return await self._ap_stats('hourly', 7*24*60*60*1000, ap_mac, start, end, site)
+
+    async def ap_stat_daily(self, ap_mac=None, start=None, end=None, site=None):
+        '''
+            Get ap stats (daily), see `UnifiClient.ap_stat_daily`
+        '''
+        return await self._ap_stats('daily', 7*24*60*60*1000, ap_mac, start, end, site)
+
+    # User stats
+
+    @async_requires_login
+    @guard(models.user_stats_params.merge(models._inner_stats_extras))
+    async def _user_stats(self, gran, def_range, user_mac, attrs=['rx_bytes', 'tx_bytes'], start=None, end=None, site=None):
+        start, end = time_range(start, end, def_range)
+        data = {
+            'mac': user_mac,
+            'attrs': attrs if 'time' in attrs else attrs + ['time'],
+            'start': start,
+            'end': end,
+        }
+        r = await self.get(self.endpoint('/api/s/%s/stat/report/%s.user' % (site, gran)), json=data)
+        return await self.process_response(r)
+
+    async def user_stat_5min(self, user_mac, attrs=['rx_bytes', 'tx_bytes'], start=None, end=None, site=None):
+        '''
+            Get user/client stats (5 min), see `UnifiClient.user_stat_5min`
+        '''
+        return await self._user_stats('5minutes', 12*60*60*1000, user_mac, attrs, start, end, site)
+
+    async def user_stat_hourly(self, user_mac, attrs=['rx_bytes', 'tx_bytes'], start=None, end=None, site=None):
+        '''
+            Get user/client stats (hourly), see `UnifiClient.user_stat_hourly`
+        '''
+        return await self._user_stats('hourly', 7*24*60*60*1000, user_mac, attrs, start, end, site)
+
+    async def user_stat_daily(self, user_mac, attrs=['rx_bytes', 'tx_bytes'], start=None, end=None, site=None):
+        '''
+            Get user/client stats (daily), see `UnifiClient.user_stat_daily`
+        '''
+        return await self._user_stats('daily', 7*24*60*60*1000, user_mac, attrs, start, end, site)
+
+    # gateway
+
+    @async_requires_login
+    @guard(models.gateway_stats_params.merge(models._inner_stats_extras))
+    async def _gateway_stats(self, gran, def_range, attrs=['mem', 'cpu', 'loadavg_5'], start=None, end=None, site='default'):
+        start, end = time_range(start, end, def_range)
+        data = {
+            'attrs': attrs if 'time' in attrs else attrs + ['time'],
+            'start': start,
+            'end': end,
+        }
+        r = await self.get(self.endpoint('/api/s/%s/stat/report/%s.gw' % (site, gran)), json=data)
+        return await self.process_response(r)
+
+    async def gateway_stat_5min(self, attrs=['mem', 'cpu', 'loadavg_5'], start=None, end=None, site='default'):
+        '''
+            Get gateway stats (5 min), see `UnifiClient.gateway_stat_5min`
+        '''
+        return await self._gateway_stats('5minutes', 12*60*60*1000, attrs, start, end, site)
+
+    async def gateway_stat_hourly(self, attrs=['mem', 'cpu', 'loadavg_5'], start=None, end=None, site='default'):
+        '''
+            Get gateway stats (hourly), see `UnifiClient.gateway_stat_hourly`
+        '''
+        return await self._gateway_stats('hourly', 7*24*60*60*1000, attrs, start, end, site)
+
+    async def gateway_stat_daily(self, attrs=['mem', 'cpu', 'loadavg_5'], start=None, end=None, site='default'):
+        '''
+            Get gateway stats (daily), see `UnifiClient.gateway_stat_daily`
+        '''
+        return await self._gateway_stats('daily', 365*24*60*60*1000, attrs, start, end, site)
+
+    @async_requires_login
+    @guard(models._base_time_site_params)
+    async def speedtest_result(self, start=None, end=None, site='default'):
+        '''
+            Get speed test results, see `UnifiClient.speedtest_result`
+        '''
+        start, end = time_range(start, end, 24*60*60*1000)
+        data = {
+            'attrs': ['xput_download', 'xput_upload', 'latency', 'time'],
+            'start': start,
+            'end': end,
+        }
+        r = await self.get(self.endpoint('/api/s/%s/stat/report/archive.speedtest' % site), json=data)
+        return await self.process_response(r)
+
+    @async_requires_login
+    async def stat_deviceBasic(self, site):
+        '''
+            Get all AP mac's from this site, see `UnifiClient.stat_deviceBasic`
+        '''
+        r = await self.get(self.endpoint('/api/s/{}/stat/device-basic'.format(site)))
+        return await self.process_response(r)
+
+    @async_requires_login
+    async def stat_device(self, site, macs=None):
+        '''
+            List devices with their clients and stats, see `UnifiClient.stat_device`
+        '''
+        r = await self.post(self.endpoint('/api/s/{}/stat/device'.format(site)), json={"macs": macs}, timeout=4)
+        return await self.process_response(r)
+
+    @async_requires_login
+    async def stat_reportSite(self, site, date_range, interval='daily', attrs=None):
+        '''
+            Get total user and traffic per interval, see `UnifiClient.stat_reportSite`
+        '''
+        assert date_range, "date_range is required"
+        data = {
+            "start": self.datetemp(date_range[0]),
+            "end": self.datetemp(date_range[1]),
+            "attrs": ["wlan_bytes", "wlan-num_sta", "time"] if attrs is None else attrs,
+        }
+        r = await self.post(self.endpoint('/api/s/{}/stat/report/{}.site'.format(site, interval)), json=data)
+        return await self.process_response(r)
+
+    @async_requires_login
+    async def stat_reportAp(self, site, date_range, macs=None, interval='daily', attrs=None):
+        '''
+            Get AP stats per interval, see `UnifiClient.stat_reportAp`
+        '''
+        data = {
+            "start": self.datetemp(date_range[0]),
+            "end": self.datetemp(date_range[1]),
+            "attrs": ["bytes", "num_sta", "time"] if attrs is None else attrs,
+        }
+        r = await self.post(self.endpoint('/api/s/{}/stat/report/{}.ap'.format(site, interval)), json=data, timeout=4)
+        return await self.process_response(r)
+
+    @async_requires_login
+    async def stat_widgetHealth(self, site):
+        '''
+            List AP's and Switchs by state, see `UnifiClient.stat_widgetHealth`
+        '''
+        r = await self.post(self.endpoint('/api/s/{}/stat/widget/health'.format(site)))
+        return await self.process_response(r)
+
+    @async_requires_login
+    async def stat_clients(self, site):
+        '''
+            List all users connected, pending and others stats, see `UnifiClient.stat_clients`
+        '''
+        r = await self.get(self.endpoint('/api/s/{}/stat/sta'.format(site)))
+        return await self.process_response(r)
@@ -0,0 +1,146 @@
+from asyncio import Lock
+from urllib.parse import urljoin
+import logging
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    raise ImportError('The asyncio client requires aiohttp (pip install unifi-python-api[async])')
+
+from .utils import models
+from .utils.decorators import async_call_requires_login, async_requires_login, guard
+from .utils.metrics import Metrics
+
+log = logging.getLogger('unifi_api')
+
+
+class AsyncUnifiSession:
+    '''
+        asyncio counterpart of AbstractUnifiSession
+        all requests share a single aiohttp connection pool of `connection_limit` connections
+    '''
+    @guard(models.async_init_params)
+    def __init__(self, base_url, ssl_verify=False, debug=False, username=None, password=None, connection_limit=100, metrics=None,
+                 strict_responses=False):
+        # set init params
+        self.base_url = base_url
+        self.ssl_verify = ssl_verify
+        self._debug = debug
+        # validate whole responses with `models.JsonResponse` instead of only their envelope
+        self.strict_responses = strict_responses
+        self.username = username
+        self.password = password
+        self.connection_limit = connection_limit
+        # request metrics per endpoint template, see `utils.metrics.Metrics`
+        self.metrics = Metrics() if metrics is None else metrics
+
+        # aiohttp sessions must be created inside a running loop, see `session`
+        self._session = None
+        self._login_lock = None
+        # bumped on every login, lets concurrent callers know the cookie was refreshed
+        self.login_generation = 0
+
+    @async_requires_login
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close_session()
+
+    @property
+    def debug_enabled(self):
+        return self._debug or log.isEnabledFor(logging.DEBUG)
+
+    def debug(self, msg, *args):
+        '''
+            Debug message, formatted lazily, see `AbstractUnifiSession.debug`
+        '''
+        if self._debug:
+            print(msg % args if args else msg)
+        log.debug(msg, *args)
+
+    def endpoint(self, path):
+        return urljoin(self.base_url, path)
+
+    def clear_cookies(self):
+        if self._session is not None:
+            self._session.cookie_jar.clear()
+
+    async def close_session(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connection_limit, ssl=self.ssl_verify),
+                # unsafe allows cookies from controllers addressed by ip
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+            )
+        return self._session
+
+    @property
+    def login_lock(self):
+        if self._login_lock is None:
+            self._login_lock = Lock()
+        return self._login_lock
+
+    @property
+    def logged_in(self):
+        return self._session is not None and any(c.key == 'unifises' for c in self._session.cookie_jar)
+
+    async def request(self, method, url, timeout=None, **kwargs):
+        '''
+            Make a request and read the whole body, the connection is released before returning
+        '''
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        started = time.perf_counter()
+        async with self.session.request(method, url, **kwargs) as r:
+            body = await r.read()
+        self.metrics.observe_request(method, url, r.status, time.perf_counter() - started, len(body))
+        return r
+
+    @async_call_requires_login
+    async def get(self, *args, **kwargs):
+        return await self.request('GET', *args, **kwargs)
+
+    @async_call_requires_login
+    async def post(self, *args, **kwargs):
+        return await self.request('POST', *args, **kwargs)
+
+    @async_call_requires_login
+    async def put(self, *args, **kwargs):
+        return await self.request('PUT', *args, **kwargs)
+
+    @async_call_requires_login
+    async def delete(self, *args, **kwargs):
+        return await self.request('DELETE', *args, **kwargs)
+
+    async def process_response(self, response, boolean=False):
+        if 'application/json' not in response.headers.get('Content-Type', ''):
+            # raise or return?
+            if self.debug_enabled:
+                self.debug('status: %s', response.status)
+                self.debug('headers: %s', response.headers)
+                self.debug('text: %s', await response.text())
+            raise ValueError('Content type should be json')
+
+        started = time.perf_counter()
+        data = await response.json()
+        decoded = time.perf_counter()
+        data = models.JsonResponse(data) if self.strict_responses else models.check_response(data)
+        self.metrics.observe_decode(response.method, str(response.url), decoded - started, time.perf_counter() - decoded)
+        if data['meta']['rc'] == 'ok':
+            return True if boolean else data['data']
+        self.debug(data['meta']['msg'])
+        return False
+
+    async def login(self, username=None, password=None):
+        raise NotImplementedError('login')
+
+    async def logout(self):
+        raise NotImplementedError('logout')
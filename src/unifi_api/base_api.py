@@ -1,20 +1,97 @@
+from contextlib import contextmanager, nullcontext
+from threading import RLock, local
 from urllib.parse import urljoin
+import logging
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .utils import models
+from .utils.stream import iter_members
 from .utils.decorators import call_requires_login, requires_login, guard
+from .utils.metrics import Metrics, endpoint_template
+from .utils import tracing
+from .utils.refresh import SessionRefresher
+from .utils.coalesce import SingleFlight
+
+log = logging.getLogger('unifi_api')
 
 
 class AbstractUnifiSession:
     @guard(models.init_params)
-    def __init__(self, base_url, ssl_verify=False, debug=False, username=None, password=None):
+    def __init__(self, base_url, ssl_verify=False, debug=False, username=None, password=None, cache=None, report_cache=None,
+                 pool_connections=10, pool_maxsize=10, pool_block=False, keep_alive=True, retries=0, backoff_factor=0, metrics=None, tracer=None,
+                 cookie_store=None, limiter=None, coalesce=False, strict_responses=False):
+        '''
+            Controller session
+            -------------------------
+            params:
+                Name             | required  | description
+                -----------------------------------------
+                base_url         |   True    | controller url, e.g. https://example.com:8443
+                ssl_verify       |   False   | verify the controller certificate, defaults to False
+                debug            |   False   | print debug messages (they're also logged to the `unifi_api` logger), defaults to False
+                username         |   False   | login username
+                password         |   False   | login password
+                cache            |   False   | utils.cache.ResponseCache for read calls, defaults to None (no cache)
+                report_cache     |   False   | utils.report_cache.ReportCache for stats reports, defaults to None (no cache)
+                pool_connections |   False   | number of hosts with pooled connections, defaults to 10
+                pool_maxsize     |   False   | max pooled connections per host, defaults to 10
+                pool_block       |   False   | wait for a free connection instead of opening an unpooled one, defaults to False
+                keep_alive       |   False   | reuse connections between requests, defaults to True
+                retries          |   False   | transport level retries (connection errors, 502/503/504), defaults to 0
+                backoff_factor   |   False   | backoff between retries (factor * 2^retry seconds), defaults to 0
+                metrics          |   False   | utils.metrics.Metrics to record requests in, defaults to a new one
+                tracer           |   False   | utils.tracing.Tracer receiving the spans of each call, defaults to None
+                cookie_store     |   False   | utils.cookie_store.CookieStore to share the login with other sessions, defaults to None
+                limiter          |   False   | utils.limiter.RateLimiter of the requests to the controller, defaults to None (no limits)
+                coalesce         |   False   | identical reads made while one is in flight share its response, defaults to False
+                strict_responses |   False   | validate whole responses (models.JsonResponse) instead of their envelope, defaults to False
+        '''
         # set init params
         self.base_url = base_url
         self.ssl_verify = ssl_verify
         self._debug = debug
+        # validate whole responses with `models.JsonResponse` instead of only their envelope
+        self.strict_responses = strict_responses
         self.username = username
         self.password = password
+        # optional utils.cache.ResponseCache for read calls
+        self.cache = cache
+        # optional utils.report_cache.ReportCache of closed stats buckets
+        self.report_cache = report_cache
+        # transport options, used by `clean_session`
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        # request metrics per endpoint template, see `utils.metrics.Metrics`
+        self.metrics = Metrics() if metrics is None else metrics
+        # optional utils.tracing.Tracer, can be set at any time
+        self.tracer = tracer
+        # optional utils.cookie_store.CookieStore, logins are reused across processes through it
+        self.cookie_store = cookie_store
+        # optional utils.limiter.RateLimiter, rate limits and adaptive concurrency of the requests
+        self.limiter = limiter
+        # utils.coalesce.SingleFlight of the reads, None if disabled
+        self.coalescer = SingleFlight() if coalesce else None
+
+        # login is single-flight: callers that saw an expired cookie wait on the lock
+        # and skip their own login if `login_generation` moved meanwhile
+        self.login_lock = RLock()
+        self.login_generation = 0
+        # time.monotonic() of the last login and response, used by the background refresh
+        self.login_time = None
+        self.last_request = None
+        # utils.refresh.SessionRefresher, see `start_refresh`
+        self.refresher = None
+
+        # per thread state (streaming mode)
+        self._local = local()
 
         # init session
         self.clean_session()
@@ -26,10 +103,30 @@ class AbstractUnifiSession:
     def __exit__(self, exc_type, exc, tb):
         return
 
-    def debug(self, *args, **kwargs):
-        # TODO: change for logging
+    @property
+    def debug_enabled(self):
+        return self._debug or log.isEnabledFor(logging.DEBUG)
+
+    def debug(self, msg, *args):
+        '''
+            Debug message, formatted lazily (`self.debug('data: %s', data)`) only if `debug` is on
+            or the `unifi_api` logger is enabled for DEBUG
+        '''
         if self._debug:
-            print(*args, **kwargs)
+            print(msg % args if args else msg)
+        log.debug(msg, *args)
+
+    def span(self, name, **attributes):
+        '''
+            Tracing span around a block, nested in the current span (no-op without `tracer`)
+            -------------------------
+            wrap client calls in your own spans to group their phases:
+                with client.span('sync'):
+                    client.list_sessions()
+        '''
+        if self.tracer is None:
+            return nullcontext()
+        return tracing.span(self.tracer, name, **attributes)
 
     def endpoint(self, path):
         return urljoin(self.base_url, path)
@@ -37,13 +134,168 @@ class AbstractUnifiSession:
     def clear_cookies(self):
         self._session.cookies.clear()
 
+    def session_cookie(self):
+        '''
+            returns the `unifises` cookie of the session (http.cookiejar.Cookie), None if not logged in
+        '''
+        for cookie in self._session.cookies:
+            if cookie.name == 'unifises':
+                return cookie
+        return None
+
+    def restore_cookie(self, stale=None):
+        '''
+            Set the session cookie stored in `cookie_store`, returns True if one was set
+            -------------------------
+            `stale` is the value of a cookie the controller just refused, it isn't restored again
+
+            # the cookie isn't checked here, calls made with an expired one log in again
+        '''
+        if self.cookie_store is None:
+            return False
+        entry = self.cookie_store.load(self.cookie_store.key(self.base_url, self.username))
+        if entry is None or entry['value'] == stale:
+            return False
+        self.clear_cookies()
+        self._session.cookies.set('unifises', entry['value'], domain=entry.get('domain', ''), path=entry.get('path', '/'))
+        self.login_generation += 1
+        created = entry.get('created')
+        self.login_time = None if created is None else time.monotonic() - max(time.time() - created, 0)
+        self.debug('session cookie restored from the cookie store')
+        return True
+
+    def store_cookie(self):
+        '''
+            Save the session cookie in `cookie_store`, called after each login
+        '''
+        cookie = self.session_cookie()
+        if self.cookie_store is None or cookie is None:
+            return
+        self.cookie_store.save(self.cookie_store.key(self.base_url, self.username), {
+            'value': cookie.value,
+            'domain': cookie.domain,
+            'path': cookie.path,
+            'expires': cookie.expires,
+            # wall clock time of the login, the age of restored cookies
+            'created': None if self.login_time is None else time.time() - (time.monotonic() - self.login_time),
+        })
+
+    def forget_cookie(self):
+        if self.cookie_store is not None:
+            self.cookie_store.delete(self.cookie_store.key(self.base_url, self.username))
+
+    def refresh_login(self):
+        '''
+            Log in again without dropping the current cookie, calls made meanwhile keep using it
+            -------------------------
+            the login is made by a new session on its own connection, its cookie then replaces this one
+        '''
+        fresh = type(self)(self.base_url, ssl_verify=self.ssl_verify, username=self.username, password=self.password,
+                           metrics=self.metrics, tracer=self.tracer)
+        try:
+            if not fresh.login():
+                return False
+            with self.login_lock:
+                self._session.cookies.set_cookie(fresh.session_cookie())
+                self.login_generation += 1
+                self.login_time = fresh.login_time
+            self.store_cookie()
+            return True
+        finally:
+            fresh.close_session()
+
+    @call_requires_login
+    def _validate(self, method, url):
+        return self.session.request(method, url, timeout=10)
+
+    def validate_session(self):
+        '''
+            Light authenticated call (/api/self), logs in again if the session expired
+        '''
+        r = self._validate('GET', self.endpoint('/api/self'))
+        if r.status_code == 200:
+            self.last_request = time.monotonic()
+            return True
+        return False
+
+    def start_refresh(self, max_age=None, max_idle=300, interval=5, max_backoff=300):
+        '''
+            Keep the session logged in from a background thread, see utils.refresh.SessionRefresher
+            -------------------------
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                max_age     |   False   | seconds after a login to log in again, defaults to None (only when expired)
+                max_idle    |   False   | seconds without calls after which the session is validated, defaults to 300
+                interval    |   False   | seconds between checks, defaults to 5
+                max_backoff |   False   | max seconds between refreshes after failures, defaults to 300
+
+            # set max_age below the controller session lifetime so calls never meet an expired cookie
+            # stopped by `logout` and `close_session`
+        '''
+        self.stop_refresh()
+        self.refresher = SessionRefresher(
+            self, max_age=max_age, max_idle=max_idle, interval=interval, max_backoff=max_backoff,
+        ).start()
+        return self.refresher
+
+    def stop_refresh(self):
+        if self.refresher is not None:
+            self.refresher.stop()
+            self.refresher = None
+
     def clean_session(self):
         if hasattr(self, '_session'):
             self._session.close()
         self._session = requests.session()
         self._session.verify = self.ssl_verify
 
+        retries = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block,
+            max_retries=retries,
+        )
+        # connections report a `connect` span while traced
+        adapter.poolmanager.pool_classes_by_scheme = dict(tracing.TRACED_POOL_CLASSES)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        if not self.keep_alive:
+            self._session.headers['Connection'] = 'close'
+
+    def pool_stats(self):
+        '''
+            Connection pool usage
+            -------------------------
+            returns a dict of host -> {maxsize, connections (opened so far), requests, idle, in_use}
+        '''
+        stats = {}
+        adapters = {id(adapter): adapter for adapter in self._session.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None or pool.pool is None:
+                    continue
+                # the pool queue holds idle connections and None placeholders for unopened slots
+                queued = list(pool.pool.queue)
+                stats['%s://%s:%s' % (pool.scheme, pool.host, pool.port)] = {
+                    'maxsize': pool.pool.maxsize,
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests,
+                    'idle': sum(1 for conn in queued if conn is not None),
+                    'in_use': max(pool.pool.maxsize - len(queued), 0),
+                }
+        return stats
+
     def close_session(self):
+        self.stop_refresh()
         self._session.close()
 
     @property
@@ -55,30 +307,168 @@ class AbstractUnifiSession:
         return 'unifises' in self.session.cookies
 
     @call_requires_login
+    def _send(self, method, url, **kwargs):
+        if self.limiter is None:
+            return self._transmit(method, url, **kwargs)
+        with self.limiter.slot(url) as slot:
+            r = self._transmit(method, url, **kwargs)
+            slot['status'] = r.status_code
+            return r
+
+    def _transmit(self, method, url, **kwargs):
+        stream = kwargs.get('stream', False)
+        if self.tracer is not None and not stream:
+            # read the body separately to trace it
+            kwargs['stream'] = True
+        started = time.perf_counter()
+        with self.span('wait', method=method, url=url) as span:
+            r = self.session.request(method, url, **kwargs)
+            if span is not None:
+                span.attributes['status'] = r.status_code
+        if stream:
+            size = int(r.headers.get('Content-Length') or 0)
+        else:
+            with self.span('read'):
+                size = len(r.content)
+        self.metrics.observe_request(method, url, r.status_code, time.perf_counter() - started, size)
+        self.last_request = time.monotonic()
+        return r
+
+    def request(self, method, url, **kwargs):
+        '''
+            Make a request, reads are answered from `cache` when enabled, and shared with the
+            identical reads in flight when `coalesce` is on
+        '''
+        if self.tracer is None:
+            return self._request(method, url, **kwargs)
+        with self.span('request', method=method, endpoint=endpoint_template(url), url=url):
+            return self._request(method, url, **kwargs)
+
+    def _request(self, method, url, **kwargs):
+        if self.streaming_enabled:
+            kwargs.setdefault('stream', True)
+        cache = self.cache
+        if cache is None:
+            return self._fetch(method, url, **kwargs)
+        if cache.is_write(method, url):
+            r = self._send(method, url, **kwargs)
+            cache.invalidate(url)
+            return r
+        ttl = cache.ttl(url)
+        if ttl is None or kwargs.get('stream'):
+            return self._fetch(method, url, **kwargs)
+        key = cache.key(method, url, kwargs.get('json'))
+        r = cache.get(key)
+        if r is None:
+            r = self._fetch(method, url, **kwargs)
+            # a transient controller error (HTTP 200, rc error) isn't served again
+            if r.status_code == 200 and cache.succeeded(r):
+                cache.put(key, r, ttl)
+        return r
+
+    def _fetch(self, method, url, **kwargs):
+        # identical reads in flight share one response (streamed ones can't be shared)
+        coalescer = self.coalescer
+        if coalescer is None or kwargs.get('stream') or set(kwargs) - {'json', 'timeout'} \
+                or not coalescer.can_coalesce(method, url):
+            return self._send(method, url, **kwargs)
+        r, shared = coalescer.do(coalescer.key(method, url, kwargs.get('json')), lambda: self._send(method, url, **kwargs))
+        if shared:
+            self.metrics.observe_coalesced(method, url)
+        return r
+
     def get(self, *args, **kwargs):
-        return self.session.get(*args, **kwargs)
+        return self.request('GET', *args, **kwargs)
 
-    @call_requires_login
     def post(self, *args, **kwargs):
-        return self.session.post(*args, **kwargs)
+        return self.request('POST', *args, **kwargs)
 
-    @call_requires_login
     def put(self, *args, **kwargs):
-        return self.session.put(*args, **kwargs)
+        return self.request('PUT', *args, **kwargs)
 
-    @call_requires_login
     def delete(self, *args, **kwargs):
-        return self.session.delete(*args, **kwargs)
+        return self.request('DELETE', *args, **kwargs)
 
-    def process_response(self, response, boolean=False):
+    @contextmanager
+    def streaming(self):
+        '''
+            Streaming mode for the current thread
+            -------------------------
+            inside the block, calls returning a list return an iterator instead, reading
+            the records from the response body as they arrive (memory stays flat)
+
+            # only `meta` is validated, records are yielded as parsed
+            # the iterator holds the connection until it's exhausted or closed
+        '''
+        previous = self.streaming_enabled
+        self._local.stream = True
+        try:
+            yield self
+        finally:
+            self._local.stream = previous
+
+    @property
+    def streaming_enabled(self):
+        return getattr(self._local, 'stream', False)
+
+    def check_content_type(self, response):
         if 'Content-Type' not in response.headers or 'application/json' not in response.headers['Content-Type']:
             # raise or return?
-            self.debug(response.status_code)
-            self.debug(response.headers)
-            self.debug(response.text)
+            if self.debug_enabled:
+                self.debug('status: %s', response.status_code)
+                self.debug('headers: %s', response.headers)
+                self.debug('text: %s', response.text)
             raise ValueError('Content type should be json')
 
-        data = models.JsonResponse(response.json())
+    def stream_response(self, response, chunk_size=64*1024):
+        '''
+            Streaming counterpart of `process_response`
+            -------------------------
+            returns an iterator over the records of `data`, or False if `meta` reports an error
+
+            # controllers send `meta` before `data`, if it comes after, errors raise ValueError at the end
+        '''
+        self.check_content_type(response)
+        members = iter_members(response.iter_content(chunk_size))
+        first = None
+        for key, value, item in members:
+            if key == 'meta':
+                meta = models.JsonMeta(value)
+                if meta['rc'] != 'ok':
+                    self.debug(meta.get('msg'))
+                    response.close()
+                    return False
+            elif key == 'data':
+                first = (value,)
+                break
+
+        def records():
+            try:
+                if first is not None:
+                    # first record, or the whole `data` if it isn't a list
+                    yield first[0]
+                for key, value, item in members:
+                    if key == 'data':
+                        yield value
+                    elif key == 'meta' and models.JsonMeta(value)['rc'] != 'ok':
+                        raise ValueError(value.get('msg', 'Controller returned an error'))
+            finally:
+                response.close()
+        return records()
+
+    def process_response(self, response, boolean=False):
+        if not boolean and self.streaming_enabled:
+            return self.stream_response(response)
+        self.check_content_type(response)
+
+        started = time.perf_counter()
+        with self.span('decode'):
+            data = response.json()
+        decoded = time.perf_counter()
+        with self.span('validate', strict=self.strict_responses):
+            data = models.JsonResponse(data) if self.strict_responses else models.check_response(data)
+        if response.request is not None:
+            self.metrics.observe_decode(response.request.method, response.request.url, decoded - started, time.perf_counter() - decoded)
         if data['meta']['rc'] == 'ok':
             return True if boolean else data['data']
         self.debug(data['meta']['msg'])
@@ -0,0 +1,540 @@
+'''
+    Local stand-in UniFi controller, for tests and offline load generation
+
+    $ python -m unifi_api.fake_controller --port 8443 --sites 10 --clients 5000 --latency 0.02
+
+    serves synthetic sites, devices, clients, sessions, authorizations, stats reports and speed tests over
+    plain http, with cookie expiry (`api.err.LoginRequired` 401s) and injected latency, jitter
+    and failures:
+
+    with FakeController(sites=3, clients=1000) as controller:
+        client = UnifiClient(controller.url, username='admin', password='admin')
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import urlsplit
+import argparse
+import json
+import random
+import re
+import secrets
+import time
+import zlib
+
+from .utils.report_cache import GRANULARITY
+
+_REPORT_PATH = re.compile(r'^/api/s/([^/]+)/stat/report/(5minutes|hourly|daily)\.(site|ap|user|gw)$')
+_SPEEDTEST_PATH = re.compile(r'^/api/s/([^/]+)/stat/report/archive\.speedtest$')
+_SITE_PATH = re.compile(r'^/api/s/([^/]+)/(stat|cmd)/([^/]+)(?:/([^/]+))?$')
+
+STAMGR_COMMANDS = ('authorize-guest', 'unauthorize-guest', 'kick-sta', 'block-sta', 'unblock-sta', 'forget-sta')
+
+
+def _mac(mac):
+    # macs are generated lowercase, the client sends them normalized uppercase
+    return mac.lower().replace('-', ':')
+
+
+class FakeData:
+    '''
+        Synthetic controller data, generated per site on first use
+        -------------------------
+        params:
+            Name        | required  | description
+            -----------------------------------------
+            sites       |   False   | number of sites, the first one is `default`, defaults to 1
+            devices     |   False   | access points per site, defaults to 10
+            clients     |   False   | known clients per site (3/4 of them online), defaults to 100
+            history     |   False   | seconds of sessions, authorizations and report buckets, defaults to 7 days
+            churn       |   False   | fraction of online clients that roam, leave or join between client polls
+            seed        |   False   | random seed, same seed -> same data
+    '''
+    def __init__(self, sites=1, devices=10, clients=100, history=7*24*60*60, churn=0, seed=0):
+        self.num_sites = sites
+        self.num_devices = devices
+        self.num_clients = clients
+        self.history = history
+        self.churn_rate = churn
+        self.seed = seed
+        self.now = int(time.time())
+        self.sites = [
+            {
+                '_id': '%024x' % (s + 1),
+                'name': 'default' if s == 0 else 'site%d' % s,
+                'desc': 'Default' if s == 0 else 'Site %d' % s,
+                'role': 'admin',
+            } for s in range(sites)
+        ]
+        self.site_index = {site['name']: s for s, site in enumerate(self.sites)}
+        self._lock = Lock()
+        self._cache = {}
+
+    def _site(self, name):
+        s = self.site_index[name]
+        with self._lock:
+            data = self._cache.get(s)
+            if data is None:
+                data = self._cache[s] = self._generate(s)
+        return data
+
+    def _generate(self, s):
+        rnd = random.Random('%s/%d' % (self.seed, s))
+        site_id = self.sites[s]['_id']
+        devices = [
+            {
+                '_id': '%08x%016x' % (s + 1, i + 1),
+                'mac': 'f0:9f:%02x:%02x:%02x:%02x' % (s >> 8 & 255, s & 255, i >> 8 & 255, i & 255),
+                'site_id': site_id,
+                'name': 'ap-%d' % i,
+                'ip': '10.%d.0.%d' % (s % 256, i % 250 + 2),
+                'model': 'U7PG2',
+                'type': 'uap',
+                'version': '4.3.28.11361',
+                'serial': 'F09FC2%06X' % (s << 12 | i),
+                'state': 1,
+                'adopted': True,
+                'uptime': rnd.randint(3600, 90*86400),
+                'last_seen': self.now,
+                'num_sta': 0,
+                'rx_bytes': rnd.randint(0, 10**12),
+                'tx_bytes': rnd.randint(0, 10**12),
+            } for i in range(self.num_devices)
+        ]
+        clients = []
+        for i in range(self.num_clients):
+            ap = devices[rnd.randrange(len(devices))] if devices else None
+            clients.append({
+                '_id': '%08x%016x' % (s + 1, 0x100000000 + i),
+                'mac': '00:%02x:%02x:%02x:%02x:%02x' % (s >> 8 & 255, s & 255, i >> 16 & 255, i >> 8 & 255, i & 255),
+                'site_id': site_id,
+                'oui': rnd.choice(('Apple', 'Samsung', 'Intel', 'Google')),
+                'hostname': 'host-%d-%d' % (s, i),
+                'ip': '10.%d.%d.%d' % (s % 256, 1 + i // 250 % 254, i % 250 + 2),
+                'ap_mac': ap and ap['mac'],
+                'essid': 'guest' if i % 3 == 0 else 'corp',
+                'is_guest': i % 3 == 0,
+                'is_wired': False,
+                'first_seen': self.now - rnd.randint(0, 365*86400),
+                'last_seen': self.now,
+                'uptime': rnd.randint(0, 86400),
+                'rx_bytes': rnd.randint(0, 10**9),
+                'tx_bytes': rnd.randint(0, 10**9),
+                'signal': -rnd.randint(40, 85),
+                'channel': rnd.choice((1, 6, 11, 36, 44, 149)),
+                'radio_proto': rnd.choice(('ng', 'na', 'ac')),
+            })
+        online = set(i for i in range(len(clients)) if i % 4 != 3)
+
+        sessions = []
+        authorizations = []
+        step = max(1, self.history // max(1, 2*len(clients)))
+        for n, start in enumerate(range(self.now - self.history, self.now, step)):
+            c = clients[rnd.randrange(len(clients))] if clients else None
+            if c is None:
+                break
+            duration = rnd.randint(60, 4*3600)
+            sessions.append({
+                '_id': '%08x%016x' % (s + 1, 0x200000000 + n),
+                'mac': c['mac'],
+                'site_id': site_id,
+                'user_id': c['_id'],
+                'hostname': c['hostname'],
+                'ip': c['ip'],
+                'ap_mac': c['ap_mac'],
+                'is_guest': c['is_guest'],
+                'assoc_time': start,
+                'disassoc_time': start + duration,
+                'duration': duration,
+                'rx_bytes': rnd.randint(0, 10**8),
+                'tx_bytes': rnd.randint(0, 10**8),
+            })
+            if c['is_guest']:
+                authorizations.append({
+                    '_id': '%08x%016x' % (s + 1, 0x300000000 + n),
+                    'mac': c['mac'],
+                    'site_id': site_id,
+                    'start': start,
+                    'end': start + 24*3600,
+                    'authorized_by': 'api',
+                })
+        return {'devices': devices, 'clients': clients, 'online': online, 'rnd': rnd,
+                'sessions': sessions, 'authorizations': authorizations}
+
+    def has_site(self, name):
+        return name in self.site_index
+
+    def devices(self, site, macs=None):
+        devices = self._site(site)['devices']
+        if macs:
+            macs = set(map(_mac, macs))
+            devices = [d for d in devices if d['mac'] in macs]
+        return devices
+
+    def devices_basic(self, site):
+        return [{k: d[k] for k in ('mac', 'state', 'adopted', 'type', 'model', 'name')} for d in self._site(site)['devices']]
+
+    def clients(self, site, mac=None):
+        data = self._site(site)
+        if mac is not None:
+            return [c for c in data['clients'] if c['mac'] == _mac(mac)]
+        return data['clients']
+
+    def online_clients(self, site, mac=None):
+        data = self._site(site)
+        if self.churn_rate:
+            self.churn(site)
+        with self._lock:
+            online = [data['clients'][i] for i in sorted(data['online'])]
+        if mac is not None:
+            online = [c for c in online if c['mac'] == _mac(mac)]
+        return online
+
+    def churn(self, site):
+        '''
+            Make a fraction (`churn`) of the online clients roam, leave or join
+        '''
+        data = self._site(site)
+        rnd = data['rnd']
+        clients = data['clients']
+        with self._lock:
+            for _ in range(max(1, int(len(data['online']) * self.churn_rate))):
+                i = rnd.randrange(len(clients))
+                action = rnd.random()
+                if i not in data['online']:
+                    data['online'].add(i)
+                elif action < 0.5 and data['devices']:
+                    # copy, responses already sent keep their values
+                    clients[i] = dict(clients[i], ap_mac=rnd.choice(data['devices'])['mac'])
+                else:
+                    data['online'].discard(i)
+
+    def guests(self, site, within):
+        since = self.now - within*3600
+        return [c for c in self._site(site)['clients'] if c['is_guest'] and c['last_seen'] >= since]
+
+    def all_users(self, site, within):
+        since = self.now - within*3600
+        return [c for c in self._site(site)['clients'] if c['last_seen'] >= since]
+
+    def sessions(self, site, start, end, mac=None, limit=None):
+        sessions = self._site(site)['sessions']
+        if mac is not None:
+            sessions = [x for x in sessions if x['mac'] == _mac(mac)]
+        if start is not None:
+            sessions = [x for x in sessions if start <= x['assoc_time']*1000 <= end]
+        if limit is not None:
+            sessions = sorted(sessions, key=lambda x: -x['assoc_time'])[:limit]
+        return sessions
+
+    def authorizations(self, site, start, end):
+        return [x for x in self._site(site)['authorizations'] if start <= x['start']*1000 <= end]
+
+    def health(self, site):
+        data = self._site(site)
+        return [
+            {'subsystem': 'wlan', 'status': 'ok', 'num_ap': len(data['devices']), 'num_user': len(data['online'])},
+            {'subsystem': 'wan', 'status': 'ok'},
+            {'subsystem': 'lan', 'status': 'ok'},
+        ]
+
+    def report(self, site, gran, kind, start, end, attrs, macs=None):
+        '''
+            Report buckets between start and end (milliseconds), values only depend on their
+            (site, object, attr, time), so overlapping requests agree
+        '''
+        size = GRANULARITY[gran]
+        first = max(start, (self.now - self.history)*1000)
+        first = first + (-first) % size
+        last = min(end, int(time.time()*1000))
+        if kind == 'ap':
+            objects = [('ap', d['mac']) for d in self.devices(site, macs)]
+        elif kind == 'user':
+            objects = [('user', _mac(m)) for m in (macs or [])]
+        elif kind == 'gw':
+            objects = [('gw', 'f0:9f:c2:00:00:01')]
+        else:
+            objects = [(None, None)]
+        attrs = [a for a in (attrs or ['bytes']) if a != 'time']
+        seeds = {a: zlib.crc32(('%s/%s' % (site, a)).encode()) for a in attrs}
+        records = []
+        for key, oid in objects:
+            oid_seed = zlib.crc32((oid or '').encode())
+            for ts in range(first, last + 1, size):
+                record = {'time': ts, 'oid': oid or site}
+                if key is not None:
+                    record[key] = oid
+                for a in attrs:
+                    record[a] = (ts // size * 2654435761 ^ seeds[a] ^ oid_seed) % 100000
+                records.append(record)
+        return records
+
+    def speedtests(self, site, start, end):
+        '''
+            Hourly speed tests of the gateway between start and end (milliseconds)
+        '''
+        return [
+            {
+                'time': r['time'],
+                'xput_download': r['xput_download'] / 100,
+                'xput_upload': r['xput_upload'] / 1000,
+                'latency': r['latency'] % 100 + 1,
+            } for r in self.report(site, 'hourly', 'gw', start, end, ['xput_download', 'xput_upload', 'latency'])
+        ]
+
+
+class FakeController:
+    '''
+        Local http server answering like a UniFi controller
+        -------------------------
+        params:
+            Name            | required  | description
+            -----------------------------------------
+            data            |   False   | FakeData, if not given one is built from the FakeData params in **kwargs
+            host, port      |   False   | address to listen on, defaults to 127.0.0.1 and a free port
+            username        |   False   | login username, defaults to `admin`
+            password        |   False   | login password, defaults to `admin`
+            cookie_ttl      |   False   | seconds until a login cookie expires, defaults to None (never)
+            latency         |   False   | seconds added to every response, defaults to 0
+            jitter          |   False   | max random seconds added on top of latency, defaults to 0
+            failure_rate    |   False   | fraction of api calls answered with a 503, defaults to 0
+
+        # `stats` counts requests, logins, login_required (401) and failures (injected 503)
+    '''
+    def __init__(self, data=None, host='127.0.0.1', port=0, username='admin', password='admin',
+                 cookie_ttl=None, latency=0, jitter=0, failure_rate=0, **kwargs):
+        self.data = FakeData(**kwargs) if data is None else data
+        self.username = username
+        self.password = password
+        self.cookie_ttl = cookie_ttl
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(self.data.seed)
+        self.stats = {'requests': 0, 'logins': 0, 'login_required': 0, 'failures': 0}
+        self._tokens = {}
+        self._lock = Lock()
+        self._thread = None
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self._thread = Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def expire_cookies(self):
+        '''
+            Invalidate every login cookie, the next calls get `api.err.LoginRequired`
+        '''
+        with self._lock:
+            self._tokens.clear()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _new_token(self):
+        token = secrets.token_hex(16)
+        with self._lock:
+            self._tokens[token] = None if self.cookie_ttl is None else time.monotonic() + self.cookie_ttl
+        return token
+
+    def _valid_token(self, token):
+        with self._lock:
+            if token not in self._tokens:
+                return False
+            expires = self._tokens[token]
+            if expires is not None and expires < time.monotonic():
+                del self._tokens[token]
+                return False
+            return True
+
+    def _handler(self):
+        controller = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are separate writes, avoid delayed ack stalls on keep-alive connections
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                controller._handle(self)
+
+            do_POST = do_PUT = do_DELETE = do_GET
+
+        return Handler
+
+    def _reply(self, handler, status, data=None, rc='ok', msg=None, headers=None):
+        meta = {'rc': rc}
+        if msg is not None:
+            meta['msg'] = msg
+        body = json.dumps({'meta': meta, 'data': [] if data is None else data}).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json;charset=UTF-8')
+        handler.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _handle(self, handler):
+        self._count('requests')
+        length = int(handler.headers.get('Content-Length') or 0)
+        raw = handler.rfile.read(length) if length else b''
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            return self._reply(handler, 400, rc='error', msg='api.err.InvalidPayload')
+        path = urlsplit(handler.path).path.rstrip('/')
+
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        if path == '/api/login':
+            if body.get('username') != self.username or body.get('password') != self.password:
+                return self._reply(handler, 400, rc='error', msg='api.err.Invalid')
+            self._count('logins')
+            token = self._new_token()
+            return self._reply(handler, 200, headers={'Set-Cookie': 'unifises=%s; Path=/; HttpOnly' % token})
+
+        cookies = dict(
+            part.strip().split('=', 1) for part in handler.headers.get('Cookie', '').split(';') if '=' in part
+        )
+        if path == '/logout':
+            with self._lock:
+                self._tokens.pop(cookies.get('unifises'), None)
+            return self._reply(handler, 200)
+
+        if not self._valid_token(cookies.get('unifises')):
+            self._count('login_required')
+            return self._reply(handler, 401, rc='error', msg='api.err.LoginRequired')
+
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self._count('failures')
+            return self._reply(handler, 503, rc='error', msg='api.err.ServiceUnavailable')
+
+        try:
+            data = self._route(path, body)
+        except KeyError as e:
+            return self._reply(handler, 400, rc='error', msg=str(e.args[0]))
+        if data is None:
+            return self._reply(handler, 404, rc='error', msg='api.err.NotFound')
+        return self._reply(handler, 200, data)
+
+    def _route(self, path, body):
+        '''
+            returns the `data` of an api path, None if unknown, raises KeyError(msg) for api errors
+        '''
+        data = self.data
+        if path == '/api/self':
+            return [{'name': self.username, 'is_super': True}]
+        if path == '/api/self/sites':
+            return data.sites
+
+        match = _REPORT_PATH.match(path)
+        if match:
+            site, gran, kind = match.groups()
+            if not data.has_site(site):
+                raise KeyError('api.err.NoSiteContext')
+            macs = body.get('macs') or ([body['mac']] if body.get('mac') else None)
+            return data.report(site, gran, kind, body.get('start', 0), body.get('end', 0), body.get('attrs'), macs)
+
+        match = _SPEEDTEST_PATH.match(path)
+        if match:
+            site = match.group(1)
+            if not data.has_site(site):
+                raise KeyError('api.err.NoSiteContext')
+            return data.speedtests(site, body.get('start', 0), body.get('end', 0))
+
+        match = _SITE_PATH.match(path)
+        if not match:
+            return None
+        site, section, name, arg = match.groups()
+        if not data.has_site(site):
+            raise KeyError('api.err.NoSiteContext')
+
+        if section == 'cmd':
+            if name != 'stamgr':
+                return None
+            if body.get('cmd') not in STAMGR_COMMANDS:
+                raise KeyError('api.err.UnknownCommand')
+            return []
+
+        now = int(time.time()*1000)
+        if name == 'device':
+            return data.devices(site, [arg] if arg else body.get('macs'))
+        if name == 'device-basic':
+            return data.devices_basic(site)
+        if name == 'sta':
+            return data.online_clients(site, arg)
+        if name == 'user':
+            return data.clients(site, arg)
+        if name == 'allusers':
+            return data.all_users(site, body.get('within', 8760))
+        if name == 'guest':
+            return data.guests(site, body.get('within', 8760))
+        if name == 'session':
+            if 'start' in body:
+                return data.sessions(site, body['start'], body.get('end', now), body.get('mac'))
+            return data.sessions(site, None, None, body.get('mac'), body.get('_limit'))
+        if name == 'authorization':
+            return data.authorizations(site, body.get('start', 0), body.get('end', now))
+        if name == 'health' or (name == 'widget' and arg == 'health'):
+            return data.health(site)
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in UniFi controller')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--sites', type=int, default=1)
+    parser.add_argument('--devices', type=int, default=10, help='access points per site')
+    parser.add_argument('--clients', type=int, default=100, help='clients per site')
+    parser.add_argument('--history-days', type=float, default=7, help='days of sessions and report buckets')
+    parser.add_argument('--churn', type=float, default=0, help='fraction of clients changing between polls')
+    parser.add_argument('--cookie-ttl', type=float, default=None, help='seconds until login cookies expire')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0, help='max random seconds added to the latency')
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of calls answered with a 503')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    controller = FakeController(
+        host=args.host, port=args.port, username=args.username, password=args.password,
+        cookie_ttl=args.cookie_ttl, latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+        sites=args.sites, devices=args.devices, clients=args.clients, history=int(args.history_days*86400),
+        churn=args.churn, seed=args.seed,
+    )
+    print('fake controller on %s (%s/%s)' % (controller.url, args.username, args.password))
+    try:
+        controller.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        controller.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
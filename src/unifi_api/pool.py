@@ -0,0 +1,276 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import copy_context
+from threading import BoundedSemaphore, Lock
+import time
+
+from .utils.exceptions import UnifiControllerErrors, UnifiControllerUnavailable, UnifiRoutingError, UnifiSiteErrors
+
+
+class ControllerState:
+    '''
+        Concurrency limit and health of one controller of a UnifiClientPool
+        -------------------------
+        healthy         | False after `max_failures` consecutive failed calls
+        failures        | consecutive failed calls
+        last_error      | exception of the last failed call
+        unhealthy_since | time.monotonic() it was marked unhealthy, None if healthy
+        calls, errors   | totals
+    '''
+    def __init__(self, max_concurrency):
+        self.slots = BoundedSemaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.healthy = True
+        self.failures = 0
+        self.last_error = None
+        self.unhealthy_since = None
+        self.calls = 0
+        self.errors = 0
+
+    def as_dict(self):
+        return {
+            'healthy': self.healthy,
+            'failures': self.failures,
+            'last_error': None if self.last_error is None else repr(self.last_error),
+            'calls': self.calls,
+            'errors': self.errors,
+            'max_concurrency': self.max_concurrency,
+        }
+
+
+class UnifiClientPool:
+    '''
+        Sessions of several controllers, site scoped calls are routed to the controller of their site
+        -------------------------
+        params:
+            Name            | required  | description
+            -----------------------------------------
+            clients         |   True    | dict of name -> AbstractUnifiSession, or a list of sessions (named by base_url)
+            max_concurrency |   False   | max concurrent calls per controller (int, or dict of name -> int), defaults to 4
+            max_failures    |   False   | consecutive failed calls until a controller is marked unhealthy, defaults to 3
+            retry_after     |   False   | seconds an unhealthy controller is skipped before being tried again, defaults to 30
+            route_refresh   |   False   | min seconds between the rebuilds of the site table on unknown sites, defaults to 30
+
+        # the site -> controller table is built from `list_sites` of every controller on first use,
+        # `refresh_routes()` rebuilds it, an unknown site rebuilds it at most once per `route_refresh` seconds
+        # site names found on several controllers (e.g. `default`) need `controller=`
+        # failed calls are exceptions (connection errors, failed logins), calls returning False don't count
+    '''
+    def __init__(self, clients, max_concurrency=4, max_failures=3, retry_after=30, route_refresh=30):
+        if not isinstance(clients, dict):
+            clients = {client.base_url: client for client in clients}
+        assert clients, 'clients must not be empty'
+        assert max_failures > 0, 'max_failures must be positive'
+        self.clients = dict(clients)
+        self.max_failures = max_failures
+        self.retry_after = retry_after
+        limits = max_concurrency if isinstance(max_concurrency, dict) else dict.fromkeys(self.clients, max_concurrency)
+        self.states = {name: ControllerState(limits.get(name, 4)) for name in self.clients}
+        self.route_refresh = route_refresh
+        # site name -> [controller names], None until built, and time.monotonic() it was built
+        self.routes = None
+        self.routes_time = None
+        self._lock = Lock()
+
+    def __getitem__(self, name):
+        return self.clients[name]
+
+    def __getattr__(self, method):
+        # pool.list_devices(site='x') -> pool.call('list_devices', site='x')
+        if method.startswith('_'):
+            raise AttributeError(method)
+        def routed(*args, **kwargs):
+            return self.call(method, *args, **kwargs)
+        routed.__name__ = method
+        return routed
+
+    def health(self):
+        '''
+            returns a dict of controller name -> state (see ControllerState)
+        '''
+        with self._lock:
+            return {name: state.as_dict() for name, state in self.states.items()}
+
+    def available(self, name):
+        '''
+            returns True if calls to a controller are allowed (healthy, or unhealthy for `retry_after` seconds)
+        '''
+        state = self.states[name]
+        with self._lock:
+            return state.healthy or time.monotonic() - state.unhealthy_since >= self.retry_after
+
+    def run(self, name, method, *args, **kwargs):
+        '''
+            Run a call on one controller, within its concurrency limit
+            -------------------------
+            `method` is the name of a client method, or a callable receiving the client first
+        '''
+        if not self.available(name):
+            raise UnifiControllerUnavailable('%s is unhealthy: %r' % (name, self.states[name].last_error))
+        client = self.clients[name]
+        state = self.states[name]
+        fn = getattr(client, method) if isinstance(method, str) else (lambda *a, **kw: method(client, *a, **kw))
+        with state.slots:
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as ex:
+                self._failed(state, ex)
+                raise
+        self._succeeded(state)
+        return result
+
+    def _succeeded(self, state):
+        with self._lock:
+            state.calls += 1
+            state.failures = 0
+            state.healthy = True
+            state.unhealthy_since = None
+
+    def _failed(self, state, ex):
+        with self._lock:
+            state.calls += 1
+            state.errors += 1
+            state.failures += 1
+            state.last_error = ex
+            if state.failures >= self.max_failures:
+                # a failed retry of an unhealthy controller starts a new wait
+                state.healthy = False
+                state.unhealthy_since = time.monotonic()
+
+    def _parallel(self, tasks, errors):
+        # runs (key, name, method, args, kwargs) tasks, yields (key, result) as they complete
+        # more threads than the controllers' slots would only wait on them
+        slots = sum(self.states[name].max_concurrency for name in {task[1] for task in tasks})
+        executor = ThreadPoolExecutor(max_workers=max(min(len(tasks), slots), 1))
+        futures = {
+            executor.submit(copy_context().run, self.run, name, method, *args, **kwargs): key
+            for key, name, method, args, kwargs in tasks
+        }
+        try:
+            for f in as_completed(futures):
+                try:
+                    result = f.result()
+                except Exception as ex:
+                    errors[futures[f]] = ex
+                    continue
+                yield futures[f], result
+        finally:
+            for f in futures:
+                f.cancel()
+            executor.shutdown(wait=False)
+
+    def fan_out(self, method, *args, controllers=None, errors=None, **kwargs):
+        '''
+            Run a call on every controller in parallel
+            -------------------------
+            yields (controller name, result) pairs as the calls complete
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                method      |   True    | name of a client method, or a callable receiving the client first
+                controllers |   False   | controller names, defaults to all of them
+                errors      |   False   | dict to collect controller name -> exception of failed calls
+                *args       |   False   | params of every call
+                **kwargs    |   False   | params of every call
+
+            # unhealthy controllers fail with UnifiControllerUnavailable without being called
+            # if `errors` isn't given, UnifiControllerErrors is raised after every result has been yielded
+        '''
+        names = list(self.clients) if controllers is None else list(controllers)
+        failed = {} if errors is None else errors
+        yield from self._parallel([(name, name, method, args, kwargs) for name in names], failed)
+        if errors is None and failed:
+            raise UnifiControllerErrors(failed)
+
+    def refresh_routes(self):
+        '''
+            Rebuild the site -> controllers table from `list_sites` of every controller
+            -------------------------
+            returns the table, controllers that fail (or return False) keep their previous sites
+        '''
+        previous = self.routes or {}
+        errors = {}
+        sites = {}
+        for name, result in self.fan_out('list_sites', errors=errors):
+            if result is False:
+                errors[name] = UnifiRoutingError('list_sites of %s failed' % name)
+            else:
+                sites[name] = [s['name'] for s in result]
+        for name in errors:
+            sites[name] = [site for site, owners in previous.items() if name in owners]
+        routes = {}
+        for name in self.clients:
+            for site in sites.get(name, ()):
+                routes.setdefault(site, []).append(name)
+        self.routes = routes
+        self.routes_time = time.monotonic()
+        return routes
+
+    def route(self, site, controller=None):
+        '''
+            returns the name of the controller of a site
+        '''
+        if controller is not None:
+            if controller not in self.clients:
+                raise UnifiRoutingError('unknown controller %s' % controller)
+            return controller
+        routes = self.routes
+        if routes is None or (site not in routes and time.monotonic() - self.routes_time >= self.route_refresh):
+            routes = self.refresh_routes()
+        owners = routes.get(site)
+        if not owners:
+            raise UnifiRoutingError('unknown site %s' % site)
+        if len(owners) > 1:
+            raise UnifiRoutingError('site %s is on several controllers (%s), pass controller=' % (site, ', '.join(owners)))
+        return owners[0]
+
+    def call(self, method, *args, site=None, controller=None, **kwargs):
+        '''
+            Run a site scoped call on the controller of its site
+            -------------------------
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                method      |   True    | name of a client method, or a callable receiving the client first
+                site        |   True    | site name, passed to the call as keyword
+                controller  |   False   | controller name, for sites found on several controllers
+        '''
+        assert site is not None or controller is not None, 'site or controller is required'
+        name = self.route(site, controller)
+        if site is not None:
+            kwargs['site'] = site
+        return self.run(name, method, *args, **kwargs)
+
+    def for_each_site(self, method, sites=None, errors=None, **kwargs):
+        '''
+            Run a site scoped call on the sites of every controller in parallel
+            -------------------------
+            yields ((controller name, site), result) pairs as the calls complete
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                method      |   True    | name of a client method, or a callable receiving the client first
+                sites       |   False   | (controller name, site) pairs, defaults to every site of the routing table
+                errors      |   False   | dict to collect (controller name, site) -> exception of failed calls
+                **kwargs    |   False   | extra params for every call
+
+            # each controller runs up to its `max_concurrency` calls at once
+            # if `errors` isn't given, UnifiSiteErrors is raised after every result has been yielded
+        '''
+        if sites is None:
+            routes = self.routes if self.routes is not None else self.refresh_routes()
+            sites = [(name, site) for site, owners in sorted(routes.items()) for name in owners]
+        failed = {} if errors is None else errors
+        tasks = [((name, site), name, method, (), dict(kwargs, site=site)) for name, site in sites]
+        yield from self._parallel(tasks, failed)
+        if errors is None and failed:
+            raise UnifiSiteErrors(failed)
+
+    def close(self):
+        for client in self.clients.values():
+            client.close_session()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
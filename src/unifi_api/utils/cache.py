@@ -0,0 +1,136 @@
+# response cache for read calls made through AbstractUnifiSession
+from collections import OrderedDict
+from threading import Lock
+from urllib.parse import urlsplit
+import json
+import re
+import time
+
+# (path regexp, ttl in seconds), first match wins, unmatched paths (or a None ttl) aren't cached
+DEFAULT_TTLS = (
+    (r'^/api/self/sites$', 5*60),
+    # reports default to `end=now`, a new key every call: use a report_cache (utils.report_cache) instead
+    (r'/stat/report/', None),
+    (r'/stat/device-basic$', 60),
+    (r'/stat/device(/|$)', 15),
+    (r'/stat/widget/health$', 15),
+    (r'/stat/', 10),
+)
+
+# paths changing controller state, they invalidate the cached reads of their site
+WRITE_PATHS = re.compile(r'/(cmd|rest|upd)/')
+SITE_PATH = re.compile(r'^/api/s/([^/]+)/')
+# result code of the response envelope, the controller sends `meta` first
+META_RC = re.compile(rb'"meta"\s*:\s*\{[^{}]*?"rc"\s*:\s*"([^"]*)"')
+
+
+class ResponseCache:
+    '''
+        LRU cache of controller responses with per endpoint TTLs
+        -------------------------
+        params:
+            Name        | required  | description
+            -----------------------------------------
+            ttls        |   False   | sequence of (path regexp, seconds), defaults to `DEFAULT_TTLS`
+            max_bytes   |   False   | max size of cached bodies, least recently used are evicted, defaults to 32MB
+
+        # keys are (method, url, json body), only successful responses (HTTP 200 and meta.rc ok)
+        # of matched paths are stored
+        # a write (cmd/rest/upd paths, PUT, DELETE) drops every key of its site
+    '''
+    def __init__(self, ttls=DEFAULT_TTLS, max_bytes=32*1024*1024):
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def ttl(self, url):
+        '''
+            returns the ttl of an url, None if it shouldn't be cached
+        '''
+        path = urlsplit(url).path
+        for pattern, ttl in self.ttls:
+            if pattern.search(path):
+                return ttl
+        return None
+
+    @staticmethod
+    def key(method, url, body=None):
+        return (method.upper(), url, None if body is None else json.dumps(body, sort_keys=True))
+
+    @staticmethod
+    def succeeded(response):
+        '''
+            returns True if the envelope of a response has `meta.rc == 'ok'`
+        '''
+        m = META_RC.search(response.content, 0, 512)
+        if m is not None:
+            return m.group(1) == b'ok'
+        try:
+            data = response.json()
+        except ValueError:
+            return False
+        return isinstance(data, dict) and isinstance(data.get('meta'), dict) and data['meta'].get('rc') == 'ok'
+
+    @staticmethod
+    def is_write(method, url):
+        return method.upper() in ('PUT', 'DELETE') or WRITE_PATHS.search(urlsplit(url).path) is not None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, response, ttl):
+        size = len(response.content)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + ttl, size, response)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, url=None):
+        '''
+            Drop the keys of the site of `url`, or every key if the url isn't site scoped (or not given)
+        '''
+        m = None if url is None else SITE_PATH.match(urlsplit(url).path)
+        with self._lock:
+            if m is None:
+                self._entries.clear()
+                self.size = 0
+                return
+            prefix = '/api/s/%s/' % m.group(1)
+            for key in [k for k in self._entries if urlsplit(k[1]).path.startswith(prefix)]:
+                self._drop(key)
+
+    def stats(self):
+        '''
+            returns a dict with the hit/miss/eviction counters and the cache size
+        '''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self.size,
+            }
+
+    def _drop(self, key):
+        self.size -= self._entries.pop(key)[1]
@@ -0,0 +1,73 @@
+# single-flight coalescing of identical in-flight reads
+from threading import Event, Lock
+import json
+
+from .cache import ResponseCache
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+        Identical calls made while one is in flight wait for it and share its result
+        -------------------------
+        counters: `calls` made, `coalesced` calls that got the result of another one
+
+        # only reads are coalesced: GET/POST outside the cmd/rest/upd paths, see `can_coalesce`
+        # the shared result is the same object for every caller, don't mutate it
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def key(method, url, body=None):
+        return (method.upper(), url, None if body is None else json.dumps(body, sort_keys=True))
+
+    @staticmethod
+    def can_coalesce(method, url):
+        return method.upper() in ('GET', 'POST') and not ResponseCache.is_write(method, url)
+
+    def do(self, key, fn):
+        '''
+            returns (result, shared): the result of fn(), or of the call of the same key in flight (shared=True)
+            -------------------------
+            errors of the call are raised to every caller
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._calls)}
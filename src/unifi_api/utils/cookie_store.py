@@ -0,0 +1,125 @@
+# stores of controller session cookies, shared between clients, processes and workers
+from contextlib import contextmanager
+from threading import Lock
+import json
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks (windows), writes are still atomic
+    fcntl = None
+
+
+class CookieStore:
+    '''
+        Storage of `unifises` session cookies, set it as the `cookie_store` of a session
+        -------------------------
+        subclass it for other backends (redis, a database...), entries are dicts of
+        `{'value': ..., 'domain': ..., 'path': ..., 'expires': timestamp or None}` stored under `key(base_url, username)`
+
+        # stored cookies aren't checked, sessions use them until the controller answers api.err.LoginRequired
+    '''
+    @staticmethod
+    def key(base_url, username):
+        return '%s|%s' % (base_url.rstrip('/'), username)
+
+    def load(self, key):
+        '''
+            returns the entry of a key, None if missing
+        '''
+        raise NotImplementedError('load')
+
+    def save(self, key, entry):
+        raise NotImplementedError('save')
+
+    def delete(self, key):
+        raise NotImplementedError('delete')
+
+    @staticmethod
+    def expired(entry):
+        return entry.get('expires') is not None and entry['expires'] <= time.time()
+
+
+class MemoryCookieStore(CookieStore):
+    '''
+        Cookie store shared by the sessions of one process
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}
+
+    def load(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        return None if entry is None or self.expired(entry) else dict(entry)
+
+    def save(self, key, entry):
+        with self._lock:
+            self._entries[key] = dict(entry)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class FileCookieStore(CookieStore):
+    '''
+        Cookie store in a json file, shared by the processes of a host
+        -------------------------
+        params:
+            Name        | required  | description
+            -----------------------------------------
+            path        |   True    | json file of the cookies, created with mode 0600
+
+        # updates hold an exclusive lock on `path.lock` and replace the file atomically
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+
+    @contextmanager
+    def _locked(self, exclusive):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            fd = os.open('%s.lock' % self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                yield
+            finally:
+                os.close(fd)
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as fh:
+                return json.load(fh)
+        except (FileNotFoundError, ValueError):
+            # missing or corrupt, it only holds cookies: start over
+            return {}
+
+    def _write(self, entries):
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(entries, fh)
+        os.replace(tmp, self.path)
+
+    def load(self, key):
+        with self._locked(exclusive=False):
+            entry = self._read().get(key)
+        return None if entry is None or self.expired(entry) else entry
+
+    def save(self, key, entry):
+        with self._locked(exclusive=True):
+            entries = self._read()
+            entries[key] = dict(entry)
+            self._write(entries)
+
+    def delete(self, key):
+        with self._locked(exclusive=True):
+            entries = self._read()
+            if entries.pop(key, None) is not None:
+                self._write(entries)
@@ -1,15 +1,18 @@
 # custom decorators
 from functools import wraps
+import inspect
+import threading
 
 import trafaret as t
+from trafaret.base import GuardError
 
 from .exceptions import UnifiLoginError
-from .models import JsonResponse
+from .models import check_response
 
 def call_requires_login(func):
     def validate(resp):
-        if resp.status_code == 401 and 'application/json' in resp.headers.get('Content-Type'):
-            d = JsonResponse.check(resp.json())
+        if resp.status_code == 401 and 'application/json' in resp.headers.get('Content-Type', ''):
+            d = check_response(resp.json())
             if d['meta']['msg'] == 'api.err.LoginRequired':
                 return
         return resp
@@ -20,12 +23,21 @@ def call_requires_login(func):
         assert isinstance(self, AbstractUnifiSession), 'Calls must be made from an AbstractUnifiSession subclass'
         r = None
         for i in range(3):
+            generation = self.login_generation
             r = func(self, *args, **kwargs)
             if validate(r) is not None:
                 break
             self.debug('*****needs to reconnect to controller')
-            self.clear_cookies()
-            self.login()
+            # wrapped calls are (method, url, **kwargs)
+            self.metrics.observe_retry(args[0], args[1])
+            # only one thread logs in again, the others wait and reuse its cookie
+            with self.span('relogin'), self.login_lock:
+                if generation == self.login_generation:
+                    cookie = self.session_cookie()
+                    self.clear_cookies()
+                    # another process may have logged in already, reuse its cookie if it's a new one
+                    if not self.restore_cookie(stale=cookie and cookie.value):
+                        self.login()
         else:
             raise UnifiLoginError('Reconnection to controller failed')
         return r
@@ -39,19 +51,230 @@ def requires_login(func):
         assert isinstance(self, AbstractUnifiSession), 'Must be called from an AbstractUnifiSession subclass'
         # could try sometimes to ease bad connection cases
         if not self.logged_in:
-            self.login()
+            with self.login_lock:
+                if not self.logged_in and not self.restore_cookie():
+                    self.login()
         return func(self, *args, **kwargs)
     return wrapper
 
+def async_call_requires_login(func):
+    async def validate(resp):
+        if resp.status == 401 and 'application/json' in resp.headers.get('Content-Type', ''):
+            d = check_response(await resp.json())
+            if d['meta']['msg'] == 'api.err.LoginRequired':
+                return
+        return resp
+
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        from ..async_base_api import AsyncUnifiSession
+        assert isinstance(self, AsyncUnifiSession), 'Calls must be made from an AsyncUnifiSession subclass'
+        r = None
+        for i in range(3):
+            generation = self.login_generation
+            r = await func(self, *args, **kwargs)
+            if await validate(r) is not None:
+                break
+            self.debug('*****needs to reconnect to controller')
+            # wrapped calls are get/post/put/delete(url, **kwargs)
+            self.metrics.observe_retry(func.__name__.upper(), args[0])
+            # only one coroutine logs in again, the others reuse its cookie
+            async with self.login_lock:
+                if generation == self.login_generation:
+                    self.clear_cookies()
+                    await self.login()
+        else:
+            raise UnifiLoginError('Reconnection to controller failed')
+        return r
+    return wrapper
+
+
+def async_requires_login(func):
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        from ..async_base_api import AsyncUnifiSession
+        assert isinstance(self, AsyncUnifiSession), 'Must be called from an AsyncUnifiSession subclass'
+        if not self.logged_in:
+            async with self.login_lock:
+                if not self.logged_in:
+                    await self.login()
+        return await func(self, *args, **kwargs)
+    return wrapper
+
+# argument validation level of `guard`:
+#   full  -> trafaret check of every argument
+#   types -> cheap isinstance checks, MAC addresses are still normalized
+#   off   -> no validation (nor conversion)
+VALIDATION_LEVELS = ('full', 'types', 'off')
+_validation = {'level': 'full'}
+_guarded = threading.local()
+
+
+def set_validation_level(level):
+    '''
+        Set the argument validation level of every guarded call, see `VALIDATION_LEVELS`
+    '''
+    assert level in VALIDATION_LEVELS, 'level must be one of %s' % (VALIDATION_LEVELS, )
+    _validation['level'] = level
+
+
+def get_validation_level():
+    return _validation['level']
+
+
+def _compile_type_check(trafaret):
+    # translate a trafaret into a cheap checker, unknown trafarets are checked as is
+    from . import models
+    if trafaret is models.MacAddress:
+        return models.check_macaddr
+    if isinstance(trafaret, t.Forward):
+        return _compile_type_check(trafaret.trafaret)
+    if isinstance(trafaret, t.OnError):
+        return _compile_type_check(trafaret.trafaret)
+    if isinstance(trafaret, t.Or):
+        checks = [_compile_type_check(tr) for tr in trafaret.trafarets]
+        def check_or(value):
+            for check in checks:
+                try:
+                    return check(value)
+                except t.DataError:
+                    pass
+            raise t.DataError('value does not match any variant', value=value)
+        return check_or
+    if isinstance(trafaret, t.List):
+        check_item = _compile_type_check(trafaret.trafaret)
+        def check_list(value):
+            if not isinstance(value, list):
+                raise t.DataError('value is not a list', value=value)
+            return [check_item(v) for v in value]
+        return check_list
+    if isinstance(trafaret, t.Atom):
+        return _value_check(lambda value: value == trafaret.value)
+    if isinstance(trafaret, t.Enum):
+        return _value_check(lambda value: value in trafaret.variants)
+    if isinstance(trafaret, t.Type):
+        return _value_check(lambda value: isinstance(value, trafaret.type_))
+    for cls, types in ((t.Bool, bool), (t.Int, int), (t.Float, (int, float)), (t.String, str)):
+        if type(trafaret) is cls:
+            if cls in (t.Int, t.Float) and any(getattr(trafaret, b) is not None for b in ('gte', 'lte', 'gt', 'lt')):
+                # bounded numbers get the full check
+                return trafaret.check
+            return _value_check(lambda value: isinstance(value, types))
+    return trafaret.check
+
+
+def _value_check(ok):
+    def check(value):
+        if not ok(value):
+            raise t.DataError('value has wrong type', value=value)
+        return value
+    return check
+
+
 def guard(params=None, **kwargs):
-    specs = t.Forward()
-    if params is None:
-        specs << t.Dict(**kwargs)
-    else:
-        specs << params
+    '''
+        Validate and convert the arguments of a call with a trafaret Dict (or the kwargs trafarets)
+        -------------------------
+        the validation level is set with `set_validation_level`:
+            full  -> the trafaret Dict checks and converts every argument
+            types -> each argument gets a cheap type check (bounds of numbers are still checked,
+                     MAC addresses are still normalized), trafarets without a cheap variant run as is,
+                     arguments missing from the Dict are rejected unless it allows extra keys
+        arguments are bound like a plain call: extra positional, unknown or repeated arguments raise TypeError
+
+        # guarded internal helpers (`_name`) called by a guarded method of the same object run
+        # unchecked, their arguments are built from values the outer guard already converted,
+        # other nested calls on the same object only when they receive such values as is
+    '''
+    specs = t.Dict(**kwargs) if params is None else params
     def wrapped(fn):
-        guarder = t.guard(specs)
-        wrapper = wraps(fn)(guarder(fn))
-        wrapper.__doc__ = fn.__doc__
+        signature = inspect.signature(fn)
+        params = list(signature.parameters)
+        method = bool(params) and params[0] in ('self', 'cls')
+        names = params[1:] if method else params
+        positions = {name: i for i, name in enumerate(names)}
+        defaults = {name: p.default for name, p in signature.parameters.items() if p.default is not p.empty}
+        plain = all(p.kind is p.POSITIONAL_OR_KEYWORD for p in signature.parameters.values())
+        internal = method and fn.__name__.startswith('_')
+        type_checks = []
+        # argument names allowed at the types level, empty if the Dict allows any
+        known = set()
+
+        def bind(args, kw):
+            # extra or repeated arguments raise TypeError, missing ones are reported by the check
+            if not plain:
+                bound = signature.bind_partial(*args, **kw)
+                bound.apply_defaults()
+                call_args = dict(bound.arguments)
+                if method:
+                    call_args.pop(params[0])
+                return call_args
+            if method:
+                args = args[1:]
+            if len(args) > len(names):
+                raise TypeError('%s() takes %d positional arguments but %d were given' % (fn.__name__, len(names), len(args)))
+            call_args = dict(defaults)
+            call_args.update(zip(names, args))
+            if kw:
+                for name in kw:
+                    position = positions.get(name)
+                    if position is None:
+                        raise TypeError('%s() got an unexpected keyword argument %r' % (fn.__name__, name))
+                    if position < len(args):
+                        raise TypeError('%s() got multiple values for argument %r' % (fn.__name__, name))
+                call_args.update(kw)
+            return call_args
+
+        def check_types(call_args):
+            if not type_checks:
+                type_checks.extend((key.name, _compile_type_check(key.trafaret)) for key in specs.keys)
+                if not (specs.allow_any or specs.ignore_any):
+                    known.update(key.name for key in specs.keys)
+                    known.update(specs.extras, specs.ignore)
+            # call_args is a new dict, converted in place
+            converted = call_args
+            errors = {}
+            if known and not known.issuperset(converted):
+                for name in converted:
+                    if name not in known:
+                        errors[name] = t.DataError('%s is not allowed key' % name)
+            for name, check in type_checks:
+                if name in converted:
+                    try:
+                        converted[name] = check(converted[name])
+                    except t.DataError as err:
+                        errors[name] = err
+            if errors:
+                raise GuardError(error=errors)
+            return converted
+
+        @wraps(fn)
+        def wrapper(*args, **kw):
+            level = _validation['level']
+            if level == 'off':
+                return fn(*args, **kw)
+            owner = args[0] if method and args else None
+            outer = getattr(_guarded, 'converted', None)
+            if owner is not None and outer is not None and outer[0] is owner and (internal or (
+                    all(id(v) in outer[1] for v in args[1:]) and all(id(v) in outer[1] for v in kw.values()))):
+                # nested call trusted to the outer guard
+                return fn(*args, **kw)
+
+            call_args = bind(args, kw)
+            if level == 'full':
+                try:
+                    converted = specs.check(call_args)
+                except t.DataError as err:
+                    raise GuardError(error=err.error)
+            else:
+                converted = check_types(call_args)
+
+            if owner is None:
+                return fn(**converted)
+            _guarded.converted = (owner, set(map(id, converted.values())))
+            try:
+                return fn(owner, **converted)
+            finally:
+                _guarded.converted = outer
         return wrapper
     return wrapped
@@ -2,3 +2,42 @@
 
 class UnifiLoginError(Exception):
     pass
+
+
+class UnifiCallFailed(Exception):
+    '''
+        Recorded in the `errors` of a multi-site call for sites whose call returned False (controller error)
+    '''
+    pass
+
+
+class UnifiSiteErrors(Exception):
+    '''
+        Raised after a multi-site call finishes, `errors` maps each failed site to its exception
+    '''
+    def __init__(self, errors):
+        super(UnifiSiteErrors, self).__init__('%d site(s) failed: %s' % (len(errors), ', '.join(sorted(errors))))
+        self.errors = errors
+
+
+class UnifiControllerErrors(Exception):
+    '''
+        Raised after a multi-controller call finishes, `errors` maps each failed controller to its exception
+    '''
+    def __init__(self, errors):
+        super(UnifiControllerErrors, self).__init__('%d controller(s) failed: %s' % (len(errors), ', '.join(sorted(errors))))
+        self.errors = errors
+
+
+class UnifiControllerUnavailable(Exception):
+    '''
+        Raised for calls to a controller marked unhealthy by a UnifiClientPool
+    '''
+    pass
+
+
+class UnifiRoutingError(Exception):
+    '''
+        Raised when a UnifiClientPool can't tell the controller of a site (unknown or on several controllers)
+    '''
+    pass
@@ -0,0 +1,192 @@
+# client side rate limits and adaptive concurrency of the requests to a controller
+from contextlib import contextmanager
+from threading import Condition, Lock
+from urllib.parse import urlsplit
+import re
+import time
+
+# (endpoint class, path regexp), first match wins
+ENDPOINT_CLASSES = (
+    ('report', r'/stat/report/'),
+    ('command', r'/(cmd|rest|upd)/'),
+    ('listing', r''),
+)
+
+
+class TokenBucket:
+    '''
+        Token bucket of `rate` requests per second, up to `burst` at once
+        -------------------------
+        # `acquire` reserves a token and sleeps until it's due, callers are served in arrival order
+    '''
+    def __init__(self, rate, burst=None):
+        assert rate > 0, 'rate must be positive'
+        self.rate = rate
+        self.burst = max(1, rate if burst is None else burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        '''
+            Take a token, returns the seconds waited for it
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class AIMDLimit:
+    '''
+        Concurrent requests limit, additive increase / multiplicative decrease
+        -------------------------
+        params:
+            Name            | required  | description
+            -----------------------------------------
+            initial         |   False   | starting limit, defaults to 4
+            min_limit       |   False   | lower bound, defaults to 1
+            max_limit       |   False   | upper bound, defaults to 64
+            target_latency  |   False   | seconds above which a response counts as congestion, defaults to 2
+            backoff         |   False   | factor applied to the limit on congestion, defaults to 0.5
+
+        # errors (exceptions, 429 and 5xx) and slow responses multiply the limit by `backoff`, once per round trip:
+        # requests started before the last decrease don't decrease it again
+        # successes while the limit is in use raise it by 1/limit (+1 per full window)
+    '''
+    def __init__(self, initial=4, min_limit=1, max_limit=64, target_latency=2, backoff=0.5):
+        assert 1 <= min_limit <= initial <= max_limit, 'limits must be 1 <= min_limit <= initial <= max_limit'
+        assert 0 < backoff < 1, 'backoff must be between 0 and 1'
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        self._last_decrease = float('-inf')
+        self._cond = Condition()
+
+    def acquire(self):
+        '''
+            Wait for a free slot, returns its start time (for `release`)
+        '''
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, started, seconds, error=False):
+        with self._cond:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if error or seconds > self.target_latency:
+                if started >= self._last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._last_decrease = time.monotonic()
+                    self.decreases += 1
+            elif saturated and self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.increases += 1
+            self._cond.notify_all()
+
+
+class RateLimiter:
+    '''
+        Client side limits of the requests to one controller
+        -------------------------
+        params:
+            Name        | required  | description
+            -----------------------------------------
+            rate        |   False   | max requests per second to the controller, defaults to None (no limit)
+            burst       |   False   | requests allowed at once above the rate, defaults to `rate`
+            class_rates |   False   | dict of endpoint class -> max requests per second, e.g. {'report': 2, 'command': 5}
+            concurrency |   False   | AIMDLimit of the concurrent requests, defaults to AIMDLimit(), False for none
+            classes     |   False   | (endpoint class, path regexp) pairs, defaults to `ENDPOINT_CLASSES`
+
+        # share one limiter between the sessions of a controller, not between controllers
+        # the concurrency slot is held until the body is read, or until the headers for streamed responses
+    '''
+    def __init__(self, rate=None, burst=None, class_rates=None, concurrency=None, classes=ENDPOINT_CLASSES):
+        self.bucket = None if rate is None else TokenBucket(rate, burst)
+        self.class_buckets = {name: TokenBucket(r) for name, r in (class_rates or {}).items()}
+        self.concurrency = AIMDLimit() if concurrency is None else (concurrency or None)
+        self.classes = [(name, re.compile(pattern)) for name, pattern in classes]
+        self._lock = Lock()
+        self._stats = {}
+
+    def classify(self, url):
+        '''
+            returns the endpoint class of an url, None if no pattern matches
+        '''
+        path = urlsplit(url).path
+        for name, pattern in self.classes:
+            if pattern.search(path):
+                return name
+        return None
+
+    @contextmanager
+    def slot(self, url):
+        '''
+            Wait for the rate limits and a concurrency slot, the block makes the request
+            -------------------------
+            yields a dict, set its `status` to the response status code to report errors
+        '''
+        name = self.classify(url)
+        waited = 0
+        if self.bucket is not None:
+            waited += self.bucket.acquire()
+        if name in self.class_buckets:
+            waited += self.class_buckets[name].acquire()
+        concurrency = self.concurrency
+        if concurrency is not None:
+            queued = time.monotonic()
+            started = concurrency.acquire()
+            waited += started - queued
+        else:
+            started = time.monotonic()
+        slot = {'status': None}
+        error = True
+        try:
+            yield slot
+            status = slot['status']
+            error = status is not None and (status == 429 or status >= 500)
+        finally:
+            if concurrency is not None:
+                concurrency.release(started, time.monotonic() - started, error)
+            self._observe(name, waited, error)
+
+    def _observe(self, name, waited, error):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = {'requests': 0, 'throttled': 0, 'wait_seconds': 0.0, 'errors': 0}
+            stats['requests'] += 1
+            stats['errors'] += error
+            if waited > 0:
+                stats['throttled'] += 1
+                stats['wait_seconds'] += waited
+
+    def stats(self):
+        '''
+            returns {'classes': {class: {requests, throttled, wait_seconds, errors}},
+                     'concurrency': {limit, in_flight, increases, decreases} or None}
+        '''
+        with self._lock:
+            classes = {name: dict(stats) for name, stats in self._stats.items()}
+        concurrency = self.concurrency
+        if concurrency is None:
+            return {'classes': classes, 'concurrency': None}
+        return {'classes': classes, 'concurrency': {
+            'limit': int(concurrency.limit),
+            'in_flight': concurrency.in_flight,
+            'increases': concurrency.increases,
+            'decreases': concurrency.decreases,
+        }}
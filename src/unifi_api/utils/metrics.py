@@ -0,0 +1,194 @@
+# request metrics per endpoint template
+from bisect import bisect_left
+from functools import lru_cache
+from threading import Lock
+import re
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_SITE = re.compile(r'^(/api/s/)[^/]+')
+_MAC = re.compile(r'/([0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2}(?=/|$)')
+_OBJECT_ID = re.compile(r'/[0-9a-f]{24}(?=/|$)')
+
+
+@lru_cache(maxsize=4096)
+def endpoint_template(url):
+    '''
+        Endpoint of a url without the site, macs and object ids
+        e.g. https://host:8443/api/s/default/stat/device/f0:9f:c2:00:00:01 -> /api/s/{site}/stat/device/{mac}
+    '''
+    path = re.sub(r'^[a-z]+://[^/]+', '', url or '').split('?', 1)[0].rstrip('/') or '/'
+    path = _SITE.sub(r'\1{site}', path)
+    path = _MAC.sub('/{mac}', path)
+    return _OBJECT_ID.sub('/{id}', path)
+
+
+class _Endpoint:
+    __slots__ = ('status', 'latency_buckets', 'latency_sum', 'bytes', 'decode_sum', 'decode_count',
+                 'validate_sum', 'validate_count', 'relogin_retries', 'coalesced')
+
+    def __init__(self):
+        self.status = {}
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.bytes = 0
+        self.decode_sum = 0.0
+        self.decode_count = 0
+        self.validate_sum = 0.0
+        self.validate_count = 0
+        self.relogin_retries = 0
+        self.coalesced = 0
+
+
+class Metrics:
+    '''
+        Controller request metrics
+        -------------------------
+        per (method, endpoint template): requests by status, latency histogram, response bytes,
+        json decode and validation time, re-login retries, calls coalesced into an in-flight
+        identical one; plus login counts and background
+        session refreshes (count by result and time spent, per kind: login, validate)
+
+        # `snapshot()` returns a dict, `prometheus()` the prometheus text exposition format
+        # share one instance between sessions to aggregate them
+        # streamed responses count the Content-Length bytes, when sent, and no decode time
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self._endpoints = {}
+        self.logins = {'ok': 0, 'failed': 0}
+        self.refreshes = {}
+
+    def _endpoint(self, method, url):
+        key = (method.upper(), endpoint_template(url))
+        endpoint = self._endpoints.get(key)
+        if endpoint is None:
+            endpoint = self._endpoints.setdefault(key, _Endpoint())
+        return endpoint
+
+    def observe_request(self, method, url, status, seconds, size):
+        with self._lock:
+            endpoint = self._endpoint(method, url)
+            endpoint.status[status] = endpoint.status.get(status, 0) + 1
+            endpoint.latency_buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            endpoint.latency_sum += seconds
+            if size:
+                endpoint.bytes += size
+
+    def observe_decode(self, method, url, decode_seconds, validate_seconds):
+        with self._lock:
+            endpoint = self._endpoint(method, url)
+            endpoint.decode_sum += decode_seconds
+            endpoint.decode_count += 1
+            endpoint.validate_sum += validate_seconds
+            endpoint.validate_count += 1
+
+    def observe_retry(self, method, url):
+        with self._lock:
+            self._endpoint(method, url).relogin_retries += 1
+
+    def observe_coalesced(self, method, url):
+        with self._lock:
+            self._endpoint(method, url).coalesced += 1
+
+    def observe_login(self, ok):
+        with self._lock:
+            self.logins['ok' if ok else 'failed'] += 1
+
+    def observe_refresh(self, kind, ok, seconds):
+        with self._lock:
+            refresh = self.refreshes.get(kind)
+            if refresh is None:
+                refresh = self.refreshes[kind] = {'ok': 0, 'failed': 0, 'seconds': 0.0}
+            refresh['ok' if ok else 'failed'] += 1
+            refresh['seconds'] += seconds
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self.logins = {'ok': 0, 'failed': 0}
+            self.refreshes = {}
+
+    def snapshot(self):
+        '''
+            returns {'endpoints': {'METHOD template': {...}}, 'logins': {'ok': n, 'failed': n},
+                     'refreshes': {kind: {'ok': n, 'failed': n, 'seconds': s}}}
+            latency buckets are cumulative, keyed by upper bound ('+Inf' last)
+        '''
+        with self._lock:
+            endpoints = {}
+            for (method, template), e in sorted(self._endpoints.items()):
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf', ), e.latency_buckets):
+                    cumulative += count
+                    buckets[bound] = cumulative
+                endpoints['%s %s' % (method, template)] = {
+                    'requests': sum(e.status.values()),
+                    'status': dict(e.status),
+                    'latency': {'count': cumulative, 'sum': e.latency_sum, 'buckets': buckets},
+                    'bytes': e.bytes,
+                    'decode': {'count': e.decode_count, 'sum': e.decode_sum},
+                    'validate': {'count': e.validate_count, 'sum': e.validate_sum},
+                    'relogin_retries': e.relogin_retries,
+                    'coalesced': e.coalesced,
+                }
+            return {
+                'endpoints': endpoints,
+                'logins': dict(self.logins),
+                'refreshes': {kind: dict(r) for kind, r in sorted(self.refreshes.items())},
+            }
+
+    def prometheus(self, prefix='unifi'):
+        '''
+            returns the metrics in the prometheus text exposition format
+        '''
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, kind, doc):
+            lines.append('# HELP %s_%s %s' % (prefix, name, doc))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+
+        def labels(key, **extra):
+            method, template = key.split(' ', 1)
+            pairs = [('method', method), ('endpoint', template)] + sorted(extra.items())
+            return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+        endpoints = snapshot['endpoints']
+        family('requests_total', 'counter', 'Requests sent to the controller')
+        for key, e in endpoints.items():
+            for status, count in sorted(e['status'].items()):
+                lines.append('%s_requests_total{%s} %d' % (prefix, labels(key, status=status), count))
+        family('request_duration_seconds', 'histogram', 'Request latency')
+        for key, e in endpoints.items():
+            for bound, count in e['latency']['buckets'].items():
+                lines.append('%s_request_duration_seconds_bucket{%s} %d' % (prefix, labels(key, le=bound), count))
+            lines.append('%s_request_duration_seconds_sum{%s} %r' % (prefix, labels(key), e['latency']['sum']))
+            lines.append('%s_request_duration_seconds_count{%s} %d' % (prefix, labels(key), e['latency']['count']))
+        family('response_bytes_total', 'counter', 'Response body bytes')
+        for key, e in endpoints.items():
+            lines.append('%s_response_bytes_total{%s} %d' % (prefix, labels(key), e['bytes']))
+        for name, doc in (('decode', 'Json decoding time'), ('validate', 'Response validation time')):
+            family('%s_seconds' % name, 'summary', doc)
+            for key, e in endpoints.items():
+                lines.append('%s_%s_seconds_sum{%s} %r' % (prefix, name, labels(key), e[name]['sum']))
+                lines.append('%s_%s_seconds_count{%s} %d' % (prefix, name, labels(key), e[name]['count']))
+        family('relogin_retries_total', 'counter', 'Calls retried after an expired login')
+        for key, e in endpoints.items():
+            lines.append('%s_relogin_retries_total{%s} %d' % (prefix, labels(key), e['relogin_retries']))
+        family('coalesced_total', 'counter', 'Calls answered by an identical call in flight')
+        for key, e in endpoints.items():
+            lines.append('%s_coalesced_total{%s} %d' % (prefix, labels(key), e['coalesced']))
+        family('logins_total', 'counter', 'Logins to the controller')
+        for result, count in sorted(snapshot['logins'].items()):
+            lines.append('%s_logins_total{result="%s"} %d' % (prefix, result, count))
+        family('session_refreshes_total', 'counter', 'Background session refreshes')
+        for kind, r in snapshot['refreshes'].items():
+            for result in ('ok', 'failed'):
+                lines.append('%s_session_refreshes_total{kind="%s",result="%s"} %d' % (prefix, kind, result, r[result]))
+        family('session_refresh_seconds_total', 'counter', 'Time spent in background session refreshes')
+        for kind, r in snapshot['refreshes'].items():
+            lines.append('%s_session_refresh_seconds_total{kind="%s"} %r' % (prefix, kind, r['seconds']))
+        return '\n'.join(lines) + '\n'
@@ -1,27 +1,39 @@
 from datetime import datetime
+from functools import lru_cache
 import re
 
 import trafaret as t
 
-class ReAndTrans(t.Regexp):
-    def __init__(self, regexp, re_flags=0, trans=lambda x: x):
-        super(ReAndTrans, self).__init__(regexp, re_flags)
-        self.trans = trans
-    def check_and_return(self, value):
-        return self.trans(super(ReAndTrans, self).check_and_return(value))
+from .cache import ResponseCache
+from .report_cache import ReportCache
+from .metrics import Metrics
+from .tracing import Tracer
+from .cookie_store import CookieStore
+from .limiter import RateLimiter
 
 def format_macaddr(mac_address):
     m = mac_address.upper().replace('-', '').replace(':', '')
     return ':'.join(m[x:x+2] for x in range(0, len(m), 2))
 
 
-MacAddress = t.OnError(
-    ReAndTrans(re.compile(
-        r'^([0-9A-F]{2}[:-]?){5}([0-9A-F]{2})$',
-        re.IGNORECASE,
-    ), trans=format_macaddr),
-    'value is not a MAC address',
-)
+MAC_ADDRESS_RE = re.compile(r'^([0-9A-F]{2}[:-]?){5}([0-9A-F]{2})$', re.IGNORECASE)
+
+@lru_cache(maxsize=16384)
+def normalize_macaddr(value):
+    '''
+        Memoized MAC address check and format, returns None if value isn't a MAC address
+    '''
+    if MAC_ADDRESS_RE.match(value) is None:
+        return None
+    return format_macaddr(value)
+
+def check_macaddr(value):
+    mac = normalize_macaddr(value) if isinstance(value, str) else None
+    if mac is None:
+        raise t.DataError('value is not a MAC address', value=value)
+    return mac
+
+MacAddress = t.Call(check_macaddr)
 
 SiteName = t.OnError(
     # XXX: New unifi update changes site id structure, fix for future releases
@@ -32,14 +44,32 @@ SiteName = t.OnError(
 
 # No concrete JsonResponse structure for now, only basics
 # maybe use special t.Key to map some usefull things like meta.rc (ok, error) => (True, False) in another key
+JsonMeta = t.Dict({
+    'rc': t.Enum('ok', 'error'), # check if other rc's could exist
+    t.Key('msg', optional=True): t.String,
+}, ignore_extra='*')
+
 JsonResponse = t.Dict({
     'data': t.Or(t.List(t.Any), t.String), # check if data is optinal, and possible values
-    'meta': t.Dict({
-        'rc': t.Enum('ok', 'error'), # check if other rc's could exist
-        t.Key('msg', optional=True): t.String,
-    }, ignore_extra='*'),
+    'meta': JsonMeta,
 }, ignore_extra='*')
 
+def check_response(value):
+    '''
+        Fast check of a controller response envelope
+        -------------------------
+        only `meta.rc`, `meta.msg` and the type of `data` are checked, the value is returned as is
+        (`data` isn't copied), anything else is handed to `JsonResponse` for the detailed error
+    '''
+    if isinstance(value, dict):
+        meta = value.get('meta')
+        if isinstance(meta, dict) and \
+           meta.get('rc') in ('ok', 'error') and \
+           isinstance(meta.get('msg', ''), str) and \
+           isinstance(value.get('data'), (list, str)):
+            return value
+    return JsonResponse.check(value)
+
 _base_time_params = t.Dict({
     'start': t.Or(t.Float, t.Type(datetime), t.Atom(None)),
     'end': t.Or(t.Float, t.Type(datetime), t.Atom(None)),
@@ -64,6 +94,32 @@ init_params = t.Dict({
     'debug': t.Bool,
     t.Key('username', optional=True): t.Or(t.String, t.Atom(None)),
     t.Key('password', optional=True): t.Or(t.String, t.Atom(None)),
+    t.Key('cache', optional=True): t.Or(t.Type(ResponseCache), t.Atom(None)),
+    t.Key('report_cache', optional=True): t.Or(t.Type(ReportCache), t.Atom(None)),
+    t.Key('pool_connections', optional=True): t.Int(gte=1),
+    t.Key('pool_maxsize', optional=True): t.Int(gte=1),
+    t.Key('pool_block', optional=True): t.Bool,
+    t.Key('keep_alive', optional=True): t.Bool,
+    t.Key('retries', optional=True): t.Int(gte=0),
+    t.Key('backoff_factor', optional=True): t.Float(gte=0),
+    t.Key('metrics', optional=True): t.Or(t.Type(Metrics), t.Atom(None)),
+    t.Key('tracer', optional=True): t.Or(t.Type(Tracer), t.Atom(None)),
+    t.Key('cookie_store', optional=True): t.Or(t.Type(CookieStore), t.Atom(None)),
+    t.Key('limiter', optional=True): t.Or(t.Type(RateLimiter), t.Atom(None)),
+    t.Key('coalesce', optional=True): t.Bool,
+    t.Key('strict_responses', optional=True): t.Bool,
+})
+
+# the asyncio session has its own transport, only these options apply to it
+async_init_params = t.Dict({
+    'base_url': t.URL,
+    'ssl_verify': t.Bool,
+    'debug': t.Bool,
+    t.Key('username', optional=True): t.Or(t.String, t.Atom(None)),
+    t.Key('password', optional=True): t.Or(t.String, t.Atom(None)),
+    'connection_limit': t.Int(gte=1),
+    t.Key('metrics', optional=True): t.Or(t.Type(Metrics), t.Atom(None)),
+    t.Key('strict_responses', optional=True): t.Bool,
 })
 
 authorize_guest_params = t.Dict({
@@ -76,9 +132,23 @@ authorize_guest_params = t.Dict({
     t.Key('MB_limit', optional=True): t.Or(t.Int, t.Atom(None)),
 })
 
+# (cmd, mac, site, params) tuples for UnifiClient.stamgr_batch, params use the controller field names
+stamgr_batch_params = t.List(t.Tuple(
+    t.Enum('authorize-guest', 'unauthorize-guest', 'kick-sta', 'block-sta', 'unblock-sta', 'forget-sta'),
+    MacAddress,
+    t.Or(SiteName, t.Atom(None)),
+    t.Or(t.Dict({
+        t.Key('minutes', optional=True): t.Int,
+        t.Key('up', optional=True): t.Int,
+        t.Key('down', optional=True): t.Int,
+        t.Key('MB_limit', optional=True): t.Int,
+        t.Key('ap_mac', optional=True): MacAddress,
+    }), t.Atom(None)),
+))
+
 site_stats_params = _base_time_site_params
 
-ap_stats_params = _base_time_op_site_params.merge({'ap_mac': MacAddress})
+ap_stats_params = _base_time_op_site_params.merge({'ap_mac': t.Or(MacAddress, t.Atom(None))})
 
 user_stats_params = _base_time_op_site_params.merge({ # maybe not optional site
     'user_mac': MacAddress,
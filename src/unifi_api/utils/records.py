@@ -0,0 +1,150 @@
+# compact record classes for large client/device/session lists
+import json
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+class Record:
+    '''
+        Compact controller record
+        -------------------------
+        the keys listed in `fields` are stored in slots (`record.mac`), every other key is kept
+        as a json blob that is only decoded when one of them is accessed (`record['radio_proto']`)
+
+        # absent native fields read as None and are left out of `to_dict`, fields the controller
+        # set to null are kept (`_present` is a bit mask of the native fields found in the data)
+        # subclasses only need to list their `fields` in both `fields` and `__slots__`
+    '''
+    __slots__ = ('_rest', '_extra', '_present')
+    fields = ()
+    _field_set = frozenset()
+    _field_bits = {}
+
+    def __init__(self, data, _strings=None):
+        rest = None
+        present = 0
+        bits = self._field_bits
+        for key, value in data.items():
+            bit = bits.get(key)
+            if bit is not None:
+                if _strings is not None and value.__class__ is str:
+                    # equal strings (macs, site ids, essids, ...) share one object
+                    value = _strings.setdefault(value, value)
+                object.__setattr__(self, key, value)
+                present |= bit
+            else:
+                if rest is None:
+                    rest = {}
+                rest[key] = value
+        for key in self.fields:
+            if not present & bits[key]:
+                object.__setattr__(self, key, None)
+        self._rest = None if rest is None else _encoder.encode(rest).encode()
+        self._extra = None
+        self._present = present
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.fields)
+        cls._field_bits = {key: 1 << i for i, key in enumerate(cls.fields)}
+
+    @classmethod
+    def from_records(cls, records):
+        '''
+            returns a list of records from an iterable of dicts (e.g. a streamed response)
+        '''
+        strings = {}
+        return [cls(data, strings) for data in records]
+
+    @property
+    def extra(self):
+        '''
+            dict of the keys that aren't native fields, decoded on first access
+        '''
+        if self._extra is None:
+            self._extra = {} if self._rest is None else json.loads(self._rest)
+            self._rest = None
+        return self._extra
+
+    def __getitem__(self, key):
+        bit = self._field_bits.get(key)
+        if bit is not None:
+            if not self._present & bit:
+                raise KeyError(key)
+            return getattr(self, key)
+        return self.extra[key]
+
+    def __contains__(self, key):
+        bit = self._field_bits.get(key)
+        if bit is not None:
+            return bool(self._present & bit)
+        return key in self.extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        present = self._present
+        bits = self._field_bits
+        data = {key: getattr(self, key) for key in self.fields if present & bits[key]}
+        data.update(self.extra)
+        return data
+
+    def __eq__(self, other):
+        if not isinstance(other, Record):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.mac)
+
+
+class ClientRecord(Record):
+    '''
+        Client (user/guest/station) from list_allusers, list_guests, stat_clients, list_online_clients
+    '''
+    fields = (
+        '_id', 'mac', 'site_id', 'oui', 'hostname', 'name', 'ip', 'ap_mac', 'essid', 'network',
+        'is_guest', 'is_wired', 'first_seen', 'last_seen', 'uptime', 'rx_bytes', 'tx_bytes',
+    )
+    __slots__ = fields
+
+
+class DeviceRecord(Record):
+    '''
+        Device (access point, switch, gateway) from list_devices, stat_device
+    '''
+    fields = (
+        '_id', 'mac', 'site_id', 'name', 'ip', 'model', 'type', 'version', 'serial',
+        'state', 'adopted', 'uptime', 'last_seen', 'num_sta', 'rx_bytes', 'tx_bytes',
+    )
+    __slots__ = fields
+
+
+class SessionRecord(Record):
+    '''
+        Login session from list_sessions, list_sessions_latest
+    '''
+    fields = (
+        '_id', 'mac', 'site_id', 'user_id', 'hostname', 'ip', 'ap_mac', 'is_guest',
+        'assoc_time', 'disassoc_time', 'duration', 'rx_bytes', 'tx_bytes',
+    )
+    __slots__ = fields
+
+
+# record class used by `UnifiClient.records` for each call
+RECORD_CLASSES = {
+    'list_allusers': ClientRecord,
+    'list_guests': ClientRecord,
+    'list_online_clients': ClientRecord,
+    'client_info': ClientRecord,
+    'stat_clients': ClientRecord,
+    'list_devices': DeviceRecord,
+    'stat_device': DeviceRecord,
+    'stat_deviceBasic': DeviceRecord,
+    'list_sessions': SessionRecord,
+    'list_sessions_latest': SessionRecord,
+}
@@ -0,0 +1,103 @@
+# background refresh of a controller session, keeps re-logins off the calls
+from threading import Event, Thread
+import time
+
+
+class SessionRefresher:
+    '''
+        Background thread keeping a session logged in
+        -------------------------
+        params:
+            Name        | required  | description
+            -----------------------------------------
+            session     |   True    | AbstractUnifiSession to keep alive
+            max_age     |   False   | seconds after a login to log in again, defaults to None (only when it expired)
+            max_idle    |   False   | seconds without calls after which the session is validated, defaults to 300
+            interval    |   False   | seconds between checks, defaults to 5
+            max_backoff |   False   | max seconds between refreshes after failures, defaults to 300
+
+        # a refresh logs in on a separate connection and swaps the cookie, calls keep using the old one meanwhile
+        # a validation is a light authenticated call (/api/self), an expired session logs in again there
+        # failed refreshes are retried after interval * 2 ** failures seconds, up to `max_backoff`
+        # refreshes are recorded in `session.metrics` (refreshes by kind: login, validate)
+    '''
+    def __init__(self, session, max_age=None, max_idle=300, interval=5, max_backoff=300):
+        assert max_age is None or max_age > 0, 'max_age must be positive'
+        assert max_idle is None or max_idle > 0, 'max_idle must be positive'
+        assert interval > 0, 'interval must be positive'
+        self.session = session
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self.interval = interval
+        self.max_backoff = max_backoff
+        # consecutive failed refreshes, and time.monotonic() before which none is tried again
+        self.failures = 0
+        self.retry_at = None
+        self._stop = Event()
+        self._thread = None
+
+    def due(self, now=None):
+        '''
+            returns the refresh the session needs now: 'login', 'validate' or None
+        '''
+        session = self.session
+        now = time.monotonic() if now is None else now
+        if self.retry_at is not None and now < self.retry_at:
+            return None
+        if not session.logged_in:
+            return 'login'
+        # login_time is None for cookies of unknown age (set by hand)
+        if self.max_age is not None and session.login_time is not None and now - session.login_time >= self.max_age:
+            return 'login'
+        if self.max_idle is not None and now - max(session.login_time or 0, session.last_request or 0) >= self.max_idle:
+            return 'validate'
+        return None
+
+    def check(self):
+        '''
+            Refresh the session if it's due, returns the kind of refresh made or None
+        '''
+        kind = self.due()
+        if kind is None:
+            return None
+        session = self.session
+        started = time.perf_counter()
+        try:
+            ok = session.refresh_login() if kind == 'login' else session.validate_session()
+        except Exception as e:
+            # a later check (or the next call) tries again
+            session.debug('session refresh (%s) failed: %s', kind, e)
+            ok = False
+        session.metrics.observe_refresh(kind, ok, time.perf_counter() - started)
+        if ok:
+            self.failures = 0
+            self.retry_at = None
+        else:
+            self.failures += 1
+            self.retry_at = time.monotonic() + min(self.interval * 2 ** self.failures, self.max_backoff)
+        return kind
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def start(self):
+        assert self._thread is None, 'already started'
+        self._thread = Thread(target=self.run, name='unifi-session-refresh', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
@@ -0,0 +1,214 @@
+# persistent cache of closed stat/report buckets
+from datetime import datetime
+from threading import Lock
+import json
+import sqlite3
+
+# bucket size in milliseconds of each report granularity
+GRANULARITY = {
+    '5minutes': 5*60*1000,
+    'hourly': 60*60*1000,
+    'daily': 24*60*60*1000,
+}
+
+# bumped when the tables change, older databases are dropped (it's a cache)
+SCHEMA_VERSION = 2
+
+_SCHEMA = '''
+DROP TABLE IF EXISTS buckets;
+DROP TABLE IF EXISTS identities;
+DROP TABLE IF EXISTS coverage;
+CREATE TABLE buckets (
+    controller TEXT, site TEXT, kind TEXT, mac TEXT, gran TEXT, attr TEXT, time INTEGER, value,
+    PRIMARY KEY (controller, site, kind, mac, gran, attr, time)
+) WITHOUT ROWID;
+CREATE TABLE identities (
+    controller TEXT, site TEXT, kind TEXT, mac TEXT, gran TEXT, time INTEGER, fields TEXT,
+    PRIMARY KEY (controller, site, kind, mac, gran, time)
+) WITHOUT ROWID;
+CREATE TABLE coverage (
+    controller TEXT, site TEXT, kind TEXT, mac TEXT, gran TEXT, attr TEXT, start_time INTEGER, end_time INTEGER
+);
+CREATE INDEX coverage_key ON coverage (controller, site, kind, mac, gran, attr);
+PRAGMA user_version = %d;
+''' % SCHEMA_VERSION
+
+_KEY = 'controller = ? AND site = ? AND kind = ? AND mac = ? AND gran = ?'
+
+
+def merge_ranges(ranges):
+    '''
+        returns sorted inclusive (start, end) ranges with overlapping and adjacent ones merged
+    '''
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class ReportCache:
+    '''
+        Cache of closed stat/report buckets, stored in sqlite
+        -------------------------
+        params:
+            Name        | required  | description
+            -----------------------------------------
+            path        |   False   | sqlite database file, defaults to :memory: (not persistent)
+            settle      |   False   | seconds a closed bucket is still re-fetched (late aggregation, clock skew),
+                        |           | defaults to None (one bucket of the report granularity)
+
+        # values are stored per (controller, site, report kind, object mac, granularity, attr) with the time
+        # ranges already fetched, so only missing ranges and the recent buckets are requested again
+        # a bucket is closed once `bucket time + bucket size + settle` is in the past, fetched ranges
+        # only count as covered up to their newest record (empty responses cover nothing)
+    '''
+    def __init__(self, path=':memory:', settle=None):
+        self.path = path
+        self.settle = settle
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if self._db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self._db.executescript(_SCHEMA)
+        self._lock = Lock()
+        self.cached_buckets = 0
+        self.fetched_ranges = 0
+
+    def close(self):
+        self._db.close()
+
+    def clear(self, site=None, controller=None):
+        '''
+            Drop every cached bucket (of a site and/or controller, if given)
+        '''
+        where = [(column, value) for column, value in (('controller', controller), ('site', site)) if value is not None]
+        clause = ' AND '.join('%s = ?' % column for column, _ in where)
+        with self._lock, self._db:
+            for table in ('buckets', 'identities', 'coverage'):
+                self._db.execute(
+                    'DELETE FROM %s%s' % (table, ' WHERE ' + clause if clause else ''),
+                    tuple(value for _, value in where),
+                )
+
+    def stats(self):
+        with self._lock:
+            return {'cached_buckets': self.cached_buckets, 'fetched_ranges': self.fetched_ranges}
+
+    def query(self, site, kind, mac, gran, attrs, start, end, fetch, now=None, controller=''):
+        '''
+            Get report records from cache, fetching what's missing
+            -------------------------
+            returns the records between start and end (inclusive, milliseconds) sorted by time,
+            or False if a fetch failed
+            params:
+                Name        | required  | description
+                -----------------------------------------
+                site        |   True    | site name, None for the client default (user reports)
+                kind        |   True    | report kind: site, ap, user, gw
+                mac         |   True    | mac of the reported object, None for site/gw reports
+                gran        |   True    | 5minutes, hourly, daily
+                attrs       |   True    | reported attributes
+                start, end  |   True    | time range in milliseconds
+                fetch       |   True    | callable(start, end) making the request, returns records or False
+                now         |   False   | current time in milliseconds, defaults to now
+                controller  |   False   | controller identity (base url), for caches shared between controllers
+
+            # records served from cache have the same fields as fetched ones: the requested attrs
+            # plus the other fields of the record (time, oid, site...)
+        '''
+        size = GRANULARITY[gran]
+        now = int(datetime.now().timestamp()*1000) if now is None else now
+        settle = size if self.settle is None else int(self.settle*1000)
+        closed_until = now - size - settle
+        attrs = [a for a in attrs if a != 'time']
+        # NULL never matches in the key, None site/mac are stored as ''
+        base = (controller, site or '', kind, mac or '', gran)
+
+        with self._lock:
+            gaps = []
+            for attr in attrs:
+                gaps.extend(self._gaps(base + (attr, ), start, min(end, closed_until)))
+        if end > closed_until:
+            gaps.append((max(start, closed_until + 1), end))
+        gaps = merge_ranges(gaps)
+
+        fresh = {}
+        for gap_start, gap_end in gaps:
+            records = fetch(gap_start, gap_end)
+            if records is False:
+                return False
+            records = list(records)
+            for record in records:
+                fresh[record['time']] = record
+            covered_until = min(gap_end, closed_until)
+            if records:
+                # buckets after the newest record may still be missing on the controller
+                covered_until = min(covered_until, max(record['time'] for record in records) + size - 1)
+            self._store(base, attrs, records, gap_start, covered_until if records else gap_start - 1, closed_until)
+
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT time, attr, value FROM buckets WHERE %s AND attr IN (%s) AND time BETWEEN ? AND ?'
+                % (_KEY, ', '.join('?'*len(attrs))),
+                base + tuple(attrs) + (start, end),
+            ).fetchall()
+            identities = dict(self._db.execute(
+                'SELECT time, fields FROM identities WHERE %s AND time BETWEEN ? AND ?' % _KEY,
+                base + (start, end),
+            ).fetchall())
+            self.fetched_ranges += len(gaps)
+        cached = {}
+        for time, attr, value in rows:
+            if time not in fresh:
+                record = cached.get(time)
+                if record is None:
+                    record = cached[time] = json.loads(identities[time]) if time in identities else {'time': time}
+                record[attr] = value
+        with self._lock:
+            self.cached_buckets += len(cached)
+        cached.update(fresh)
+        return [cached[time] for time in sorted(cached)]
+
+    def _gaps(self, key, start, end):
+        if start > end:
+            return []
+        covered = self._db.execute(
+            'SELECT start_time, end_time FROM coverage WHERE %s AND attr = ? '
+            'AND end_time >= ? AND start_time <= ? ORDER BY start_time' % _KEY,
+            key + (start, end),
+        ).fetchall()
+        gaps = []
+        cursor = start
+        for cov_start, cov_end in covered:
+            if cov_start > cursor:
+                gaps.append((cursor, cov_start - 1))
+            cursor = max(cursor, cov_end + 1)
+        if cursor <= end:
+            gaps.append((cursor, end))
+        return gaps
+
+    def _store(self, base, attrs, records, start, end, closed_until):
+        closed = [record for record in records if record['time'] <= closed_until]
+        rows = [
+            base + (attr, record['time'], record[attr])
+            for record in closed
+            for attr in attrs if attr in record
+        ]
+        identities = [
+            base + (record['time'], json.dumps({k: v for k, v in record.items() if k not in attrs}))
+            for record in closed
+        ]
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._db.executemany('INSERT OR REPLACE INTO identities VALUES (?, ?, ?, ?, ?, ?, ?)', identities)
+            if start > end:
+                return
+            for attr in attrs:
+                key = base + (attr, )
+                covered = self._db.execute('SELECT start_time, end_time FROM coverage WHERE %s AND attr = ?' % _KEY, key).fetchall()
+                self._db.execute('DELETE FROM coverage WHERE %s AND attr = ?' % _KEY, key)
+                self._db.executemany(
+                    'INSERT INTO coverage VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [key + r for r in merge_ranges(covered + [(start, end)])],
+                )
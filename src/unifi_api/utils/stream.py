@@ -0,0 +1,103 @@
+# incremental parsing of controller responses, used by the session streaming mode
+import codecs
+import json
+
+_WHITESPACE = ' \t\n\r'
+_DELIMITERS = _WHITESPACE + ',:]}'
+
+
+class _Buffer:
+    '''
+        Text buffer fed by an iterator of byte chunks, only the unparsed tail is kept
+    '''
+    def __init__(self, chunks, encoding='utf-8'):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.json = json.JSONDecoder()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # drop what was already parsed, then read at least as much as the unparsed tail
+        self.text = self.text[self.pos:]
+        self.pos = 0
+        wanted = max(len(self.text), 1)
+        read = 0
+        while read < wanted and not self.eof:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.eof = True
+                self.text += self.decoder.decode(b'', final=True)
+                break
+            text = self.decoder.decode(chunk)
+            self.text += text
+            read += len(text)
+
+    def peek(self):
+        '''
+            returns the next non whitespace char without consuming it
+        '''
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if self.eof:
+                raise ValueError('Unexpected end of json document')
+            self.fill()
+
+    def take(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError('Expecting one of %r at position %d, got %r' % (chars, self.pos, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        '''
+            returns the next json value, reading more chunks until it's complete
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.text, self.pos)
+                # a value not followed by a delimiter may be truncated (e.g. numbers)
+                if self.eof or (end < len(self.text) and self.text[end] in _DELIMITERS):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_members(chunks, array_key='data'):
+    '''
+        Parse a json object from an iterator of byte chunks
+        -------------------------
+        yields (key, value, item) for each member of the object, if the `array_key` member
+        is an array, its elements are yielded one by one as (array_key, element, True)
+        otherwise `item` is False
+    '''
+    buf = _Buffer(chunks)
+    buf.take('{')
+    if buf.peek() == '}':
+        return
+    while True:
+        key = buf.value()
+        buf.take(':')
+        if key == array_key and buf.peek() == '[':
+            buf.take('[')
+            if buf.peek() == ']':
+                buf.take(']')
+            else:
+                while True:
+                    yield key, buf.value(), True
+                    if buf.take(',]') == ']':
+                        break
+        else:
+            yield key, buf.value(), False
+        if buf.take(',}') == '}':
+            return
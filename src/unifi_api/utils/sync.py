@@ -0,0 +1,80 @@
+# state of the incremental (watermark) syncs of sessions and authorizations
+from hashlib import blake2b
+from threading import Lock
+import json
+import os
+
+
+def fingerprint(record):
+    '''
+        Stable hash of a record, used to tell changed records apart
+    '''
+    return blake2b(json.dumps(record, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+
+class SyncState:
+    '''
+        Watermarks of the incremental syncs, per (kind, site)
+        -------------------------
+        params:
+            Name        | required  | description
+            -----------------------------------------
+            path        |   False   | json file to persist the state, defaults to None (memory only)
+
+        # each entry keeps the watermark (record time in seconds), the fingerprint of the records
+        # inside the overlap window, to skip the ones already yielded, and the start time of the
+        # records still open (e.g. sessions without an end), re-read until they end
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = Lock()
+        self._state = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as fh:
+                self._state = json.load(fh)
+
+    @staticmethod
+    def _key(kind, site):
+        return '%s/%s' % (kind, site)
+
+    def get(self, kind, site):
+        '''
+            returns (watermark, {record id: fingerprint}), watermark is None if never synced
+        '''
+        with self._lock:
+            entry = self._state.get(self._key(kind, site))
+        if entry is None:
+            return None, {}
+        return entry['watermark'], dict(entry['seen'])
+
+    def get_open(self, kind, site):
+        '''
+            returns {record id: record time} of the records open at the last sync
+        '''
+        with self._lock:
+            entry = self._state.get(self._key(kind, site))
+        return {} if entry is None else dict(entry.get('open', {}))
+
+    def set(self, kind, site, watermark, seen, open=None):
+        with self._lock:
+            self._state[self._key(kind, site)] = {'watermark': watermark, 'seen': seen, 'open': open or {}}
+            self._save()
+
+    def reset(self, kind=None, site=None):
+        '''
+            Forget the watermarks (of a kind and/or site), next syncs start from scratch
+        '''
+        with self._lock:
+            for key in list(self._state):
+                key_kind, key_site = key.split('/', 1)
+                if (kind is None or kind == key_kind) and (site is None or site == key_site):
+                    del self._state[key]
+            self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as fh:
+            json.dump(self._state, fh)
+        os.replace(tmp, self.path)
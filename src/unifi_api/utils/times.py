@@ -0,0 +1,34 @@
+# time helpers shared by the stats calls
+from datetime import datetime
+
+
+def timestamp_ms(value):
+    '''
+        Convert a unix timestamp in seconds or a datetime to a timestamp in milliseconds
+    '''
+    if isinstance(value, datetime):
+        return int(value.timestamp()*1000)
+    return int(value*1000)
+
+
+def time_range(start, end, def_range):
+    '''
+        Resolve the (start, end) range of a stats call in milliseconds
+        end defaults to now and start to `end - def_range` (def_range in milliseconds)
+    '''
+    end = int(datetime.now().timestamp()*1000) if end is None else timestamp_ms(end)
+    start = end - def_range if start is None else timestamp_ms(start)
+    assert 0 < start < end, 'start must be before end (and both positive)'
+    return start, end
+
+
+def split_range(start, end, step):
+    '''
+        Split the inclusive range start..end (milliseconds) into inclusive chunks aligned to multiples of `step`
+    '''
+    chunks = []
+    while start <= end:
+        boundary = start - start % step + step
+        chunks.append((start, min(boundary - 1, end)))
+        start = boundary
+    return chunks
@@ -0,0 +1,236 @@
+# columnar results for stat/report calls
+from array import array
+from bisect import bisect_left
+from operator import gt
+import math
+
+NAN = float('nan')
+
+
+class TimeSeries:
+    '''
+        Columnar stats report
+        -------------------------
+        one compact array per attribute instead of a dict per bucket:
+            time         -> array('q') of timestamps in milliseconds
+            numeric attr -> array('d'), missing values are NaN
+            string attr  -> array('l') of codes into `labels[attr]` (e.g. the `ap` of multi ap reports)
+
+        # build it with `from_records` from any iterable of report records (e.g. a streamed response)
+        # `to_numpy`/`to_pandas` share the array buffers, numpy and pandas are optional
+    '''
+    __slots__ = ('time', 'columns', 'labels')
+
+    def __init__(self, time=None, columns=None, labels=None):
+        self.time = array('q') if time is None else time
+        self.columns = {} if columns is None else columns
+        self.labels = {} if labels is None else labels
+
+    @classmethod
+    def from_records(cls, records):
+        '''
+            returns a TimeSeries from an iterable of report records (dicts with a `time` key)
+        '''
+        series = cls()
+        time = series.time
+        columns = series.columns
+        labels = series.labels
+        codes = {}
+        n = 0
+        for record in records:
+            time.append(int(record['time']))
+            for key, value in record.items():
+                if key == 'time':
+                    continue
+                column = columns.get(key)
+                if column is None:
+                    # columns appearing late are backfilled with missing values
+                    if isinstance(value, str):
+                        column = columns[key] = array('l', [-1]*n)
+                        labels[key] = []
+                        codes[key] = {}
+                    else:
+                        column = columns[key] = array('d', [NAN]*n)
+                if key in labels:
+                    code = codes[key].get(value)
+                    if code is None:
+                        code = codes[key][value] = len(labels[key])
+                        labels[key].append(value)
+                    column.append(code)
+                else:
+                    column.append(value if isinstance(value, (int, float)) else NAN)
+            n += 1
+            # keys missing from this record
+            for key, column in columns.items():
+                if len(column) < n:
+                    column.append(-1 if key in labels else NAN)
+        return series
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, attr):
+        if attr == 'time':
+            return self.time
+        return self.columns[attr]
+
+    def __contains__(self, attr):
+        return attr == 'time' or attr in self.columns
+
+    def __repr__(self):
+        return '<TimeSeries %d buckets: %s>' % (len(self), ', '.join(['time'] + list(self.columns)))
+
+    @property
+    def attrs(self):
+        return list(self.columns)
+
+    def values(self, attr):
+        '''
+            returns the values of a string attribute (decoded from its codes)
+        '''
+        names = self.labels[attr]
+        return [names[code] if code >= 0 else None for code in self.columns[attr]]
+
+    def _numeric(self, attr=None):
+        attrs = [a for a in self.columns if a not in self.labels] if attr is None else [attr]
+        assert all(a not in self.labels for a in attrs), 'only numeric attributes can be aggregated'
+        return attrs
+
+    def _aggregate(self, attr, fn):
+        # fn(values, sum) runs on the whole array, only columns with gaps are filtered first
+        results = {}
+        for a in self._numeric(attr):
+            values, total = _present(self.columns[a])
+            results[a] = fn(values, total) if values else NAN
+        return results if attr is None else results[attr]
+
+    def sum(self, attr=None):
+        '''
+            returns the sum of an attribute (or a dict attr -> sum of every numeric attr), missing values are skipped
+        '''
+        return self._aggregate(attr, _sum)
+
+    def mean(self, attr=None):
+        '''
+            returns the mean of an attribute (or a dict attr -> mean of every numeric attr), missing values are skipped
+        '''
+        return self._aggregate(attr, _mean)
+
+    def min(self, attr=None):
+        '''
+            returns the min of an attribute (or a dict attr -> min of every numeric attr), missing values are skipped
+        '''
+        return self._aggregate(attr, lambda values, total: min(values))
+
+    def max(self, attr=None):
+        '''
+            returns the max of an attribute (or a dict attr -> max of every numeric attr), missing values are skipped
+        '''
+        return self._aggregate(attr, lambda values, total: max(values))
+
+    def rate(self, attr):
+        '''
+            returns an array('d') with the per second rate of a per bucket counter (e.g. bytes)
+            the first bucket uses the interval of the second one
+        '''
+        self._numeric(attr)
+        column = self.columns[attr]
+        time = self.time
+        rates = array('d')
+        for i in range(len(time)):
+            if len(time) < 2:
+                rates.append(NAN)
+                continue
+            interval = (time[i] - time[i-1]) if i else (time[1] - time[0])
+            rates.append(column[i] * 1000 / interval if interval > 0 else NAN)
+        return rates
+
+    def resample(self, interval, how='sum'):
+        '''
+            returns a new TimeSeries with buckets of `interval` milliseconds, numeric attributes
+            are aggregated with `how` (sum or mean), string attributes are dropped
+        '''
+        assert how in ('sum', 'mean'), 'how must be sum or mean'
+        fn = _sum if how == 'sum' else _mean
+        attrs = self._numeric()
+        time = self.time
+        columns = {a: self.columns[a] for a in attrs}
+        if any(map(gt, time, time[1:])):
+            # buckets are aggregated as slices of rows sorted by time
+            order = sorted(range(len(time)), key=time.__getitem__)
+            time = array('q', map(time.__getitem__, order))
+            columns = {a: array('d', map(column.__getitem__, order)) for a, column in columns.items()}
+        series = TimeSeries(array('q'), {a: array('d') for a in attrs})
+        start = 0
+        while start < len(time):
+            bucket = time[start] - time[start] % interval
+            end = bisect_left(time, bucket + interval, start + 1)
+            series.time.append(bucket)
+            for a, column in columns.items():
+                values, total = _present(column[start:end])
+                series.columns[a].append(fn(values, total) if values else NAN)
+            start = end
+        return series
+
+    def split(self, attr):
+        '''
+            returns a dict of value -> TimeSeries for each value of a string attribute (e.g. `ap`)
+        '''
+        rows = {}
+        for i, code in enumerate(self.columns[attr]):
+            rows.setdefault(code, []).append(i)
+        parts = {}
+        for code, idx in rows.items():
+            columns = {}
+            labels = {}
+            for a, column in self.columns.items():
+                if a == attr:
+                    continue
+                columns[a] = array(column.typecode, [column[i] for i in idx])
+                if a in self.labels:
+                    labels[a] = self.labels[a]
+            parts[self.labels[attr][code] if code >= 0 else None] = TimeSeries(array('q', [self.time[i] for i in idx]), columns, labels)
+        return parts
+
+    def to_numpy(self):
+        '''
+            returns a dict attr -> numpy array (sharing the memory of the columns)
+        '''
+        import numpy
+        arrays = {'time': numpy.frombuffer(self.time, dtype=numpy.int64)}
+        for a, column in self.columns.items():
+            arrays[a] = numpy.frombuffer(column, dtype=numpy.float64 if column.typecode == 'd' else numpy.dtype('l'))
+        return arrays
+
+    def to_pandas(self):
+        '''
+            returns a pandas DataFrame indexed by bucket time, string attributes are categoricals
+        '''
+        import pandas
+        arrays = self.to_numpy()
+        index = pandas.to_datetime(arrays.pop('time'), unit='ms')
+        data = {}
+        for a, values in arrays.items():
+            if a in self.labels:
+                data[a] = pandas.Categorical.from_codes(values, categories=self.labels[a])
+            else:
+                data[a] = values
+        return pandas.DataFrame(data, index=index, copy=False)
+
+
+def _present(column):
+    # returns (values, their sum) without the missing values, NaN: the only value not equal to
+    # itself, and the sum of a column with gaps
+    total = sum(column)
+    if total != total:
+        column = array('d', [v for v in column if v == v])
+        total = sum(column)
+    return column, total
+
+
+def _sum(values, total):
+    return total
+
+
+def _mean(values, total):
+    return total / len(values)
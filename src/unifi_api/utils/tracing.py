@@ -0,0 +1,131 @@
+# tracing hooks, spans of the phases of each call
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+import time
+
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# current (tracer, span) of each thread/task
+_current = ContextVar('unifi_api_span', default=(None, None))
+
+
+class Span:
+    '''
+        Timed phase of a call
+        -------------------------
+        name        | request, wait, connect, read, decode, validate, relogin, find_device, device_index, site
+        parent      | enclosing Span or None
+        attributes  | dict, e.g. method, endpoint, url, site, status
+        start, end  | time.perf_counter() values, end is None while running
+        error       | exception that ended the span, if any
+        context     | free slot for the tracer (e.g. its own span object)
+    '''
+    __slots__ = ('name', 'parent', 'attributes', 'start', 'end', 'error', 'context')
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.parent = parent
+        self.attributes = {} if attributes is None else attributes
+        self.start = time.perf_counter()
+        self.end = None
+        self.error = None
+        self.context = None
+
+    @property
+    def duration(self):
+        return None if self.end is None else self.end - self.start
+
+    def __repr__(self):
+        return '<Span %s %s>' % (self.name, '%.6fs' % self.duration if self.end is not None else 'running')
+
+
+class Tracer:
+    '''
+        Tracing hooks, subclass it and set it as the `tracer` of a session
+        -------------------------
+        `span_started(span)` and `span_ended(span)` are called from the thread running the phase,
+        spans of a call nest through `span.parent`, also across the worker threads of `for_each_site`
+        and chunked reports (the current span is a contextvar)
+
+        # hooks run inline, keep them cheap
+    '''
+    def span_started(self, span):
+        pass
+
+    def span_ended(self, span):
+        pass
+
+
+class RecordingTracer(Tracer):
+    '''
+        Tracer keeping the ended spans in `spans`, handy for tests and debugging
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self.spans = []
+
+    def span_ended(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def named(self, name):
+        return [s for s in self.spans if s.name == name]
+
+
+def current_span():
+    return _current.get()[1]
+
+
+def current_tracer():
+    return _current.get()[0]
+
+
+@contextmanager
+def span(tracer, name, **attributes):
+    '''
+        Run the block inside a new span, child of the current span
+    '''
+    s = Span(name, current_span(), attributes)
+    tracer.span_started(s)
+    token = _current.set((tracer, s))
+    try:
+        yield s
+    except BaseException as e:
+        s.error = e
+        raise
+    finally:
+        _current.reset(token)
+        s.end = time.perf_counter()
+        tracer.span_ended(s)
+
+
+# connections opened while a span is running report a `connect` span (tcp + tls)
+class _TracedHTTPConnection(HTTPConnection):
+    def connect(self):
+        tracer = current_tracer()
+        if tracer is None:
+            return super().connect()
+        with span(tracer, 'connect', host=self.host, port=self.port):
+            return super().connect()
+
+
+class _TracedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        tracer = current_tracer()
+        if tracer is None:
+            return super().connect()
+        with span(tracer, 'connect', host=self.host, port=self.port, tls=True):
+            return super().connect()
+
+
+class _TracedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TracedHTTPConnection
+
+
+class _TracedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TracedHTTPSConnection
+
+
+TRACED_POOL_CLASSES = {'http': _TracedHTTPConnectionPool, 'https': _TracedHTTPSConnectionPool}
@@ -0,0 +1,116 @@
+# presence watcher: diff of consecutive client/device polls
+from collections import namedtuple
+import time
+
+# event kinds
+JOIN = 'join'
+LEAVE = 'leave'
+ROAM = 'roam'
+IP_CHANGE = 'ip_change'
+STATE_CHANGE = 'state_change'
+
+# kind:   one of the kinds above
+# target: 'client' or 'device'
+# old/new: previous and current value of the changed field,
+#          for join/leave the dict of watched fields (new/old) and None
+Event = namedtuple('Event', ['kind', 'target', 'site', 'mac', 'old', 'new'])
+
+
+def diff(previous, current, watched):
+    '''
+        Diff two snapshots (mac -> tuple of watched values)
+        -------------------------
+        returns a list of (kind, mac, old, new), one pass over each snapshot
+        params:
+            Name        | required  | description
+            -----------------------------------------
+            previous    |   True    | snapshot of the last poll
+            current     |   True    | snapshot of this poll
+            watched     |   True    | ((field, event kind), ...) in the order of the snapshot tuples
+    '''
+    changes = []
+    for mac, values in current.items():
+        old = previous.get(mac)
+        if old is None:
+            changes.append((JOIN, mac, None, dict(zip((f for f, _ in watched), values))))
+        elif old != values:
+            for i, (field, kind) in enumerate(watched):
+                if old[i] != values[i]:
+                    changes.append((kind, mac, old[i], values[i]))
+    for mac, values in previous.items():
+        if mac not in current:
+            changes.append((LEAVE, mac, dict(zip((f for f, _ in watched), values)), None))
+    return changes
+
+
+class Watcher:
+    '''
+        Stateful watcher of the clients and devices of a site
+        -------------------------
+        each `poll` fetches the site, diffs it against the previous poll and returns the events
+        params:
+            Name        | required  | description
+            -----------------------------------------
+            client      |   True    | UnifiClient
+            site        |   False   | site name, defaults to `default`
+            clients     |   False   | watch online clients (join, leave, roam, ip_change), defaults to True
+            devices     |   False   | watch devices (join, leave, state_change), defaults to True
+
+        # only the watched fields of each entry are kept, responses are streamed into the snapshot
+        # the first poll reports every client/device as a join
+        # a failed fetch skips the diff, so it doesn't report everything as gone
+    '''
+    # field -> event kind, extend to watch more fields
+    client_fields = (('ap_mac', ROAM), ('ip', IP_CHANGE))
+    device_fields = (('state', STATE_CHANGE), )
+
+    def __init__(self, client, site='default', clients=True, devices=True):
+        self.client = client
+        self.site = site
+        self.clients = None if clients else False
+        self.devices = None if devices else False
+
+    def _snapshot(self, fetch, fields):
+        with self.client.streaming():
+            data = fetch()
+            if data is False:
+                return None
+            return {item['mac']: tuple(item.get(f) for f, _ in fields) for item in data}
+
+    def _poll(self, target, previous, fetch, fields):
+        current = self._snapshot(fetch, fields)
+        if current is None:
+            return previous, []
+        events = [Event(kind, target, self.site, mac, old, new) for kind, mac, old, new in diff(previous or {}, current, fields)]
+        return current, events
+
+    def poll(self):
+        '''
+            returns the list of events since the previous poll
+        '''
+        events = []
+        if self.clients is not False:
+            self.clients, found = self._poll(
+                'client', self.clients, lambda: self.client.list_online_clients(site=self.site), self.client_fields,
+            )
+            events.extend(found)
+        if self.devices is not False:
+            self.devices, found = self._poll(
+                'device', self.devices, lambda: self.client.stat_device(self.site), self.device_fields,
+            )
+            events.extend(found)
+        return events
+
+    def events(self, interval=10, stop=None):
+        '''
+            Poll every `interval` seconds and yield the events, until `stop` (a threading.Event) is set
+        '''
+        while stop is None or not stop.is_set():
+            started = time.monotonic()
+            for event in self.poll():
+                yield event
+            wait = max(0, interval - (time.monotonic() - started))
+            if stop is None:
+                time.sleep(wait)
+            elif stop.wait(wait):
+                break
@@ -1,18 +1,30 @@
 import json
-import sys
 from os.path import isfile, dirname, join as pjoin
+import tempfile
 import unittest
 
 from unifi_api import UnifiClient
+from unifi_api.fake_controller import FakeController
+from unifi_api.utils.cookie_store import FileCookieStore
 
+# run against a real controller if there's a configuration file (tests/config.json),
+# otherwise against the bundled fake controller
 config_file = pjoin(dirname(__file__), 'config.json')
-if not isfile(config_file):
-    print('Need configuration file (tests/config.json)')
-    sys.exit(1)
-
 config = None
-with open(config_file, 'r') as fh:
-    config = json.load(fh)
+if isfile(config_file):
+    with open(config_file, 'r') as fh:
+        config = json.load(fh)
+
+def setUpModule():
+    global config, controller
+    controller = None
+    if config is None:
+        controller = FakeController(sites=2, devices=5, clients=50, cookie_ttl=60).start()
+        config = {'base_url': controller.url, 'username': 'admin', 'password': 'admin'}
+
+def tearDownModule():
+    if controller is not None:
+        controller.stop()
 
 class TestAbstractUnifiSession(unittest.TestCase):
     def test_login(self):
@@ -20,5 +32,74 @@ class TestAbstractUnifiSession(unittest.TestCase):
         client.login()
         self.assertEqual(True, client.logged_in)
 
+    def test_list_sites(self):
+        client = UnifiClient(**config)
+        sites = client.list_sites()
+        self.assertIn('default', [s['name'] for s in sites])
+
+    def test_find_device(self):
+        client = UnifiClient(**config)
+        for site in client.list_sites():
+            devices = client.list_devices(site=site['name'])
+            if devices:
+                self.assertEqual(site['name'], client.find_device(devices[0]['mac']))
+                break
+
+@unittest.skipIf(config is not None, 'needs the fake controller')
+class TestFakeController(unittest.TestCase):
+    def test_expired_cookie(self):
+        client = UnifiClient(**config)
+        client.login()
+        logins = controller.stats['logins']
+        controller.expire_cookies()
+        self.assertEqual(2, len(client.list_sites()))
+        self.assertEqual(logins + 1, controller.stats['logins'])
+
+    def test_reports(self):
+        client = UnifiClient(**config)
+        records = client.site_stat_hourly(site='site1')
+        self.assertEqual(7*24, len(records))
+        self.assertEqual(records, client.site_stat_hourly(start=records[0]['time'] / 1000, end=records[-1]['time'] / 1000, site='site1'))
+        self.assertEqual(5*len(records), len(client.ap_stat_hourly(site='site1')))
+
+    def test_speedtests_and_macs(self):
+        client = UnifiClient(**config)
+        results = client.speedtest_result(site='site1')
+        self.assertEqual(24, len(results))
+        self.assertEqual({'time', 'xput_download', 'xput_upload', 'latency'}, set(results[0]))
+        # the client sends macs uppercase
+        session = client.list_sessions(site='site1')[0]
+        sessions = client.list_sessions(client_mac=session['mac'].upper(), site='site1')
+        self.assertTrue(sessions)
+        self.assertEqual({session['mac']}, {s['mac'] for s in sessions})
+        device = client.list_devices(site='site1')[0]
+        self.assertEqual([device['mac']], [d['mac'] for d in client.list_devices(site='site1', device_mac=device['mac'].upper())])
+
+    def test_failures(self):
+        with FakeController(failure_rate=1) as failing:
+            client = UnifiClient(failing.url, username='admin', password='admin', retries=2)
+            self.assertIs(False, client.list_sites())
+            self.assertEqual(3, failing.stats['failures'])
+
+    def test_cookie_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = FileCookieStore(pjoin(tmp, 'cookies.json'))
+            first = UnifiClient(**config, cookie_store=store)
+            first.login()
+            logins = controller.stats['logins']
+            # a new session (e.g. another worker) reuses the stored login
+            second = UnifiClient(**config, cookie_store=store)
+            self.assertEqual(2, len(second.list_sites()))
+            self.assertEqual(logins, controller.stats['logins'])
+            # an expired cookie logs in once, the other sessions pick up the new cookie
+            controller.expire_cookies()
+            self.assertEqual(2, len(second.list_sites()))
+            self.assertEqual(logins + 1, controller.stats['logins'])
+            self.assertEqual(2, len(first.list_sites()))
+            self.assertEqual(logins + 1, controller.stats['logins'])
+            self.assertEqual(second.session_cookie().value, first.session_cookie().value)
+            first.logout()
+            self.assertIsNone(store.load(store.key(config['base_url'], 'admin')))
+
 if __name__ == '__main__':
     unittest.main()
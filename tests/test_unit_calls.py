@@ -1,6 +1,7 @@
 import sys
 import unittest
 import json
+import time
 
 import requests
 import urllib3
@@ -11,6 +12,29 @@ from unifi_api.base_api import AbstractUnifiSession
 from unifi_api.utils import models
 from unifi_api.utils.decorators import requires_login, call_requires_login
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pandas
+except ImportError:
+    pandas = None
+try:
+    from aiohttp import web
+    from unifi_api.async_api import AsyncUnifiClient
+except ImportError:
+    web = None
+
+
+def make_response(method, url, body=json.dumps({}), headers={}, status=200):
+    from io import BytesIO
+    req = requests.Request(method.upper(), url).prepare()
+    body_stream = BytesIO(body) if isinstance(body, bytes) else BytesIO(body.encode())
+    headers = urllib3.response.HTTPHeaderDict(headers)
+    resp = urllib3.HTTPResponse(body_stream, headers, status, preload_content=False)
+    return requests.adapters.HTTPAdapter().build_response(req, resp)
+
 
 class BaseTestCase(unittest.TestCase):
     def assertNotRaises(self, ex_cls, fn, *args, **kwargs):
@@ -111,14 +135,6 @@ class TestAbstractUnifiSession(BaseTestCase):
         # other endpoints
 
     def test_process_response(self):
-        def make_response(method, url, body=json.dumps({}), headers={}, status=200):
-            from io import BytesIO
-            req = requests.Request(method.upper(), url).prepare()
-            body_stream = BytesIO(body) if isinstance(body, bytes) else BytesIO(body.encode())
-            headers = urllib3.response.HTTPHeaderDict(headers)
-            resp = urllib3.HTTPResponse(body_stream, headers, status, preload_content=False)
-            return requests.adapters.HTTPAdapter().build_response(req, resp)
-
         instance = AbstractUnifiSession("https://example.com", debug=True)
         self.setup_output_test()
         resp_not_json_header = make_response('POST', 'https://example.com')
@@ -146,10 +162,1324 @@ class TestAbstractUnifiSession(BaseTestCase):
 
         self.finish_output_test()
 
+class TestConnectionPool(BaseTestCase):
+    def setUp(self):
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                body = json.dumps({'data': [], 'meta': {'rc': 'ok'}}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pool_options(self):
+        instance = TAbstractUnifiSession(self.url, pool_maxsize=4, retries=2, backoff_factor=0.5)
+        adapter = instance.session.get_adapter(self.url)
+        self.assertEqual(4, adapter._pool_maxsize)
+        self.assertEqual(2, adapter.max_retries.total)
+        self.assertRaises(t.DataError, TAbstractUnifiSession, self.url, pool_maxsize=0)
+
+    def test_keep_alive_and_stats(self):
+        instance = TAbstractUnifiSession(self.url, username='aaa', password='bbb')
+        instance.session.cookies.set('unifises', 'cookie')
+        for i in range(3):
+            instance.get(instance.endpoint('/api/self/sites'))
+        stats = instance.pool_stats()[self.url]
+        self.assertEqual({'maxsize': 10, 'connections': 1, 'requests': 3, 'idle': 1, 'in_use': 0}, stats)
+
+        instance = TAbstractUnifiSession(self.url, keep_alive=False)
+        self.assertEqual('close', instance.session.headers['Connection'])
+
+
+class TestSingleFlightLogin(BaseTestCase):
+    def test_concurrent_relogin(self):
+        import threading
+        import time
+
+        class FakeSession(requests.Session):
+            valid_cookie = 'expected'
+            def request(self, method, url, **kwargs):
+                if self.cookies.get('unifises') == self.valid_cookie:
+                    return make_response('GET', url, body=json.dumps({'data': [], 'meta': {'rc': 'ok'}}), headers={'content-type': 'application/json'})
+                body = json.dumps({'data': [], 'meta': {'rc': 'error', 'msg': 'api.err.LoginRequired'}})
+                return make_response('GET', url, body=body, headers={'content-type': 'application/json'}, status=401)
+
+        class Session(TAbstractUnifiSession):
+            logins = 0
+            def clean_session(self):
+                self._session = FakeSession()
+            def login(self, username=None, password=None):
+                time.sleep(0.05)
+                self.logins += 1
+                self.session.valid_cookie = 'cookie%d' % self.logins
+                self.session.cookies.set('unifises', self.session.valid_cookie)
+                self.login_generation += 1
+                return True
+
+        instance = Session("https://example.com")
+        session = instance.session
+        instance.get('https://example.com/api/self/sites')
+        self.assertEqual(1, instance.logins)
+
+        # expire the session on the controller side
+        session.valid_cookie = 'expected'
+        statuses = []
+        threads = [threading.Thread(target=lambda: statuses.append(instance.get('https://example.com/api/self/sites').status_code)) for _ in range(10)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        self.assertEqual([200]*10, statuses)
+        self.assertEqual(2, instance.logins)
+        # the pooled session was kept
+        self.assertIs(session, instance.session)
+
+
+class TestFindDevice(BaseTestCase):
+    def make_client(self):
+        client = UnifiClient("https://example.com")
+        client.session.cookies.set('unifises', 'cookie')
+        client.calls = []
+        devices = {
+            'site1': [{'mac': 'aa:bb:cc:dd:ee:01'}],
+            'site2': [{'mac': 'aa:bb:cc:dd:ee:02'}, {'mac': 'AA-BB-CC-DD-EE-03'}],
+        }
+        def list_sites():
+            client.calls.append('sites')
+            return [{'name': name} for name in devices]
+        def list_devices(site='default'):
+            client.calls.append(site)
+            return devices[site]
+        client.list_sites = list_sites
+        client.list_devices = list_devices
+        client.devices = devices
+        return client
+
+    def test_index_built_once(self):
+        client = self.make_client()
+        self.assertEqual('site1', client.find_device('AA:BB:CC:DD:EE:01'))
+        self.assertEqual('site2', client.find_device('aa-bb-cc-dd-ee-03'))
+        self.assertEqual(['site1', 'site2', 'sites'], sorted(client.calls))
+
+    def test_index_partial(self):
+        client = self.make_client()
+        client.build_device_index()
+        list_devices = client.list_devices
+        def failing(site='default'):
+            if site == 'site2':
+                raise ValueError('site down')
+            return list_devices(site=site)
+        client.list_devices = failing
+        client.devices['site1'].append({'mac': 'aa:bb:cc:dd:ee:04'})
+        index = client.build_device_index()
+        self.assertEqual(['site2'], list(client.device_index_errors))
+        # site2 keeps the devices of the previous index
+        self.assertEqual({'AA:BB:CC:DD:EE:0%d' % i: site for i, site in ((1, 'site1'), (2, 'site2'), (3, 'site2'), (4, 'site1'))}, index)
+        self.assertEqual('site1', client.find_device('AA:BB:CC:DD:EE:04'))
+
+        # a site answering False is a failure too, not an empty site
+        from unifi_api.utils.exceptions import UnifiCallFailed
+        client.list_devices = lambda site='default': False if site == 'site1' else list_devices(site=site)
+        index = client.build_device_index()
+        self.assertEqual(['site1'], list(client.device_index_errors))
+        self.assertIsInstance(client.device_index_errors['site1'], UnifiCallFailed)
+        self.assertEqual('site1', index['AA:BB:CC:DD:EE:04'])
+
+    def test_index_miss_and_invalidate(self):
+        client = self.make_client()
+        client.device_index_miss_interval = 0
+        self.assertEqual(None, client.find_device('AA:BB:CC:DD:EE:04'))
+        self.assertEqual(3, len(client.calls))
+        client.devices['site1'].append({'mac': 'aa:bb:cc:dd:ee:04'})
+        self.assertEqual('site1', client.find_device('AA:BB:CC:DD:EE:04'))
+        self.assertEqual(6, len(client.calls))
+        # hits don't rebuild the index
+        client.find_device('AA:BB:CC:DD:EE:04')
+        self.assertEqual(6, len(client.calls))
+
+        client.calls.clear()
+        client.invalidate_device_index()
+        client.find_device('AA:BB:CC:DD:EE:01')
+        self.assertEqual(['site1', 'site2', 'sites'], sorted(client.calls))
+
+    def test_index_ttl(self):
+        client = self.make_client()
+        client.find_device('AA:BB:CC:DD:EE:01')
+        client.device_index_ttl = 0
+        client.find_device('AA:BB:CC:DD:EE:01')
+        self.assertEqual(6, len(client.calls))
+
+@unittest.skipIf(web is None, 'aiohttp not installed')
+class TestAsyncUnifiClient(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.logins = 0
+        self.valid_cookie = None
+
+        async def login(request):
+            self.logins += 1
+            self.valid_cookie = 'cookie%d' % self.logins
+            resp = web.json_response({'data': [], 'meta': {'rc': 'ok'}})
+            resp.set_cookie('unifises', self.valid_cookie)
+            return resp
+
+        async def sites(request):
+            if request.cookies.get('unifises') != self.valid_cookie:
+                return web.json_response({'data': [], 'meta': {'rc': 'error', 'msg': 'api.err.LoginRequired'}}, status=401)
+            return web.json_response({'data': [{'name': 'default'}], 'meta': {'rc': 'ok'}})
+
+        app = web.Application()
+        app.router.add_post('/api/login', login)
+        app.router.add_get('/api/self/sites', sites)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.client = AsyncUnifiClient('http://127.0.0.1:%d' % port, username='aaa', password='bbb')
+
+    async def asyncTearDown(self):
+        await self.client.close_session()
+        await self.runner.cleanup()
+
+    async def test_login_and_call(self):
+        self.assertEqual([{'name': 'default'}], await self.client.list_sites())
+        self.assertEqual(True, self.client.logged_in)
+        self.assertEqual(1, self.logins)
+
+    async def test_sync_only_params(self):
+        for option in ({'coalesce': True}, {'cache': None}, {'pool_maxsize': 2}):
+            with self.assertRaises(TypeError):
+                AsyncUnifiClient('http://127.0.0.1', **option)
+
+    async def test_concurrent_relogin(self):
+        import asyncio
+        await self.client.list_sites()
+        # expire the session on the controller side
+        self.valid_cookie = None
+        results = await asyncio.gather(*[self.client.list_sites() for _ in range(20)])
+        self.assertEqual([[{'name': 'default'}]]*20, results)
+        self.assertEqual(2, self.logins)
+
+class TestForEachSite(BaseTestCase):
+    def test_fanout(self):
+        import threading
+        import time
+        from unifi_api.utils.exceptions import UnifiSiteErrors
+
+        client = UnifiClient("https://example.com")
+        client.session.cookies.set('unifises', 'cookie')
+        client.list_sites = lambda: [{'name': 'site%d' % i} for i in range(8)]
+        barrier = threading.Barrier(4, timeout=5)
+        def stat(site, extra):
+            # fails unless 4 calls run at the same time
+            barrier.wait()
+            if site == 'site3':
+                raise ValueError(site)
+            return site + extra
+        errors = {}
+        results = dict(client.for_each_site(stat, max_workers=4, errors=errors, extra='!'))
+        self.assertEqual(7, len(results))
+        self.assertEqual('site0!', results['site0'])
+        self.assertEqual(['site3'], list(errors))
+        self.assertIsInstance(errors['site3'], ValueError)
+
+        barrier.reset()
+        with self.assertRaises(UnifiSiteErrors) as ctx:
+            list(client.for_each_site(stat, sites=['site%d' % i for i in range(4)], max_workers=4, extra=''))
+        self.assertEqual(['site3'], list(ctx.exception.errors))
+
+class TestStamgrBatch(BaseTestCase):
+    def test_batch(self):
+        client = UnifiClient("https://example.com")
+        client.session.cookies.set('unifises', 'cookie')
+        client.find_device = lambda mac: 'site2'
+        sent = []
+        def stamgr(site, data):
+            if site == 'broken':
+                raise ValueError(site)
+            sent.append((site, data))
+            return data['cmd'] != 'block-sta'
+        client._stamgr = stamgr
+
+        results = client.stamgr_batch([
+            ('authorize-guest', 'aa-bb-cc-dd-ee-01', 'site1', {'minutes': 60, 'up': 100}),
+            ('forget-sta', 'aa:bb:cc:dd:ee:02', 'site1', None),
+            ('forget-sta', 'aa:bb:cc:dd:ee:03', 'site1', None),
+            ('block-sta', 'aa:bb:cc:dd:ee:04', None, None),
+            ('kick-sta', 'aa:bb:cc:dd:ee:05', None, {'ap_mac': 'aa:bb:cc:dd:ee:ff'}),
+            ('kick-sta', 'aa:bb:cc:dd:ee:06', 'broken', None),
+        ], max_workers=2)
+
+        self.assertEqual(True, results['AA:BB:CC:DD:EE:01'])
+        self.assertEqual(True, results['AA:BB:CC:DD:EE:03'])
+        self.assertEqual(False, results['AA:BB:CC:DD:EE:04'])
+        self.assertEqual(True, results['AA:BB:CC:DD:EE:05'])
+        self.assertIsInstance(results['AA:BB:CC:DD:EE:06'], ValueError)
+        self.assertIn(('site1', {'cmd': 'authorize-guest', 'mac': 'aa:bb:cc:dd:ee:01', 'minutes': 60, 'up': 100}), sent)
+        self.assertIn(('site1', {'cmd': 'forget-sta', 'mac': ['AA:BB:CC:DD:EE:02', 'AA:BB:CC:DD:EE:03']}), sent)
+        self.assertIn(('default', {'cmd': 'block-sta', 'mac': 'aa:bb:cc:dd:ee:04'}), sent)
+        self.assertIn(('site2', {'cmd': 'kick-sta', 'mac': 'aa:bb:cc:dd:ee:05', 'ap_mac': 'AA:BB:CC:DD:EE:FF'}), sent)
+
+    def test_batch_validated_up_front(self):
+        client = UnifiClient("https://example.com")
+        client.session.cookies.set('unifises', 'cookie')
+        sent = []
+        client._stamgr = lambda site, data: sent.append(data)
+        with self.assertRaises(t.DataError):
+            client.stamgr_batch([
+                ('kick-sta', 'aa:bb:cc:dd:ee:01', 'site1', None),
+                ('kick-sta', 'not a mac', 'site1', None),
+            ])
+        self.assertEqual([], sent)
+
+class TestResponseCache(BaseTestCase):
+    def make_session(self, cache):
+        instance = TAbstractUnifiSession("https://example.com", cache=cache)
+        instance.session.cookies.set('unifises', 'cookie')
+        instance.sent = []
+        def request(method, url, **kwargs):
+            instance.sent.append((method, url))
+            body = json.dumps({'data': [len(instance.sent)], 'meta': {'rc': 'ok'}})
+            return make_response(method, url, body=body, headers={'content-type': 'application/json'})
+        instance.session.request = request
+        return instance
+
+    def test_cached_reads(self):
+        from unifi_api.utils.cache import ResponseCache
+        cache = ResponseCache()
+        instance = self.make_session(cache)
+        url = instance.endpoint('/api/s/site1/stat/device')
+
+        self.assertEqual([1], instance.process_response(instance.post(url, json={'macs': None})))
+        self.assertEqual([1], instance.process_response(instance.post(url, json={'macs': None})))
+        # different body, different key
+        self.assertEqual([2], instance.process_response(instance.post(url, json={'macs': ['aa']})))
+        # not a cached endpoint
+        instance.get(instance.endpoint('/api/s/site1/list/user'))
+        instance.get(instance.endpoint('/api/s/site1/list/user'))
+        self.assertEqual(4, len(instance.sent))
+        self.assertEqual({'hits': 1, 'misses': 2, 'evictions': 0, 'entries': 2}, {k: v for k, v in cache.stats().items() if k != 'bytes'})
+
+    def test_errors_and_reports_not_cached(self):
+        from unifi_api.utils.cache import ResponseCache
+        cache = ResponseCache()
+        instance = self.make_session(cache)
+        request = instance.session.request
+        def failing(method, url, **kwargs):
+            instance.sent.append((method, url))
+            body = json.dumps({'meta': {'rc': 'error', 'msg': 'api.err.Busy'}, 'data': []})
+            return make_response(method, url, body=body, headers={'content-type': 'application/json'})
+        instance.session.request = failing
+        url = instance.endpoint('/api/s/site1/stat/device')
+        self.assertFalse(instance.process_response(instance.get(url)))
+        instance.session.request = request
+        self.assertEqual([2], instance.process_response(instance.get(url)))
+        self.assertEqual([2], instance.process_response(instance.get(url)))
+        report = instance.endpoint('/api/s/site1/stat/report/hourly.site')
+        instance.post(report, json={'end': 1})
+        instance.post(report, json={'end': 1})
+        self.assertEqual(4, len(instance.sent))
+        self.assertIsNone(cache.ttl(report))
+
+    def test_write_invalidates_site(self):
+        from unifi_api.utils.cache import ResponseCache
+        cache = ResponseCache()
+        instance = self.make_session(cache)
+        site1 = instance.endpoint('/api/s/site1/stat/sta')
+        site2 = instance.endpoint('/api/s/site2/stat/sta')
+        instance.get(site1)
+        instance.get(site2)
+        instance.post(instance.endpoint('/api/s/site1/cmd/stamgr'), json={'cmd': 'kick-sta'})
+        instance.get(site1)
+        instance.get(site2)
+        self.assertEqual(['/api/s/site1/stat/sta', '/api/s/site2/stat/sta', '/api/s/site1/cmd/stamgr', '/api/s/site1/stat/sta'],
+                         [url[len('https://example.com'):] for method, url in instance.sent])
+
+    def test_ttl_and_lru(self):
+        from unifi_api.utils.cache import ResponseCache
+        instance = self.make_session(ResponseCache(ttls=[(r'/stat/', 0)]))
+        url = instance.endpoint('/api/s/site1/stat/sta')
+        instance.get(url)
+        instance.get(url)
+        self.assertEqual(2, len(instance.sent))
+
+        # room for two bodies
+        cache = ResponseCache(max_bytes=90)
+        instance = self.make_session(cache)
+        for site in ('a', 'b', 'a', 'c', 'a', 'b'):
+            instance.get(instance.endpoint('/api/s/%s/stat/sta' % site))
+        # b was the least recently used when c came in
+        self.assertEqual(['a', 'b', 'c', 'b'], [url.split('/')[-3] for method, url in instance.sent])
+        self.assertEqual(2, cache.evictions)
+        self.assertLessEqual(cache.size, 90)
+
+class TestStreaming(BaseTestCase):
+    def test_iter_members(self):
+        from unifi_api.utils.stream import iter_members
+        doc = json.dumps({'meta': {'rc': 'ok'}, 'data': [{'mac': 'aé', 'n': 12345}, 1.5, [], 'x'], 'extra': 1}).encode()
+        for size in (1, 3, 1000):
+            chunks = [doc[i:i+size] for i in range(0, len(doc), size)]
+            self.assertEqual([
+                ('meta', {'rc': 'ok'}, False),
+                ('data', {'mac': 'aé', 'n': 12345}, True),
+                ('data', 1.5, True),
+                ('data', [], True),
+                ('data', 'x', True),
+                ('extra', 1, False),
+            ], list(iter_members(chunks)))
+        self.assertEqual([('data', 'abc', False)], list(iter_members([b'{"data": "abc"}'])))
+        self.assertEqual([], list(iter_members([b'{}'])))
+        with self.assertRaises(ValueError):
+            list(iter_members([b'{"data": [1, 2']))
+
+    def test_streaming_mode(self):
+        instance = TAbstractUnifiSession("https://example.com")
+        instance.session.cookies.set('unifises', 'cookie')
+        sent = []
+        def request(method, url, **kwargs):
+            sent.append(kwargs)
+            rc = 'error' if url.endswith('error') else 'ok'
+            body = json.dumps({'meta': {'rc': rc, 'msg': 'aaa'}, 'data': [{'i': i} for i in range(1000)]})
+            return make_response(method, url, body=body, headers={'content-type': 'application/json'})
+        instance.session.request = request
+
+        with instance.streaming():
+            records = instance.process_response(instance.get(instance.endpoint('/api/s/default/stat/allusers')))
+            error = instance.process_response(instance.get(instance.endpoint('/api/s/default/error')))
+            ok = instance.process_response(instance.get(instance.endpoint('/api/s/default/cmd/stamgr')), boolean=True)
+        self.assertEqual(True, sent[0]['stream'])
+        self.assertNotIsInstance(records, list)
+        self.assertEqual([{'i': i} for i in range(1000)], list(records))
+        self.assertEqual(False, error)
+        self.assertEqual(True, ok)
+        # outside the block results are lists again
+        self.assertEqual(1000, len(instance.process_response(instance.get(instance.endpoint('/api/s/default/stat/allusers')))))
+        self.assertNotIn('stream', sent[-1])
+
+class TestGuard(BaseTestCase):
+    def tearDown(self):
+        from unifi_api.utils.decorators import set_validation_level
+        set_validation_level('full')
+
+    def make_class(self):
+        from unifi_api.utils.decorators import guard
+        class Guarded:
+            checks = 0
+            @guard(mac=models.MacAddress, n=t.Int, site=t.Or(models.SiteName, t.Atom(None)))
+            def outer(self, mac, n=1, site=None):
+                return self.inner(mac, n)
+            @guard(mac=models.MacAddress, n=t.Int)
+            def inner(self, mac, n):
+                return mac, n
+        return Guarded
+
+    def test_levels(self):
+        from unifi_api.utils.decorators import set_validation_level
+        obj = self.make_class()()
+        self.assertEqual(('AA:BB:CC:DD:EE:FF', 1), obj.outer('aa-bb-cc-dd-ee-ff'))
+        self.assertRaises(t.DataError, obj.outer, 'aa-bb-cc-dd-ee-ff', n='x')
+        self.assertRaises(t.DataError, obj.outer, 'not a mac')
+
+        set_validation_level('types')
+        self.assertEqual(('AA:BB:CC:DD:EE:FF', 2), obj.outer('aa-bb-cc-dd-ee-ff', 2, site='default'))
+        self.assertRaises(t.DataError, obj.outer, 'aa-bb-cc-dd-ee-ff', n='1')
+        self.assertRaises(t.DataError, obj.outer, 'aa-bb-cc-dd-ee-ff', site=1)
+        self.assertRaises(t.DataError, obj.outer, 'not a mac')
+
+        set_validation_level('off')
+        self.assertEqual(('not a mac', '1'), obj.outer('not a mac', '1'))
+        self.assertRaises(AssertionError, set_validation_level, 'bla')
+
+    def test_nested_calls_not_revalidated(self):
+        obj = self.make_class()()
+        # inner alone is validated
+        self.assertRaises(t.DataError, obj.inner, 'aa-bb-cc-dd-ee-ff', 'x')
+        models.normalize_macaddr.cache_clear()
+        obj.outer('aa-bb-cc-dd-ee-ff')
+        obj.outer('aa-bb-cc-dd-ee-ff')
+        info = models.normalize_macaddr.cache_info()
+        # second call hits the memoized normalizer, nested inner call doesn't check again
+        self.assertEqual((1, 1), (info.hits, info.misses))
+
+    def test_nested_calls_with_new_values(self):
+        from unifi_api.utils.decorators import guard, set_validation_level
+        class Guarded:
+            @guard(site=t.String)
+            def outer(self, site):
+                # values built inside the method are checked by the nested guard
+                return self.inner('aa-bb-cc-dd-ee-ff', n=len(site))
+            @guard(mac=models.MacAddress, n=t.Int(gte=2))
+            def inner(self, mac, n):
+                return mac, n
+        obj = Guarded()
+        for level in ('full', 'types'):
+            set_validation_level(level)
+            self.assertEqual(('AA:BB:CC:DD:EE:FF', 7), obj.outer('default'))
+            self.assertRaises(t.DataError, obj.outer, 'x')
+
+    def test_nested_helpers(self):
+        from unittest import mock
+        from unifi_api.utils.decorators import set_validation_level
+        client = UnifiClient("https://example.com")
+        client.session.cookies.set('unifises', 'cookie')
+        def request(method, url, **kwargs):
+            return make_response(method, url, body=json.dumps({'meta': {'rc': 'ok'}, 'data': []}), headers={'content-type': 'application/json'})
+        client.session.request = request
+        set_validation_level('full')
+        check = t.Dict.check
+        with mock.patch.object(t.Dict, 'check', autospec=True, side_effect=check) as checks:
+            # site_stat_5min -> _site_stats, unauthorize_guest -> _guest_cmd
+            client.site_stat_5min(start=1500000000, end=1500003600)
+            self.assertEqual(1, checks.call_count)
+            client.unauthorize_guest('aa:bb:cc:dd:ee:ff')
+            self.assertEqual(2, checks.call_count)
+            # called directly, helpers are checked
+            self.assertRaises(t.DataError, client._guest_cmd, 'unauthorize-guest', 'not a mac', 'default')
+
+    def test_arity(self):
+        client = UnifiClient("https://example.com")
+        client.session.cookies.set('unifises', 'cookie')
+        client.session.request = lambda method, url, **kwargs: self.fail('should not be sent')
+        from unifi_api.utils.decorators import set_validation_level
+        for level in ('full', 'types'):
+            set_validation_level(level)
+            self.assertRaises(TypeError, client.list_devices, 'default', None, 'extra', 'more')
+            self.assertRaises(TypeError, client.list_devices, 'default', site='other')
+            self.assertRaises(TypeError, client.list_devices, unknown=1)
+
+class TestTimeSeries(BaseTestCase):
+    records = [
+        {'time': 0, 'ap': 'aa', 'bytes': 600, 'num_sta': 2},
+        {'time': 0, 'ap': 'bb', 'bytes': 300},
+        {'time': 300000, 'ap': 'aa', 'bytes': 1200, 'num_sta': 4},
+        {'time': 300000, 'ap': 'bb', 'bytes': 0, 'num_sta': 1},
+    ]
+
+    def test_from_records(self):
+        import math
+        from unifi_api.utils.timeseries import TimeSeries
+        series = TimeSeries.from_records(iter(self.records))
+        self.assertEqual(4, len(series))
+        self.assertEqual(['ap', 'bytes', 'num_sta'], series.attrs)
+        self.assertEqual('q', series['time'].typecode)
+        self.assertEqual('d', series['bytes'].typecode)
+        self.assertEqual(['aa', 'bb', 'aa', 'bb'], series.values('ap'))
+        self.assertTrue(math.isnan(series['num_sta'][1]))
+        self.assertEqual({'bytes': 2100, 'num_sta': 7}, series.sum())
+        self.assertEqual(7 / 3, series.mean('num_sta'))
+
+        resampled = series.resample(600000)
+        self.assertEqual([0], list(resampled.time))
+        self.assertEqual([2100], list(resampled['bytes']))
+        per_ap = series.split('ap')
+        self.assertEqual([600, 1200], list(per_ap['aa']['bytes']))
+        self.assertEqual([2, 4], list(per_ap['aa'].rate('bytes')))
+        means = per_ap['aa'].resample(600000, how='mean')
+        self.assertEqual([900], list(means['bytes']))
+        self.assertEqual([3], list(means['num_sta']))
+
+    def test_aggregates(self):
+        import math
+        from unifi_api.utils.timeseries import TimeSeries
+        series = TimeSeries.from_records(self.records)
+        self.assertEqual({'bytes': 0, 'num_sta': 1}, series.min())
+        self.assertEqual(1200, series.max('bytes'))
+        self.assertTrue(math.isnan(TimeSeries.from_records([{'time': 0, 'x': None}]).mean('x')))
+        # unsorted rows are resampled by time
+        shuffled = TimeSeries.from_records(self.records[::-1] + [{'time': 900000, 'bytes': 5}])
+        resampled = shuffled.resample(600000)
+        self.assertEqual([0, 600000], list(resampled.time))
+        self.assertEqual([2100, 5], list(resampled['bytes']))
+        self.assertTrue(math.isnan(resampled['num_sta'][1]))
+
+    def test_columnar_call(self):
+        client = UnifiClient("https://example.com")
+        client.session.cookies.set('unifises', 'cookie')
+        def request(method, url, **kwargs):
+            self.assertEqual(True, kwargs['stream'])
+            body = json.dumps({'meta': {'rc': 'ok'}, 'data': self.records})
+            return make_response(method, url, body=body, headers={'content-type': 'application/json'})
+        client.session.request = request
+        # one report chunk (the default range can cross a chunk boundary)
+        series = client.columnar('ap_stat_5min', start=1, end=600, site='default')
+        self.assertEqual(2100, series.sum('bytes'))
+
+    @unittest.skipIf(numpy is None, 'numpy not installed')
+    def test_numpy(self):
+        from unifi_api.utils.timeseries import TimeSeries
+        series = TimeSeries.from_records(self.records)
+        arrays = series.to_numpy()
+        self.assertEqual(numpy.int64, arrays['time'].dtype)
+        self.assertEqual(2100, arrays['bytes'].sum())
+        # shares memory with the column
+        series['bytes'][0] = 0
+        self.assertEqual(1500, arrays['bytes'].sum())
+        if pandas is not None:
+            frame = series.to_pandas()
+            self.assertEqual(['aa', 'bb', 'aa', 'bb'], list(frame['ap']))
+
+class TestReportCache(BaseTestCase):
+    hour = 60*60*1000
+
+    def make_fetch(self, calls):
+        def fetch(start, end):
+            calls.append((start, end))
+            first = -(-start // self.hour) * self.hour
+            return [{'time': ts, 'bytes': ts // self.hour, 'oid': 'x'} for ts in range(first, end + 1, self.hour)]
+        return fetch
+
+    def test_only_missing_ranges_fetched(self):
+        from unifi_api.utils.report_cache import ReportCache
+        cache = ReportCache()
+        calls = []
+        fetch = self.make_fetch(calls)
+        now = 100*self.hour + 10
+        args = ('default', 'site', None, 'hourly', ['bytes', 'time'])
+
+        first = cache.query(*args, 10*self.hour, 100*self.hour, fetch, now=now)
+        self.assertEqual(list(range(10, 101)), [r['bytes'] for r in first])
+        self.assertEqual([(10*self.hour, 100*self.hour)], calls)
+
+        # same range later: only the buckets closed since and the recent ones (settle margin of one bucket)
+        calls.clear()
+        second = cache.query(*args, 10*self.hour, 101*self.hour, fetch, now=now + self.hour)
+        self.assertEqual(list(range(10, 102)), [r['bytes'] for r in second])
+        self.assertEqual([(98*self.hour + 11, 101*self.hour)], calls)
+
+        # older range: only the part before what's cached
+        calls.clear()
+        third = cache.query(*args, 5*self.hour, 20*self.hour, fetch, now=now + self.hour)
+        self.assertEqual(list(range(5, 21)), [r['bytes'] for r in third])
+        self.assertEqual([(5*self.hour, 10*self.hour - 1)], calls)
+        # cached records have the fields of fetched ones
+        self.assertEqual({'time': 15*self.hour, 'bytes': 15, 'oid': 'x'}, third[10])
+        self.assertEqual(first[5], third[10])
+
+    def test_empty_and_partial_ranges(self):
+        from unifi_api.utils.report_cache import ReportCache
+        cache = ReportCache()
+        calls = []
+        args = ('default', 'site', None, 'hourly', ['bytes'])
+        now = 100*self.hour
+        def empty(start, end):
+            calls.append((start, end))
+            return []
+        cache.query(*args, 10*self.hour, 20*self.hour, empty, now=now)
+        # nothing came back: nothing is covered
+        cache.query(*args, 10*self.hour, 20*self.hour, self.make_fetch(calls), now=now)
+        self.assertEqual([(10*self.hour, 20*self.hour)] * 2, calls)
+
+        # covered only up to the newest record
+        def partial(start, end):
+            calls.append((start, end))
+            return [r for r in self.make_fetch([])(start, end) if r['time'] <= 35*self.hour]
+        calls.clear()
+        cache.query(*args, 30*self.hour, 40*self.hour, partial, now=now)
+        cache.query(*args, 30*self.hour, 40*self.hour, self.make_fetch(calls), now=now)
+        self.assertEqual([(30*self.hour, 40*self.hour), (36*self.hour, 40*self.hour)], calls)
+
+    def test_controllers(self):
+        from unifi_api.utils.report_cache import ReportCache
+        cache = ReportCache()
+        args = ('default', 'site', None, 'hourly', ['bytes'], 0, self.hour - 1)
+        one = cache.query(*args, lambda start, end: [{'time': 0, 'bytes': 1}], now=20*self.hour, controller='https://one')
+        two = cache.query(*args, lambda start, end: [{'time': 0, 'bytes': 2}], now=20*self.hour, controller='https://two')
+        self.assertEqual([1, 2], [one[0]['bytes'], two[0]['bytes']])
+        self.assertEqual(1, cache.query(*args, self.fail, now=20*self.hour, controller='https://one')[0]['bytes'])
+        cache.clear(controller='https://one')
+        self.assertEqual(2, cache.query(*args, self.fail, now=20*self.hour, controller='https://two')[0]['bytes'])
+
+    def test_no_site(self):
+        from unifi_api.utils.report_cache import ReportCache
+        cache = ReportCache()
+        calls = []
+        args = (None, 'user', 'AA:BB:CC:DD:EE:FF', 'hourly', ['bytes'], 0, 10*self.hour)
+        self.assertEqual(11, len(cache.query(*args, self.make_fetch(calls), now=20*self.hour)))
+        self.assertEqual(11, len(cache.query(*args, self.make_fetch(calls), now=20*self.hour)))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, cache._db.execute('SELECT COUNT(*) FROM coverage').fetchone()[0])
+
+    def test_persistent(self):
+        import os
+        import tempfile
+        from unifi_api.utils.report_cache import ReportCache
+        path = os.path.join(tempfile.mkdtemp(), 'reports.db')
+        calls = []
+        args = ('default', 'user', 'AA:BB:CC:DD:EE:FF', 'hourly', ['bytes'], 0, 10*self.hour)
+        cache = ReportCache(path)
+        cache.query(*args, self.make_fetch(calls), now=20*self.hour)
+        cache.close()
+        cache = ReportCache(path)
+        self.assertEqual(11, len(cache.query(*args, self.make_fetch(calls), now=20*self.hour)))
+        self.assertEqual(1, len(calls))
+        cache.clear()
+        cache.query(*args, self.make_fetch(calls), now=20*self.hour)
+        self.assertEqual(2, len(calls))
+
+    def test_client_reports(self):
+        from unifi_api.utils.report_cache import ReportCache
+        client = UnifiClient("https://example.com", report_cache=ReportCache())
+        client.session.cookies.set('unifises', 'cookie')
+        sent = []
+        def request(method, url, **kwargs):
+            sent.append(kwargs['json'])
+            body = json.dumps({'meta': {'rc': 'ok'}, 'data': [{'time': 1000, 'bytes': 1}]})
+            return make_response(method, url, body=body, headers={'content-type': 'application/json'})
+        client.session.request = request
+        self.assertEqual([{'time': 1000, 'bytes': 1}], client.site_stat_daily(start=0.001, end=3600))
+        self.assertEqual([{'time': 1000, 'bytes': 1}], client.site_stat_daily(start=0.001, end=3600))
+        self.assertEqual(1, len(sent))
+        # reports of every ap of a site aren't cached
+        client.ap_stat_daily(start=0.001, end=3600, site='default')
+        client.ap_stat_daily(start=0.001, end=3600, site='default')
+        self.assertEqual(3, len(sent))
+
+class TestChunkedReports(BaseTestCase):
+    def test_split_range(self):
+        from unifi_api.utils.times import split_range
+        self.assertEqual([(5, 9), (10, 19), (20, 21)], split_range(5, 21, 10))
+        self.assertEqual([(10, 19)], split_range(10, 19, 10))
+        self.assertEqual([], split_range(10, 9, 10))
+
+    def test_chunked_fetch(self):
+        import threading
+        from datetime import datetime
+        day = 24*60*60*1000
+        client = UnifiClient("https://example.com")
+        client.session.cookies.set('unifises', 'cookie')
+        client.report_max_workers = 2
+        sent = []
+        lock = threading.Lock()
+        def request(method, url, **kwargs):
+            start, end = kwargs['json']['start'], kwargs['json']['end']
+            with lock:
+                sent.append((start, end))
+            first = -(-start // 3600000) * 3600000
+            # overlapping buckets (the controller may include the end bucket)
+            records = [{'time': ts, 'oid': oid, 'bytes': 1} for ts in range(first, end + 2, 3600000) for oid in ('a', 'b')]
+            body = json.dumps({'meta': {'rc': 'ok'}, 'data': records})
+            return make_response(method, url, body=body, headers={'content-type': 'application/json'})
+        client.session.request = request
+
+        records = client.site_stat_5min(start=10*day/1000, end=13*day/1000)
+        self.assertEqual([(10*day, 11*day - 1), (11*day, 12*day - 1), (12*day, 13*day - 1), (13*day, 13*day)], sorted(sent))
+        times = [r['time'] for r in records]
+        self.assertEqual(sorted(times), times)
+        self.assertEqual(len(set((r['time'], r['oid']) for r in records)), len(records))
+        self.assertEqual(3*24 + 1, len(set(times)))
+
+        sent.clear()
+        client.stat_reportAp('default', (datetime.fromtimestamp(10*day/1000), datetime.fromtimestamp(12*day/1000)), interval='hourly')
+        self.assertEqual(1, len(sent))
+
+        # streaming: chunks are fetched one at a time, as the records are consumed
+        sent.clear()
+        with client.streaming():
+            streamed = client.site_stat_5min(start=10*day/1000, end=13*day/1000)
+            self.assertEqual([(10*day, 11*day - 1)], sent)
+            streamed = list(streamed)
+        self.assertEqual(4, len(sent))
+        self.assertEqual(records, streamed)
+
+class TestSync(BaseTestCase):
+    def test_sync_sessions(self):
+        import os
+        import tempfile
+        from unifi_api.utils.sync import SyncState
+        path = os.path.join(tempfile.mkdtemp(), 'sync.json')
+        client = UnifiClient("https://example.com")
+        client.session.cookies.set('unifises', 'cookie')
+        client.sync_state = SyncState(path)
+        base = int(time.time()) - 3600
+        sessions = [
+            {'_id': 'a', 'assoc_time': base, 'disassoc_time': base + 10, 'duration': 10},
+            {'_id': 'b', 'assoc_time': base + 100, 'disassoc_time': base + 110, 'duration': 10},
+        ]
+        sent = []
+        def request(method, url, **kwargs):
+            sent.append(kwargs['json']['start'])
+            body = json.dumps({'meta': {'rc': 'ok'}, 'data': [s for s in sessions if s['assoc_time']*1000 >= kwargs['json']['start']]})
+            return make_response(method, url, body=body, headers={'content-type': 'application/json'})
+        client.session.request = request
+
+        self.assertEqual(['a', 'b'], [s['_id'] for s in client.sync_sessions(overlap=50)])
+        # nothing new, `b` is re-read within the overlap but not returned
+        self.assertEqual([], list(client.sync_sessions(overlap=50)))
+        self.assertEqual((base + 50)*1000, sent[-1])
+
+        # changed and new records are returned, watermark survives a new state instance
+        sessions[1] = {'_id': 'b', 'assoc_time': base + 100, 'disassoc_time': base + 120, 'duration': 20}
+        sessions.append({'_id': 'c', 'assoc_time': base + 200, 'disassoc_time': base + 210, 'duration': 10})
+        client.sync_state = SyncState(path)
+        self.assertEqual(['b', 'c'], [s['_id'] for s in client.sync_sessions(overlap=50)])
+        self.assertEqual((base + 200, {'c'}), (client.sync_state.get('sessions', 'default')[0], set(client.sync_state.get('sessions', 'default')[1])))
+
+        client.sync_state.reset('sessions')
+        self.assertEqual(3, len(list(client.sync_sessions(overlap=50))))
+
+    def test_sync_long_sessions(self):
+        client = UnifiClient("https://example.com")
+        client.session.cookies.set('unifises', 'cookie')
+        base = int(time.time()) - 3600
+        sessions = [
+            # started long before the overlap window, still open
+            {'_id': 'long', 'assoc_time': base - 2000},
+            {'_id': 'a', 'assoc_time': base, 'disassoc_time': base + 10},
+        ]
+        sent = []
+        def request(method, url, **kwargs):
+            sent.append(kwargs['json']['start'] // 1000)
+            body = json.dumps({'meta': {'rc': 'ok'}, 'data': [s for s in sessions if s['assoc_time']*1000 >= kwargs['json']['start']]})
+            return make_response(method, url, body=body, headers={'content-type': 'application/json'})
+        client.session.request = request
+
+        self.assertEqual(['long', 'a'], [s['_id'] for s in client.sync_sessions(overlap=50)])
+        self.assertEqual([], list(client.sync_sessions(overlap=50)))
+        self.assertEqual(base - 2000, sent[-1])
+        # the long session ends after the watermark moved past it
+        sessions[0] = {'_id': 'long', 'assoc_time': base - 2000, 'disassoc_time': base + 500}
+        self.assertEqual(['long'], [s['_id'] for s in client.sync_sessions(overlap=50)])
+        # closed: back to the overlap window
+        self.assertEqual([], list(client.sync_sessions(overlap=50)))
+        self.assertEqual(base - 50, sent[-1])
+
+    def test_sync_closed_before_overlap(self):
+        client = UnifiClient("https://example.com")
+        client.session.cookies.set('unifises', 'cookie')
+        base = int(time.time()) - 3600
+        sessions = [
+            {'_id': 'long', 'assoc_time': base - 2000},
+            # closed, older than the overlap window but newer than the open session
+            {'_id': 'closed', 'assoc_time': base - 1000, 'disassoc_time': base - 900},
+            {'_id': 'last', 'assoc_time': base, 'disassoc_time': base + 10},
+        ]
+        def request(method, url, **kwargs):
+            body = json.dumps({'meta': {'rc': 'ok'}, 'data': [s for s in sessions if s['assoc_time']*1000 >= kwargs['json']['start']]})
+            return make_response(method, url, body=body, headers={'content-type': 'application/json'})
+        client.session.request = request
+
+        self.assertEqual(['long', 'closed', 'last'], [s['_id'] for s in client.sync_sessions(overlap=50)])
+        # re-read from the open session, nothing changed
+        self.assertEqual([], list(client.sync_sessions(overlap=50)))
+        self.assertEqual([], list(client.sync_sessions(overlap=50)))
+
+class TestRecords(BaseTestCase):
+    def test_record(self):
+        from unifi_api.utils.records import ClientRecord
+        data = {'mac': '00:11:22:33:44:55', 'hostname': 'a', 'radio_proto': 'ac', 'signal': -60}
+        rec = ClientRecord(data)
+        self.assertEqual('00:11:22:33:44:55', rec.mac)
+        self.assertIsNone(rec.ip)
+        self.assertNotIn('ip', rec)
+        self.assertIsNone(rec._extra)
+        self.assertEqual('ac', rec['radio_proto'])
+        self.assertEqual(-60, rec.get('signal'))
+        self.assertEqual(None, rec.get('noise'))
+        self.assertEqual(data, rec.to_dict())
+        with self.assertRaises(AttributeError):
+            rec.radio_proto = 'n'
+
+    def test_record_nulls(self):
+        from unifi_api.utils.records import SessionRecord
+        # open session: the controller sends disassoc_time as null
+        data = {'_id': 's', 'mac': '00:11:22:33:44:55', 'assoc_time': 10, 'disassoc_time': None, 'extra': None}
+        rec = SessionRecord(data)
+        self.assertIsNone(rec.disassoc_time)
+        self.assertIn('disassoc_time', rec)
+        self.assertIsNone(rec['disassoc_time'])
+        self.assertNotIn('ip', rec)
+        with self.assertRaises(KeyError):
+            rec['ip']
+        self.assertEqual(data, rec.to_dict())
+        self.assertEqual(rec, SessionRecord(rec.to_dict()))
+        self.assertNotEqual(rec, SessionRecord({k: v for k, v in data.items() if k != 'disassoc_time'}))
+
+    def test_records_call(self):
+        from unifi_api.utils.records import DeviceRecord
+        client = UnifiClient("https://example.com")
+        client.session.cookies.set('unifises', 'cookie')
+        devices = [{'mac': '00:11:22:33:44:%02x' % i, 'site_id': 's1', 'state': 1, 'uplink': {'type': 'wire'}} for i in range(3)]
+        def request(method, url, **kwargs):
+            body = json.dumps({'meta': {'rc': 'ok'}, 'data': devices})
+            return make_response(method, url, body=body, headers={'content-type': 'application/json'})
+        client.session.request = request
+
+        records = client.records('list_devices', site='default')
+        self.assertEqual([DeviceRecord] * 3, [type(r) for r in records])
+        self.assertEqual(devices, [r.to_dict() for r in records])
+        # equal field values share one object
+        self.assertIs(records[0].site_id, records[2].site_id)
+
+class TestWatcher(BaseTestCase):
+    def test_poll(self):
+        client = UnifiClient("https://example.com")
+        client.session.cookies.set('unifises', 'cookie')
+        stations = [
+            {'mac': '00:00:00:00:00:01', 'ap_mac': 'aa:00:00:00:00:01', 'ip': '10.0.0.1', 'rx_bytes': 1},
+            {'mac': '00:00:00:00:00:02', 'ap_mac': 'aa:00:00:00:00:01', 'ip': '10.0.0.2', 'rx_bytes': 1},
+        ]
+        devices = [{'mac': 'aa:00:00:00:00:01', 'state': 1}]
+        failing = []
+        def request(method, url, **kwargs):
+            if failing:
+                return make_response(method, url, body=json.dumps({'meta': {'rc': 'error', 'msg': 'x'}, 'data': []}), headers={'content-type': 'application/json'})
+            data = devices if url.endswith('stat/device') else stations
+            body = json.dumps({'meta': {'rc': 'ok'}, 'data': data})
+            return make_response(method, url, body=body, headers={'content-type': 'application/json'})
+        client.session.request = request
+
+        watcher = client.watch()
+        self.assertEqual(
+            [('join', 'client'), ('join', 'client'), ('join', 'device')],
+            [(e.kind, e.target) for e in watcher.poll()],
+        )
+        # unwatched fields don't make events
+        stations[0]['rx_bytes'] = 2
+        self.assertEqual([], watcher.poll())
+
+        stations[0]['ap_mac'] = 'aa:00:00:00:00:02'
+        stations[0]['ip'] = '10.0.0.3'
+        stations.append({'mac': '00:00:00:00:00:03', 'ap_mac': 'aa:00:00:00:00:01', 'ip': '10.0.0.4'})
+        devices[0]['state'] = 0
+        del stations[1]
+        from unifi_api.utils.watch import Event
+        self.assertEqual([
+            Event('roam', 'client', 'default', '00:00:00:00:00:01', 'aa:00:00:00:00:01', 'aa:00:00:00:00:02'),
+            Event('ip_change', 'client', 'default', '00:00:00:00:00:01', '10.0.0.1', '10.0.0.3'),
+            Event('join', 'client', 'default', '00:00:00:00:00:03', None, {'ap_mac': 'aa:00:00:00:00:01', 'ip': '10.0.0.4'}),
+            Event('leave', 'client', 'default', '00:00:00:00:00:02', {'ap_mac': 'aa:00:00:00:00:01', 'ip': '10.0.0.2'}, None),
+            Event('state_change', 'device', 'default', 'aa:00:00:00:00:01', 1, 0),
+        ], watcher.poll())
+
+        # a failed poll doesn't report everything as gone
+        failing.append(True)
+        self.assertEqual([], watcher.poll())
+        failing.clear()
+        self.assertEqual([], watcher.poll())
+
+class TestMetrics(BaseTestCase):
+    def test_endpoint_template(self):
+        from unifi_api.utils.metrics import endpoint_template
+        self.assertEqual('/api/s/{site}/stat/device/{mac}', endpoint_template('https://example.com:8443/api/s/site1/stat/device/F0-9F-C2-00-00-01'))
+        self.assertEqual('/api/s/{site}/rest/user/{id}', endpoint_template('https://example.com/api/s/default/rest/user/5f0000000000000000000001?x=1'))
+        self.assertEqual('/api/self/sites', endpoint_template('https://example.com/api/self/sites'))
+
+    def test_request_metrics(self):
+        client = UnifiClient("https://example.com", username='aaa', password='bbb')
+        client.session.cookies.set('unifises', 'cookie')
+        expired = ['x']
+        def request(method, url, **kwargs):
+            if url.endswith('/api/login'):
+                client.session.cookies.set('unifises', 'new')
+                return make_response(method, url, body='{"meta": {"rc": "ok"}, "data": []}', headers={'content-type': 'application/json'})
+            if expired:
+                expired.pop()
+                body = json.dumps({'meta': {'rc': 'error', 'msg': 'api.err.LoginRequired'}, 'data': []})
+                return make_response(method, url, body=body, status=401, headers={'content-type': 'application/json'})
+            body = json.dumps({'meta': {'rc': 'ok'}, 'data': [{'mac': '00:11:22:33:44:55'}]})
+            return make_response(method, url, body=body, headers={'content-type': 'application/json'})
+        client.session.request = request
+        client.session.post = lambda url, **kwargs: request('POST', url, **kwargs)
+
+        client.list_devices(site='site1')
+        client.list_devices(site='site2')
+        snapshot = client.metrics.snapshot()
+        devices = snapshot['endpoints']['GET /api/s/{site}/stat/device']
+        ok = len(json.dumps({'meta': {'rc': 'ok'}, 'data': [{'mac': '00:11:22:33:44:55'}]}))
+        login_required = len(json.dumps({'meta': {'rc': 'error', 'msg': 'api.err.LoginRequired'}, 'data': []}))
+        self.assertEqual({'requests': 3, 'status': {401: 1, 200: 2}, 'bytes': 2 * ok + login_required, 'relogin_retries': 1},
+                         {k: devices[k] for k in ('requests', 'status', 'bytes', 'relogin_retries')})
+        self.assertEqual(3, devices['latency']['buckets']['+Inf'])
+        self.assertEqual(2, devices['decode']['count'])
+        self.assertEqual({'ok': 1, 'failed': 0}, snapshot['logins'])
+        self.assertEqual(1, snapshot['endpoints']['POST /api/login']['requests'])
+
+        text = client.metrics.prometheus()
+        self.assertIn('unifi_requests_total{method="GET",endpoint="/api/s/{site}/stat/device",status="200"} 2', text)
+        self.assertIn('unifi_request_duration_seconds_bucket{method="GET",endpoint="/api/s/{site}/stat/device",le="+Inf"} 3', text)
+        self.assertIn('unifi_relogin_retries_total{method="GET",endpoint="/api/s/{site}/stat/device"} 1', text)
+        self.assertIn('unifi_logins_total{result="ok"} 1', text)
+
+    def test_lazy_debug(self):
+        class Lazy:
+            formatted = 0
+            def __str__(self):
+                Lazy.formatted += 1
+                return 'lazy'
+        instance = AbstractUnifiSession("https://example.com")
+        instance.debug('value: %s', Lazy())
+        self.assertEqual(0, Lazy.formatted)
+        with self.assertLogs('unifi_api', level='DEBUG') as logs:
+            instance.debug('value: %s', Lazy())
+        self.assertEqual(['DEBUG:unifi_api:value: lazy'], logs.output)
+
+class TestTracing(BaseTestCase):
+    def test_spans(self):
+        from unifi_api.fake_controller import FakeController
+        from unifi_api.utils.tracing import RecordingTracer
+        tracer = RecordingTracer()
+        with FakeController(sites=3, devices=2) as controller:
+            client = UnifiClient(controller.url, username='admin', password='admin', tracer=tracer)
+            with client.span('call'):
+                client.list_sites()
+            names = lambda spans: [s.name for s in spans]
+            call = tracer.named('call')[0]
+            request = tracer.named('request')[0]
+            self.assertEqual(call, request.parent)
+            self.assertEqual('/api/self/sites', request.attributes['endpoint'])
+            self.assertEqual(['login', 'request', 'decode', 'validate'], names(s for s in tracer.spans if s.parent is call))
+            self.assertEqual(['wait', 'read'], names(s for s in tracer.spans if s.parent is request))
+            wait = tracer.named('wait')[0]
+            self.assertEqual(200, wait.attributes['status'])
+            # the connection was opened by the login and reused
+            self.assertEqual('login', tracer.named('connect')[0].parent.name)
+            self.assertEqual([], names(s for s in tracer.spans if s.parent is wait))
+            self.assertTrue(all(s.duration >= 0 for s in tracer.spans))
+
+            # hidden re-login
+            tracer.spans.clear()
+            controller.expire_cookies()
+            client.list_sites()
+            relogin = tracer.named('relogin')[0]
+            self.assertEqual('request', relogin.parent.name)
+            self.assertEqual(['login'], names(s for s in tracer.spans if s.parent is relogin))
+
+            # find_device fan-out, across the worker threads
+            tracer.spans.clear()
+            self.assertEqual('site2', client.find_device('f0:9f:00:02:00:01'))
+            index = tracer.named('device_index')[0]
+            self.assertEqual('find_device', index.parent.name)
+            sites = tracer.named('site')
+            self.assertEqual(['default', 'site1', 'site2'], sorted(s.attributes['site'] for s in sites))
+            self.assertTrue(all(s.parent is index for s in sites))
+            self.assertEqual(3, len([s for s in tracer.named('request') if s.parent in sites]))
+
+class TestCookieStore(BaseTestCase):
+    def test_file_store(self):
+        import os
+        import tempfile
+        from unifi_api.utils.cookie_store import FileCookieStore
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cookies.json')
+            store = FileCookieStore(path)
+            key = store.key('https://example.com/', 'admin')
+            self.assertEqual('https://example.com|admin', key)
+            self.assertIsNone(store.load(key))
+            store.save(key, {'value': 'cookie', 'domain': 'example.com', 'path': '/', 'expires': None})
+            store.save('other', {'value': 'old', 'expires': time.time() - 1})
+            self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+            self.assertEqual('cookie', FileCookieStore(path).load(key)['value'])
+            self.assertIsNone(store.load('other'))
+            store.delete(key)
+            self.assertIsNone(store.load(key))
+
+    def test_restore(self):
+        from unifi_api.utils.cookie_store import MemoryCookieStore
+        store = MemoryCookieStore()
+        store.save(store.key('https://example.com', 'admin'), {'value': 'stored', 'domain': '', 'path': '/', 'expires': None})
+        client = UnifiClient('https://example.com', username='admin', password='admin', cookie_store=store)
+        def login(*args, **kwargs):
+            raise AssertionError('should reuse the stored cookie')
+        client.login = login
+        seen = []
+        def request(method, url, **kwargs):
+            seen.append(client.session.cookies.get('unifises'))
+            return make_response(method, url, body=json.dumps({'meta': {'rc': 'ok'}, 'data': []}), headers={'content-type':'application/json'})
+        client.session.request = request
+        self.assertEqual([], client.list_sites())
+        self.assertEqual(['stored'], seen)
+
+class TestSessionRefresh(BaseTestCase):
+    def test_check(self):
+        from unifi_api.fake_controller import FakeController
+        from unifi_api.utils.refresh import SessionRefresher
+        with FakeController() as controller:
+            client = UnifiClient(controller.url, username='admin', password='admin')
+            refresher = SessionRefresher(client, max_age=50, max_idle=300)
+            self.assertEqual('login', refresher.check())
+            self.assertTrue(client.logged_in)
+            self.assertIsNone(refresher.check())
+
+            # old session: new cookie, the old one is replaced without a gap
+            cookie = client.session_cookie().value
+            client.login_time -= 100
+            self.assertEqual('login', refresher.check())
+            self.assertNotEqual(cookie, client.session_cookie().value)
+            self.assertEqual(2, controller.stats['logins'])
+
+            # idle session: validated, or logged in again if it expired
+            client.login_time -= 400
+            refresher.max_age = None
+            self.assertEqual('validate', refresher.check())
+            controller.expire_cookies()
+            client.last_request -= 400
+            client.login_time -= 400
+            self.assertEqual('validate', refresher.check())
+            self.assertEqual(3, controller.stats['logins'])
+            self.assertIsNone(refresher.check())
+
+            refreshes = client.metrics.snapshot()['refreshes']
+            self.assertEqual({'ok': 2, 'failed': 0}, {k: refreshes['login'][k] for k in ('ok', 'failed')})
+            self.assertEqual(2, refreshes['validate']['ok'])
+            self.assertIn('unifi_session_refreshes_total{kind="validate",result="ok"} 2', client.metrics.prometheus())
+
+    def test_background(self):
+        from unifi_api.fake_controller import FakeController
+        with FakeController(cookie_ttl=0.5) as controller:
+            client = UnifiClient(controller.url, username='admin', password='admin')
+            refresher = client.start_refresh(max_age=0.2, interval=0.02)
+            try:
+                deadline = time.monotonic() + 1.2
+                while time.monotonic() < deadline:
+                    client.list_sites()
+                    time.sleep(0.01)
+            finally:
+                client.close_session()
+            self.assertFalse(refresher.running)
+            self.assertIsNone(client.refresher)
+            # the calls never met an expired cookie
+            self.assertEqual(0, controller.stats['login_required'])
+            self.assertGreaterEqual(client.metrics.snapshot()['refreshes']['login']['ok'], 4)
+
+    def test_backoff(self):
+        from unifi_api.utils.refresh import SessionRefresher
+        client = UnifiClient("https://example.com", username='admin', password='wrong')
+        client.refresh_login = lambda: False
+        refresher = SessionRefresher(client, interval=5, max_backoff=30)
+        now = time.monotonic()
+        self.assertEqual('login', refresher.check())
+        self.assertEqual(1, refresher.failures)
+        # retried after 10s, then 20s, then every 30s
+        self.assertIsNone(refresher.due(now + 9))
+        self.assertEqual('login', refresher.due(now + 11))
+        delays = []
+        for _ in range(3):
+            refresher.retry_at, before = None, time.monotonic()
+            refresher.check()
+            delays.append(round(refresher.retry_at - before))
+        self.assertEqual([20, 30, 30], delays)
+        client.refresh_login = lambda: True
+        refresher.retry_at = None
+        refresher.check()
+        self.assertEqual((0, None), (refresher.failures, refresher.retry_at))
+
+    def test_logout_stops(self):
+        from unifi_api.fake_controller import FakeController
+        with FakeController() as controller:
+            client = UnifiClient(controller.url, username='admin', password='admin')
+            client.login()
+            refresher = client.start_refresh(max_age=0.05, interval=0.01)
+            self.assertTrue(client.logout())
+            self.assertFalse(refresher.running)
+            self.assertIsNone(client.refresher)
+            logins = controller.stats['logins']
+            time.sleep(0.1)
+            self.assertFalse(client.logged_in)
+            self.assertEqual(logins, controller.stats['logins'])
+
+class TestClientPool(BaseTestCase):
+    def test_routing(self):
+        from unifi_api import UnifiClientPool
+        from unifi_api.fake_controller import FakeController
+        from unifi_api.utils.exceptions import UnifiRoutingError
+        with FakeController(sites=1, devices=2) as a, FakeController(sites=3, devices=4) as b:
+            pool = UnifiClientPool({
+                'a': UnifiClient(a.url, username='admin', password='admin'),
+                'b': UnifiClient(b.url, username='admin', password='admin'),
+            }, max_concurrency={'a': 1, 'b': 2})
+            self.assertEqual(4, len(pool.list_devices(site='site2')))
+            self.assertEqual({'default': ['a', 'b'], 'site1': ['b'], 'site2': ['b']}, pool.routes)
+            self.assertRaises(UnifiRoutingError, pool.list_devices, site='default')
+            self.assertRaises(UnifiRoutingError, pool.list_devices, site='missing')
+            self.assertEqual(2, len(pool.list_devices(site='default', controller='a')))
+
+            self.assertEqual({'a': 1, 'b': 3}, {name: len(sites) for name, sites in pool.fan_out('list_sites')})
+            results = dict(pool.for_each_site('list_devices'))
+            self.assertEqual([('a', 'default'), ('b', 'default'), ('b', 'site1'), ('b', 'site2')], sorted(results))
+            self.assertEqual(2, len(results['a', 'default']))
+            self.assertEqual(1, pool.states['a'].max_concurrency)
+            self.assertTrue(all(state['healthy'] for state in pool.health().values()))
+
+    def test_route_refresh(self):
+        from unifi_api import UnifiClientPool
+        from unifi_api.utils.exceptions import UnifiRoutingError
+        calls = []
+        class Client:
+            def __init__(self, sites):
+                self.sites = sites
+            def list_sites(self):
+                calls.append(self)
+                return self.sites
+        a, b = Client([{'name': 'default'}]), Client([{'name': 'site1'}])
+        pool = UnifiClientPool({'a': a, 'b': b}, route_refresh=60)
+        self.assertEqual('b', pool.route('site1'))
+        self.assertEqual(2, len(calls))
+        # unknown sites don't rebuild the table again before route_refresh
+        for _ in range(3):
+            self.assertRaises(UnifiRoutingError, pool.route, 'missing')
+        self.assertEqual(2, len(calls))
+        # a controller answering False keeps its sites
+        b.sites = False
+        pool.routes_time -= 60
+        self.assertRaises(UnifiRoutingError, pool.route, 'missing')
+        self.assertEqual(4, len(calls))
+        self.assertEqual({'default': ['a'], 'site1': ['b']}, pool.routes)
+
+    def test_workers(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from unittest import mock
+        from unifi_api import UnifiClientPool
+        pool = UnifiClientPool({'a': object(), 'b': object()}, max_concurrency={'a': 1, 'b': 2})
+        tasks = [(i, 'a' if i % 2 else 'b', lambda client: None, (), {}) for i in range(20)]
+        with mock.patch('unifi_api.pool.ThreadPoolExecutor', wraps=ThreadPoolExecutor) as executor:
+            self.assertEqual(20, len(list(pool._parallel(tasks, {}))))
+        executor.assert_called_once_with(max_workers=3)
+
+    def test_health(self):
+        from unifi_api import UnifiClientPool
+        from unifi_api.fake_controller import FakeController
+        from unifi_api.utils.exceptions import UnifiControllerErrors, UnifiControllerUnavailable
+        with FakeController(sites=1) as a:
+            down = FakeController().start()
+            down.stop()
+            pool = UnifiClientPool([
+                UnifiClient(a.url, username='admin', password='admin'),
+                UnifiClient(down.url, username='admin', password='admin'),
+            ], max_failures=2, retry_after=60)
+            errors = {}
+            for i in range(2):
+                self.assertEqual([a.url], [name for name, _ in pool.fan_out('list_sites', errors=errors)])
+            self.assertIsInstance(errors[down.url], requests.exceptions.ConnectionError)
+            self.assertFalse(pool.health()[down.url]['healthy'])
+            self.assertTrue(pool.health()[a.url]['healthy'])
+            # skipped while unhealthy
+            with self.assertRaises(UnifiControllerErrors) as ctx:
+                list(pool.fan_out('list_sites'))
+            self.assertIsInstance(ctx.exception.errors[down.url], UnifiControllerUnavailable)
+            self.assertEqual(2, pool.states[down.url].calls)
+            # tried again after retry_after
+            pool.states[down.url].unhealthy_since -= 60
+            self.assertTrue(pool.available(down.url))
+
+class TestRateLimiter(BaseTestCase):
+    def test_token_bucket(self):
+        from unifi_api.utils.limiter import TokenBucket
+        bucket = TokenBucket(20, burst=2)
+        started = time.monotonic()
+        waits = [bucket.acquire() for i in range(6)]
+        self.assertEqual([0, 0], waits[:2])
+        self.assertTrue(all(w > 0 for w in waits[2:]))
+        self.assertGreaterEqual(time.monotonic() - started, 0.18)
+
+    def test_aimd(self):
+        from unifi_api.utils.limiter import AIMDLimit
+        limit = AIMDLimit(initial=4, min_limit=1, max_limit=5, target_latency=1)
+        starts = [limit.acquire() for i in range(4)]
+        self.assertEqual(4, limit.in_flight)
+        # successes while the limit is in use grow it by 1/limit each
+        for i in range(5):
+            limit.release(starts.pop(0), 0.1)
+            while limit.in_flight < int(limit.limit):
+                starts.append(limit.acquire())
+        self.assertEqual(5, limit.limit)
+        self.assertEqual(5, limit.in_flight)
+        for started in starts:
+            limit.release(started, 0.1)
+        self.assertEqual(5, limit.increases)
+        # errors of one round trip halve it once
+        starts = [limit.acquire() for i in range(3)]
+        limit.release(starts[0], 0.1, error=True)
+        limit.release(starts[1], 0.1, error=True)
+        limit.release(starts[2], 0.1)
+        self.assertEqual(2.5, limit.limit)
+        # slow responses are congestion too
+        limit.release(limit.acquire(), 1.5)
+        self.assertEqual(1.25, limit.limit)
+        limit.release(limit.acquire(), 5)
+        self.assertEqual(1, limit.limit)
+        self.assertEqual(3, limit.decreases)
+
+    def test_session(self):
+        from unifi_api.fake_controller import FakeController
+        from unifi_api.utils.limiter import RateLimiter, AIMDLimit
+        limiter = RateLimiter(class_rates={'report': 1000}, concurrency=AIMDLimit(initial=2))
+        self.assertEqual('report', limiter.classify('https://h/api/s/default/stat/report/hourly.site'))
+        self.assertEqual('command', limiter.classify('https://h/api/s/default/cmd/stamgr'))
+        self.assertEqual('listing', limiter.classify('https://h/api/s/default/stat/device'))
+        with FakeController(sites=4, failure_rate=0.5, seed=1) as controller:
+            client = UnifiClient(controller.url, username='admin', password='admin', limiter=limiter)
+            errors = {}
+            list(client.for_each_site('list_devices', sites=['default', 'site1', 'site2', 'site3'] * 4, errors=errors))
+            client.site_stat_hourly(site='default')
+            stats = limiter.stats()
+            self.assertEqual(controller.stats['requests'] - controller.stats['logins'], sum(c['requests'] for c in stats['classes'].values()))
+            self.assertEqual(controller.stats['failures'], stats['classes']['listing']['errors'] + stats['classes']['report']['errors'])
+            self.assertGreater(stats['concurrency']['decreases'], 0)
+            self.assertEqual(0, stats['concurrency']['in_flight'])
+
+class TestCoalescing(BaseTestCase):
+    def test_single_flight(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from unifi_api.fake_controller import FakeController
+        with FakeController(sites=2, latency=0.2) as controller:
+            client = UnifiClient(controller.url, username='admin', password='admin', coalesce=True)
+            client.login()
+            requests_before = controller.stats['requests']
+            with ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(lambda i: client.list_devices(site='site1'), range(8)))
+            self.assertTrue(all(r == results[0] for r in results))
+            self.assertEqual(requests_before + 1, controller.stats['requests'])
+            self.assertEqual({'calls': 1, 'coalesced': 7, 'in_flight': 0}, client.coalescer.stats())
+            self.assertEqual(7, client.metrics.snapshot()['endpoints']['GET /api/s/{site}/stat/device']['coalesced'])
+
+            # different bodies and writes aren't coalesced
+            requests_before = controller.stats['requests']
+            with ThreadPoolExecutor(4) as executor:
+                list(executor.map(lambda site: client.list_devices(site=site), ['default', 'site1']))
+                list(executor.map(lambda i: client.block_sta('00:11:22:33:44:55', site='default'), range(4)))
+            self.assertEqual(requests_before + 6, controller.stats['requests'])
+            self.assertEqual(7, client.coalescer.coalesced)
+
+class TestStrictResponses(BaseTestCase):
+    def test_option(self):
+        from unittest import mock
+        self.assertFalse(UnifiClient("https://example.com", debug=True).strict_responses)
+        client = UnifiClient("https://example.com", strict_responses=True)
+        client.session.cookies.set('unifises', 'cookie')
+        def request(method, url, **kwargs):
+            return make_response(method, url, body=json.dumps({'meta': {'rc': 'ok'}, 'data': [1]}), headers={'content-type': 'application/json'})
+        client.session.request = request
+        with mock.patch.object(models, 'JsonResponse', wraps=models.JsonResponse) as strict:
+            self.assertEqual([1], client.list_sites())
+        self.assertEqual(1, strict.call_count)
+
 # models: ...
 class TestModels(BaseTestCase):
     def test_ident(self):
         self.assertEqual(True, True)
 
+    def test_check_response(self):
+        ok = {'data': [{'a': 1}], 'meta': {'rc': 'ok'}}
+        self.assertIs(ok, models.check_response(ok))
+        self.assertIs(ok['data'], models.check_response(ok)['data'])
+        self.assertEqual('abc', models.check_response({'data': 'abc', 'meta': {'rc': 'error', 'msg': 'x'}})['data'])
+        for bad in ({}, [], {'data': [], 'meta': {'rc': 'bla'}}, {'data': 1, 'meta': {'rc': 'ok'}}, {'data': [], 'meta': {'rc': 'ok', 'msg': 1}}):
+            self.assertRaises(t.DataError, models.check_response, bad)
+
 if __name__ == '__main__':
     unittest.main()